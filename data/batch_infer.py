@@ -0,0 +1,241 @@
+import logging
+import torch
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def pad_sequences(seqs, width=None, dtype=np.int32):
+    """Packs a list of id lists into a zero padded [N, width] matrix plus a length vector."""
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    if width is None:
+        width = int(lengths.max()) if len(seqs) > 0 else 0
+    matrix = np.zeros([len(seqs), width], dtype=dtype)
+    for i, s in enumerate(seqs):
+        matrix[i, :len(s)] = s
+    return matrix, lengths
+
+
+def bucket_batches(lengths, max_tokens, max_batch_size=None):
+    """Groups row indices into batches of similar length.
+
+    Rows are sorted longest first, so the first row of every batch fixes its padded
+    length and the batch takes as many rows as fit in `max_tokens` (rows x padded length).
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(-lengths, kind="stable")
+    batches = []
+    begin = 0
+    N = len(order)
+    while begin < N:
+        longest = max(int(lengths[order[begin]]), 1)
+        size = max(1, max_tokens // longest)
+        if max_batch_size is not None:
+            size = min(size, max_batch_size)
+        batches.append(order[begin:begin + size])
+        begin += size
+    return batches
+
+
+def unique_rows(input_ids, lengths, segment_ids=None):
+    """Finds exact duplicate rows, comparing ids (and segment ids) up to each row's length.
+
+    Returns the index of the first occurrence of every distinct row and, for every row,
+    the position of its distinct row in that list.
+    """
+    lengths = np.asarray(lengths)
+    # -1 past each row's length, so rows only match up to their length and rows of different lengths never match
+    padding = np.arange(input_ids.shape[1]) >= lengths[:, None]
+    keys = [np.where(padding, -1, input_ids)]
+    if segment_ids is not None:
+        keys.append(np.where(padding, -1, segment_ids))
+    keys = np.ascontiguousarray(np.concatenate(keys, axis=1))
+    # rows are grouped by a random projection, exact unless two distinct rows collide, which is checked
+    hashes = keys @ np.random.default_rng(0).random(keys.shape[1])
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    if not (keys == keys[first[inverse]]).all():
+        rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+    # np.unique sorts the distinct rows, put them back in the order of their first occurrence
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return first[order].astype(np.int64), rank[inverse]
+
+
+def ranges(starts, lengths):
+    """The concatenated `np.arange(start, start + length)` of every (start, length)."""
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(int(np.sum(lengths))) - np.repeat(offsets - starts, lengths)
+
+
+class RaggedRows(object):
+    """Variable length outputs of a batch of rows: their values back to back plus the start of every row."""
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def concat(cls, parts):
+        """The rows of all `parts`, one after the other."""
+        offsets = np.zeros(sum(len(part) for part in parts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.concatenate([np.diff(part.offsets) for part in parts]))
+        return cls(np.concatenate([part.values for part in parts]), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def split(self):
+        """Every row as a `RaggedRows` of its own, the unit of the score cache."""
+        return [RaggedRows(self.row(i), np.array([0, self.offsets[i + 1] - self.offsets[i]])) for i in range(len(self))]
+
+    def take(self, index):
+        """The rows `index`, in that order."""
+        counts = np.diff(self.offsets)[index]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return RaggedRows(self.values[ranges(self.offsets[:-1][index], counts)], offsets)
+
+
+class BucketedInference(object):
+    """Batched inference over variable length inputs with per-batch dynamic padding.
+
+    Inputs are given as a zero padded id matrix plus lengths. Each batch is cut to its own
+    longest row instead of `max_seq_length`, and the outputs are scattered back to the
+    original row order. With `dedup`, repeated rows are run once and their output is
+    shared by every occurrence. With a `ScoreCache`, outputs of rows seen by an earlier
+    run (of this or another process) are read back instead of recomputed.
+    """
+    def __init__(self, model, device, max_tokens, max_batch_size=None, dedup=True, cache=None):
+        self.model = model
+        self.device = device
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.dedup = dedup
+        self.cache = cache
+        self.num_rows = 0
+        self.num_unique_rows = 0
+
+    def log_stats(self, name):
+        if self.num_rows > 0:
+            logger.info("{}: ran {} unique of {} rows, dedup ratio {:.4f}".format(
+                name, self.num_unique_rows, self.num_rows, 1 - self.num_unique_rows / self.num_rows))
+        if self.cache is not None:
+            self.cache.log_stats(name)
+
+    def run(self, input_ids, lengths, forward_fn, segment_ids=None, max_tokens=None, grad=False, desc="Evaluating",
+            cache_name=None):
+        """Runs `forward_fn(input_ids, input_mask, segment_ids)` over length bucketed batches.
+
+        `forward_fn` returns either an np.ndarray whose first dim is the batch, a list with one
+        entry per row, or `RaggedRows`. The result has the same type, in the original row order.
+        Set `grad` for forward functions that backpropagate (e.g. saliency scores), their
+        outputs are never cached. Outputs are cached under `cache_name`, by default the name of
+        `forward_fn`; it must change with every setting the outputs depend on.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        inverse = None
+        if self.dedup:
+            rows, inverse = unique_rows(input_ids, lengths, segment_ids)
+            self.num_rows += len(lengths)
+            self.num_unique_rows += len(rows)
+            if len(rows) < len(lengths):
+                input_ids, lengths = input_ids[rows], lengths[rows]
+                segment_ids = None if segment_ids is None else segment_ids[rows]
+            else:
+                inverse = None
+
+        if self.cache is not None and not grad:
+            outputs = self.run_cached(input_ids, lengths, forward_fn, segment_ids, max_tokens, desc,
+                                      cache_name or forward_fn.__name__)
+        else:
+            outputs = self.run_rows(input_ids, lengths, forward_fn, segment_ids, max_tokens, grad, desc)
+
+        if inverse is None:
+            return outputs
+        if isinstance(outputs, np.ndarray):
+            return outputs[inverse]
+        if isinstance(outputs, RaggedRows):
+            return outputs.take(inverse)
+        return [outputs[j] for j in inverse]
+
+    def run_cached(self, input_ids, lengths, forward_fn, segment_ids, max_tokens, desc, cache_name):
+        # outputs are cached per row
+        keys = [self.cache.key(cache_name, input_ids[i, :L], None if segment_ids is None else segment_ids[i, :L])
+                for i, L in enumerate(lengths)]
+        found = self.cache.get_many(keys)
+        values = [found.get(key) for key in keys]
+        miss = np.array([i for i, key in enumerate(keys) if key not in found], dtype=np.int64)
+        if len(miss) > 0:
+            res = self.run_rows(input_ids[miss], lengths[miss], forward_fn, None if segment_ids is None else segment_ids[miss],
+                                max_tokens, False, desc)
+            if isinstance(res, RaggedRows):
+                res = res.split()
+            for i, r in zip(miss, res):
+                values[i] = r
+            self.cache.put_many([(keys[i], values[i]) for i in miss])
+        if len(values) > 0 and isinstance(values[0], RaggedRows):
+            return RaggedRows.concat(values)
+        # per row outputs of different lengths stay a list
+        if len(values) > 0 and isinstance(values[0], np.ndarray) and all(v.shape == values[0].shape for v in values):
+            return np.stack(values)
+        return values
+
+    def run_rows(self, input_ids, lengths, forward_fn, segment_ids, max_tokens, grad, desc):
+        N = len(lengths)
+        max_tokens = max_tokens if max_tokens is not None else self.max_tokens
+        outputs = None
+        ragged = []
+
+        self.model.eval()
+        for idx in tqdm(bucket_batches(lengths, max_tokens, self.max_batch_size), desc=desc):
+            L = int(lengths[idx[0]])
+            batch_lengths = torch.from_numpy(lengths[idx])
+            input_mask = (torch.arange(L).unsqueeze(0) < batch_lengths.unsqueeze(1)).long()
+            batch_input_ids = torch.from_numpy(input_ids[idx, :L].astype(np.int64)) * input_mask
+            if segment_ids is None:
+                batch_segment_ids = torch.zeros_like(batch_input_ids)
+            else:
+                batch_segment_ids = torch.from_numpy(segment_ids[idx, :L].astype(np.int64)) * input_mask
+
+            with torch.set_grad_enabled(grad):
+                res = forward_fn(batch_input_ids.to(self.device), input_mask.to(self.device), batch_segment_ids.to(self.device))
+
+            if isinstance(res, RaggedRows):
+                # placed in row order once all batches are in
+                ragged.append((idx, res))
+                continue
+            if outputs is None:
+                if isinstance(res, np.ndarray):
+                    outputs = np.zeros((N,) + res.shape[1:], dtype=res.dtype)
+                else:
+                    outputs = [None] * N
+            if isinstance(outputs, np.ndarray):
+                outputs[idx] = res
+            else:
+                for i, r in zip(idx, res):
+                    outputs[i] = r
+
+        if len(ragged) > 0:
+            return self.gather_ragged(ragged, N)
+        if outputs is None:
+            outputs = []
+        return outputs
+
+    def gather_ragged(self, batches, N):
+        """The `RaggedRows` of every (row indices, `RaggedRows`) batch as one, in row order."""
+        counts = np.zeros(N, dtype=np.int64)
+        for idx, res in batches:
+            counts[idx] = np.diff(res.offsets)
+        offsets = np.zeros(N + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        values = np.zeros(offsets[-1], dtype=batches[0][1].values.dtype)
+        for idx, res in batches:
+            values[ranges(offsets[:-1][idx], counts[idx])] = res.values
+        return RaggedRows(values, offsets)
@@ -0,0 +1,94 @@
+"""Compare size and write/read throughput of hdf5 codecs and chunk shapes on a pretraining file.
+
+Every setting rewrites the datasets of `--input_file` with `HDF5Appender`, then reads them back
+in batches of `--batch_size` rows, once in order and once from random batch aligned offsets.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+sys.path.append("../")
+
+from data.hdf5_writer import FEATURE_DTYPES, HDF5Appender
+
+logger = logging.getLogger(__name__)
+
+
+def parse_codec(codec):
+    """"gzip:6" -> ("gzip", 6), "lzf" -> ("lzf", None)"""
+    name, _, level = codec.partition(":")
+    return name, int(level) if level else None
+
+
+def read_batches(filename, batch_size, starts):
+    begin = time.time()
+    with h5py.File(filename, "r") as f:
+        datasets = [f[name] for name in FEATURE_DTYPES]
+        for start in starts:
+            for dataset in datasets:
+                dataset[start:start + batch_size]
+    return time.time() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", default=None, type=str, required=True,
+                        help="An hdf5 file written by create_data.py.")
+    parser.add_argument("--output_dir", default=None, type=str, required=True,
+                        help="Where the rewritten files go, they are removed afterwards.")
+    parser.add_argument("--codecs", default="none,lzf,gzip:1,gzip:4,gzip:9", type=str,
+                        help="Comma separated codecs, gzip:N is gzip at level N.")
+    parser.add_argument("--chunk_rows", default="256,1024,4096", type=str, help="Comma separated chunk sizes in rows.")
+    parser.add_argument("--batch_size", default=32, type=int, help="Rows per read, the loader's batch size.")
+    parser.add_argument("--num_random_batches", default=2000, type=int)
+    parser.add_argument("--random_seed", default=12345, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.WARN)
+
+    with h5py.File(args.input_file, "r") as f:
+        features = {name: f[name][:] for name in FEATURE_DTYPES}
+    num_rows = len(features["input_ids"])
+    raw_mb = sum(array.nbytes for array in features.values()) / (1 << 20)
+    max_seq_length = features["input_ids"].shape[1]
+    max_predictions_per_seq = features["masked_lm_ids"].shape[1]
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    rng = np.random.RandomState(args.random_seed)
+    seq_starts = list(range(0, num_rows, args.batch_size))
+    rand_starts = (rng.randint(0, max(num_rows // args.batch_size, 1), args.num_random_batches) * args.batch_size).tolist()
+
+    print("{} rows, {:.1f} MB uncompressed, batches of {} rows".format(num_rows, raw_mb, args.batch_size))
+    print("{:<8} {:>7} {:>9} {:>11} {:>13} {:>13}".format(
+        "codec", "chunks", "size(MB)", "write MB/s", "seq rows/s", "random rows/s"))
+    for codec in args.codecs.split(","):
+        compression, level = parse_codec(codec)
+        for chunk_rows in [int(x) for x in args.chunk_rows.split(",")]:
+            filename = os.path.join(args.output_dir, "bench_{}_{}.hdf5".format(codec.replace(":", ""), chunk_rows))
+            begin = time.time()
+            writer = HDF5Appender(filename, max_seq_length, max_predictions_per_seq, chunk_rows=chunk_rows,
+                                  compression=compression, compression_level=level)
+            writer.append(features)
+            writer.close()
+            write_elapsed = time.time() - begin
+            size_mb = os.path.getsize(filename) / (1 << 20)
+            seq_elapsed = read_batches(filename, args.batch_size, seq_starts)
+            rand_elapsed = read_batches(filename, args.batch_size, rand_starts)
+            print("{:<8} {:>7} {:>9.1f} {:>11.1f} {:>13.0f} {:>13.0f}".format(
+                codec, chunk_rows, size_mb, raw_mb / max(write_elapsed, 1e-9), num_rows / max(seq_elapsed, 1e-9),
+                len(rand_starts) * args.batch_size / max(rand_elapsed, 1e-9)))
+            os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Compare instances/sec of the list based and the array based training instance builders on a corpus.
+
+The list based builder, one `TrainingInstance` per row, is the reference implementation of
+`documents_to_features` in create_data.py and only lives here.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import collections
+import logging
+import random
+import sys
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append("../")
+
+import model.tokenization as tokenization
+from data.create_data import documents_to_features
+from data.data_utils import processors
+from data.hdf5_writer import FEATURE_DTYPES, write_features
+from data.rand_mask_gen import RandMask
+
+logger = logging.getLogger(__name__)
+
+
+class TrainingInstance(object):
+    """A single training instance (sentence pair)."""
+    def __init__(self, tokens, segment_ids, masked_lm_positions, masked_lm_labels, is_random_next):
+        self.tokens = tokens
+        self.segment_ids = segment_ids
+        self.is_random_next = is_random_next
+        self.masked_lm_positions = masked_lm_positions
+        self.masked_lm_labels = masked_lm_labels
+
+    def __str__(self):
+        s = ""
+        s += "tokens: %s\n" % (" ".join(
+            [tokenization.printable_text(x) for x in self.tokens]))
+        s += "segment_ids: %s\n" % (" ".join([str(x) for x in self.segment_ids]))
+        s += "is_random_next: %s\n" % self.is_random_next
+        s += "masked_lm_positions: %s\n" % (" ".join(
+            [str(x) for x in self.masked_lm_positions]))
+        s += "masked_lm_labels: %s\n" % (" ".join(
+            [tokenization.printable_text(x) for x in self.masked_lm_labels]))
+        s += "\n"
+        return s
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def instances_to_features(instances, tokenizer, max_seq_length, max_predictions_per_seq):
+    """Converts `TrainingInstance`s to the padded feature arrays stored in the hdf5 files."""
+    features = collections.OrderedDict()
+    
+    num_instances = len(instances)
+    features["input_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
+    features["input_mask"] = np.zeros([num_instances, max_seq_length], dtype="int32")
+    features["segment_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
+    features["masked_lm_positions"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
+    features["masked_lm_ids"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
+    features["next_sentence_labels"] = np.zeros(num_instances, dtype="int32")
+
+
+    for inst_index, instance in enumerate(tqdm(instances, desc="Writing Instances")):
+        input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
+        input_mask = [1] * len(input_ids)
+        segment_ids = list(instance.segment_ids)
+        assert len(input_ids) <= max_seq_length
+
+        while len(input_ids) < max_seq_length:
+            input_ids.append(0)
+            input_mask.append(0)
+            segment_ids.append(0)
+
+        assert len(input_ids) == max_seq_length
+        assert len(input_mask) == max_seq_length
+        assert len(segment_ids) == max_seq_length
+
+        masked_lm_positions = list(instance.masked_lm_positions)
+        masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
+        masked_lm_weights = [1.0] * len(masked_lm_ids)
+
+        while len(masked_lm_positions) < max_predictions_per_seq:
+            masked_lm_positions.append(0)
+            masked_lm_ids.append(0)
+            masked_lm_weights.append(0.0)
+
+        next_sentence_label = 1 if instance.is_random_next else 0
+
+        features["input_ids"][inst_index] = input_ids
+        features["input_mask"][inst_index] = input_mask
+        features["segment_ids"][inst_index] = segment_ids
+        features["masked_lm_positions"][inst_index] = masked_lm_positions
+        features["masked_lm_ids"][inst_index] = masked_lm_ids
+        features["next_sentence_labels"][inst_index] = next_sentence_label
+
+    return features
+
+
+def write_instance_to_example_file(instances, tokenizer, max_seq_length,
+                                    max_predictions_per_seq, output_file):
+    """Create TF example files from `TrainingInstance`s."""
+    print(output_file)
+    features = instances_to_features(instances, tokenizer, max_seq_length, max_predictions_per_seq)
+    write_features(features, output_file)
+
+
+def documents_to_instances(all_documents, vocab, max_seq_length, short_seq_prob, masked_lm_prob, max_predictions_per_seq, rng):
+    """Drops empty documents, shuffles the rest and builds shuffled `TrainingInstance`s from them.
+
+    `vocab` is the id -> token list of the tokenizer, for the replacement tokens."""
+    instances = []
+    all_documents = [x for x in all_documents if x]
+    rng.shuffle(all_documents)
+    for document_index in range(len(all_documents)):
+        instances.extend(create_instances_from_document(all_documents, document_index, vocab, max_seq_length,
+            short_seq_prob, masked_lm_prob, max_predictions_per_seq, rng))
+
+    rng.shuffle(instances)
+    return all_documents, instances
+
+
+def create_instances_from_document(
+    all_documents, document_index, vocab, max_seq_length, short_seq_prob,
+    masked_lm_prob, max_predictions_per_seq, rng):
+    """Creates `TrainingInstance`s for a single document."""
+
+    # document: MaskedTokenInstance: (ids, positions, mask_ids)
+    document = all_documents[document_index]
+
+    # Account for [CLS], [SEP]
+    max_num_tokens = max_seq_length - 2
+
+    target_seq_length = max_num_tokens
+    if rng.random() < short_seq_prob:
+        target_seq_length = rng.randint(2, max_num_tokens)
+
+    instances = []
+    current_chunk = []
+    current_length = 0
+    i = 0
+    while i < len(document):
+        segment = document[i] # segment: MaskedTokenInstance (ids, positions, mask_ids)
+        current_chunk.append(segment)
+        current_length += len(segment.ids)
+        if i == len(document) - 1 or current_length >= target_seq_length:
+            if current_chunk:
+                tokens_a = []
+                m_info_a = [] # replacement id of every token, -1 if it is not masked
+                for j in range(len(current_chunk)):
+                    segment_mask = np.full(len(current_chunk[j].ids), -1, dtype=np.int64)
+                    segment_mask[current_chunk[j].positions] = current_chunk[j].mask_ids
+                    tokens_a.extend(vocab[token_id] for token_id in current_chunk[j].ids)
+                    m_info_a.extend(segment_mask.tolist())
+                truncate_seq_pair(tokens_a, m_info_a, [], [], max_num_tokens, rng)
+
+                assert len(tokens_a) >= 1
+
+                tokens = []
+                m_info = []
+                segment_ids = []
+                tokens.append("[CLS]")
+                m_info.append(-1)
+                segment_ids.append(0)
+                for token, info in zip(tokens_a, m_info_a):
+                    tokens.append(token)
+                    m_info.append(info)
+                    segment_ids.append(0)
+
+                tokens.append("[SEP]")
+                m_info.append(-1)
+                segment_ids.append(0)
+
+                masked_lm_positions = [index for index in range(len(m_info)) if m_info[index] >= 0]
+                if len(masked_lm_positions) > max_predictions_per_seq:
+                    rng.shuffle(masked_lm_positions)
+                    masked_lm_positions = masked_lm_positions[0:max_predictions_per_seq]
+                    masked_lm_positions.sort()
+                masked_lm_labels = [tokens[pos] for pos in masked_lm_positions]
+                
+                for pos in masked_lm_positions:
+                    tokens[pos] = vocab[m_info[pos]]
+
+                is_random_next = False
+                instance = TrainingInstance(
+                    tokens=tokens,
+                    segment_ids=segment_ids,
+                    is_random_next=is_random_next,
+                    masked_lm_positions=masked_lm_positions,
+                    masked_lm_labels=masked_lm_labels)
+                instances.append(instance)
+            current_chunk = []
+            current_length = 0  
+        i += 1
+    return instances
+
+
+def truncate_seq_pair(tokens_a, m_info_a, tokens_b, m_info_b, max_num_tokens, rng):
+    """Truncates a pair of sequences to a maximum sequence length."""
+    while True:
+        total_length = len(tokens_a) + len(tokens_b)
+        if total_length <= max_num_tokens:
+            break
+
+        (trunc_tokens, trunc_info) = (tokens_a, m_info_a) if len(tokens_a) > len(tokens_b) else (tokens_b, m_info_b)
+        assert len(trunc_tokens) >= 1
+
+        # We want to sometimes truncate from the front and sometimes from the
+        # back to add more randomness and avoid biases.
+        if rng.random() < 0.5:
+            del trunc_tokens[0]
+            del trunc_info[0]
+        else:
+            trunc_tokens.pop()
+            trunc_info.pop()
+
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", default=None, type=str, required=True)
+    parser.add_argument("--bert_model", default=None, type=str, required=True,
+                        help="Model whose tokenizer is used, the documents are masked at random.")
+    parser.add_argument("--task_name", default="", type=str, required=True)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--max_predictions_per_seq", default=20, type=int)
+    parser.add_argument("--masked_lm_prob", default=0.15, type=float)
+    parser.add_argument("--short_seq_prob", default=0.1, type=float)
+    parser.add_argument("--dupe_factor", default=1, type=int)
+    parser.add_argument("--do_lower_case", action='store_true')
+    parser.add_argument("--random_seed", default=12345, type=int)
+    parser.add_argument("--num_docs", default=10000, type=int, help="Number of documents to benchmark on.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    if args.task_name == "absa" or args.task_name == "absa_term":
+        raise ValueError("Aspect based tasks are not supported")
+    examples = processors[args.task_name]().get_pretrain_examples(args.input_dir, -1, 1)[:args.num_docs]
+    data = [example.text_a for example in examples]
+    generator = RandMask(args.masked_lm_prob, args.bert_model, args.do_lower_case, args.max_seq_length)
+    all_documents = generator(data, None, args.dupe_factor, random.Random(args.random_seed))
+    cls_id, sep_id = generator.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+    # both builders get the same seed, so they must give the same rows
+    begin = time.time()
+    _, instances = documents_to_instances(all_documents, generator.vocab, args.max_seq_length, args.short_seq_prob,
+                                          args.masked_lm_prob, args.max_predictions_per_seq, random.Random(args.random_seed))
+    list_features = instances_to_features(instances, generator.tokenizer, args.max_seq_length, args.max_predictions_per_seq)
+    list_elapsed = time.time() - begin
+    del instances
+
+    begin = time.time()
+    _, array_features = documents_to_features(all_documents, cls_id, sep_id, args.max_seq_length, args.short_seq_prob,
+                                              args.max_predictions_per_seq, random.Random(args.random_seed))
+    array_elapsed = time.time() - begin
+
+    num_instances = len(array_features["input_ids"])
+    print("{} documents, {} instances".format(len(all_documents), num_instances))
+    print("{:<8} {:>10} {:>14}".format("builder", "time(s)", "instances/s"))
+    for name, elapsed in [("list", list_elapsed), ("array", array_elapsed)]:
+        print("{:<8} {:>10.2f} {:>14.0f}".format(name, elapsed, num_instances / max(elapsed, 1e-9)))
+    for name in FEATURE_DTYPES:
+        if not np.array_equal(list_features[name], array_features[name]):
+            print("{} differs".format(name))
+
+
+if __name__ == "__main__":
+    main()
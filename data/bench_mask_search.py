@@ -0,0 +1,95 @@
+"""Compare wall-clock time, scorer rounds and output agreement of the rule mode mask searches."""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+sys.path.append("../")
+
+from data.data_utils import processors
+from data.sc_mask_gen import SC, ASC, mask_searches
+from data.mask_kernel import masked_flags
+
+logger = logging.getLogger(__name__)
+
+
+def document_flags(all_documents):
+    return [masked_flags(sentence) for document in all_documents for sentence in document]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", default=None, type=str, required=True)
+    parser.add_argument("--bert_model", default=None, type=str, required=True,
+                        help="The finetuned classifier used by rule mode.")
+    parser.add_argument("--task_name", default="", type=str, required=True)
+    parser.add_argument("--searches", default="greedy,speculative,group", type=str,
+                        help="Comma separated mask searches to run. The first one is the reference.")
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--sentence_batch_size", default=32, type=int)
+    parser.add_argument("--top_sen_rate", default=0.8, type=float)
+    parser.add_argument("--threshold", default=0.2, type=float)
+    parser.add_argument("--masked_lm_prob", default=0.15, type=float)
+    parser.add_argument("--do_lower_case", action='store_true')
+    parser.add_argument("--random_seed", default=12345, type=int)
+    parser.add_argument("--num_docs", default=1000, type=int, help="Number of documents to benchmark on.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    processor = processors[args.task_name]()
+    examples = processor.get_pretrain_examples(args.input_dir, -1, 1)[:args.num_docs]
+    if args.task_name == "absa" or args.task_name == "absa_term":
+        data, all_labels, generator_cls = examples, None, ASC
+    else:
+        data = [example.text_a for example in examples]
+        all_labels = [example.label for example in examples]
+        generator_cls = SC
+    label_list = processor.get_labels()
+
+    searches = args.searches.split(",")
+    for search in searches:
+        if search not in mask_searches:
+            raise ValueError("Unknown mask search: {}".format(search))
+
+    generator = generator_cls(args.masked_lm_prob, args.top_sen_rate, args.threshold, args.bert_model, args.do_lower_case,
+                              args.max_seq_length, label_list, args.sentence_batch_size)
+    score_ids = generator.score_ids
+    stats = {"calls": 0, "rows": 0}
+
+    def counting_score_ids(input_ids, lengths, segment_ids=None):
+        stats["calls"] += 1
+        stats["rows"] += len(lengths)
+        return score_ids(input_ids, lengths, segment_ids)
+
+    # calls made through `self.score_ids` now go through the counter
+    generator.score_ids = counting_score_ids
+
+    results = []
+    for search in searches:
+        generator.mask_search = search
+        stats["calls"], stats["rows"] = 0, 0
+        begin = time.time()
+        all_documents = generator(data, all_labels, 1, random.Random(args.random_seed))
+        elapsed = time.time() - begin
+        results.append((search, elapsed, stats["calls"], stats["rows"], document_flags(all_documents)))
+
+    ref_flags = results[0][-1]
+    print("{:<12} {:>10} {:>8} {:>12} {:>10} {:>10} {:>10}".format("search", "time(s)", "rounds", "scored rows", "masked", "differing", "agreement"))
+    for search, elapsed, calls, rows, flags in results:
+        same, total, masked = 0, 0, 0
+        for ref, cur in zip(ref_flags, flags):
+            same += sum(1 for x, y in zip(ref, cur) if x == y)
+            total += len(ref)
+            masked += sum(cur)
+        agreement = same / total if total > 0 else 1.0
+        print("{:<12} {:>10.2f} {:>8} {:>12} {:>10} {:>10} {:>10.4f}".format(search, elapsed, calls, rows, masked, total - same, agreement))
+
+
+if __name__ == "__main__":
+    main()
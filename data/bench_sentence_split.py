@@ -0,0 +1,85 @@
+"""Compare throughput and sentence boundary agreement of the sentence splitters on a corpus."""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import logging
+import sys
+import time
+
+sys.path.append("../")
+
+from data.data_utils import processors
+from data.sentence_split import splitters
+
+logger = logging.getLogger(__name__)
+
+
+def boundaries(doc_sentences):
+    """Sentence starts as counts of non-whitespace characters before them, whitespace never matters."""
+    starts = set()
+    pos = 0
+    for sentence in doc_sentences:
+        starts.add(pos)
+        pos += sum(1 for c in sentence if not c.isspace())
+    return starts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", default=None, type=str, required=True)
+    parser.add_argument("--task_name", default="", type=str, required=True)
+    parser.add_argument("--splitters", default="spacy,regex", type=str,
+                        help="Comma separated splitters to run. The first one is the reference.")
+    parser.add_argument("--num_docs", default=10000, type=int, help="Number of documents to benchmark on.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    if args.task_name == "absa" or args.task_name == "absa_term":
+        raise ValueError("Aspect based tasks are not segmented")
+    examples = processors[args.task_name]().get_pretrain_examples(args.input_dir, -1, 1)[:args.num_docs]
+    data = [example.text_a for example in examples]
+    num_chars = sum(len(doc) for doc in data)
+
+    names = args.splitters.split(",")
+    for name in names:
+        if name not in splitters:
+            raise ValueError("Unknown sentence splitter: {}".format(name))
+
+    results = []
+    for name in names:
+        # startup includes imports and pipeline construction on the first document
+        begin = time.time()
+        splitter = splitters[name]()
+        splitter.split(data[:1])
+        startup = time.time() - begin
+        begin = time.time()
+        all_sentences = splitter.split(data)
+        elapsed = time.time() - begin
+        results.append((name, startup, elapsed, all_sentences))
+
+    ref_sentences = results[0][-1]
+    print("{} documents, {:.1f} MB".format(len(data), num_chars / (1 << 20)))
+    print("{:<8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "splitter", "startup(s)", "time(s)", "docs/s", "sentences", "same docs", "precision", "recall", "f1"))
+    for name, startup, elapsed, all_sentences in results:
+        same_docs, num_sentences, true_pos, num_ref, num_cur = 0, 0, 0, 0, 0
+        for ref, cur in zip(ref_sentences, all_sentences):
+            ref_starts, cur_starts = boundaries(ref), boundaries(cur)
+            same_docs += 1 if ref_starts == cur_starts else 0
+            true_pos += len(ref_starts & cur_starts)
+            num_ref += len(ref_starts)
+            num_cur += len(cur_starts)
+            num_sentences += len(cur)
+        precision = true_pos / num_cur if num_cur > 0 else 1.0
+        recall = true_pos / num_ref if num_ref > 0 else 1.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        print("{:<8} {:>10.2f} {:>10.2f} {:>10.0f} {:>10} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}".format(
+            name, startup, elapsed, len(data) / max(elapsed, 1e-9), num_sentences, same_docs / max(len(data), 1),
+            precision, recall, f1))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import torch
 import argparse
+import bisect
 import logging
 import os
 import random
@@ -11,111 +12,51 @@ import numpy as np
 import collections
 import json
 import pickle
+import queue
+import resource
 import sys
-from tqdm import tqdm, trange
+import threading
+import time
 
 sys.path.append("../")
 
-import model.tokenization as tokenization
 from tokenization import BertTokenizer
 from data.data_utils import processors
-from data.sc_mask_gen import SC, ModelGen, ASC
+from data.sc_mask_gen import SC, ModelGen, ASC, SaliencyGen
 from data.rand_mask_gen import RandMask
+from data.score_cache import ScoreCache
+from data.loop_checkpoint import LoopCheckpoint
+from data.token_cache import load_tokenized_corpus
+from data.mask_kernel import labeled_sentence
+from data.hdf5_writer import FEATURE_DTYPES, HDF5_CHUNK_ROWS, HDF5_CODECS, hdf5_codec, HDF5Appender
+from data.labeled_store import write_labeled
+from data.shard_coordinator import claim_unit, mark_done
+
+logger = logging.getLogger(__name__)
 
-class TrainingInstance(object):
-    """A single training instance (sentence pair)."""
-    def __init__(self, tokens, segment_ids, masked_lm_positions, masked_lm_labels, is_random_next):
-        self.tokens = tokens
-        self.segment_ids = segment_ids
-        self.is_random_next = is_random_next
-        self.masked_lm_positions = masked_lm_positions
-        self.masked_lm_labels = masked_lm_labels
-
-    def __str__(self):
-        s = ""
-        s += "tokens: %s\n" % (" ".join(
-            [tokenization.printable_text(x) for x in self.tokens]))
-        s += "segment_ids: %s\n" % (" ".join([str(x) for x in self.segment_ids]))
-        s += "is_random_next: %s\n" % self.is_random_next
-        s += "masked_lm_positions: %s\n" % (" ".join(
-            [str(x) for x in self.masked_lm_positions]))
-        s += "masked_lm_labels: %s\n" % (" ".join(
-            [tokenization.printable_text(x) for x in self.masked_lm_labels]))
-        s += "\n"
-        return s
-
-    def __repr__(self):
-        return self.__str__()
-
-
-def write_instance_to_example_file(instances, tokenizer, max_seq_length,
-                                    max_predictions_per_seq, output_file):
-    """Create TF example files from `TrainingInstance`s."""
-    print(output_file)
-    total_written = 0
-    features = collections.OrderedDict()
-    
-    num_instances = len(instances)
-    features["input_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["input_mask"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["segment_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["masked_lm_positions"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
-    features["masked_lm_ids"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
-    features["next_sentence_labels"] = np.zeros(num_instances, dtype="int32")
-
-
-    for inst_index, instance in enumerate(tqdm(instances, desc="Writing Instances")):
-        input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-        input_mask = [1] * len(input_ids)
-        segment_ids = list(instance.segment_ids)
-        assert len(input_ids) <= max_seq_length
-
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        masked_lm_positions = list(instance.masked_lm_positions)
-        masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-        masked_lm_weights = [1.0] * len(masked_lm_ids)
-
-        while len(masked_lm_positions) < max_predictions_per_seq:
-            masked_lm_positions.append(0)
-            masked_lm_ids.append(0)
-            masked_lm_weights.append(0.0)
-
-        next_sentence_label = 1 if instance.is_random_next else 0
-
-        features["input_ids"][inst_index] = input_ids
-        features["input_mask"][inst_index] = input_mask
-        features["segment_ids"][inst_index] = segment_ids
-        features["masked_lm_positions"][inst_index] = masked_lm_positions
-        features["masked_lm_ids"][inst_index] = masked_lm_ids
-        features["next_sentence_labels"][inst_index] = next_sentence_label
-
-        total_written += 1
 
+def write_spans(spans, output_file, block_rows=65536, **kwargs):
+    """Writes an `InstanceSpans` block by block, only one block of feature arrays is in memory."""
     print("saving data")
-    f= h5py.File(output_file, 'w')
-    f.create_dataset("input_ids", data=features["input_ids"], dtype='i4', compression='gzip')
-    f.create_dataset("input_mask", data=features["input_mask"], dtype='i1', compression='gzip')
-    f.create_dataset("segment_ids", data=features["segment_ids"], dtype='i1', compression='gzip')
-    f.create_dataset("masked_lm_positions", data=features["masked_lm_positions"], dtype='i4', compression='gzip')
-    f.create_dataset("masked_lm_ids", data=features["masked_lm_ids"], dtype='i4', compression='gzip')
-    f.create_dataset("next_sentence_labels", data=features["next_sentence_labels"], dtype='i1', compression='gzip')
-    f.flush()
-    f.close()
-
-def write_labeled_data(labeled_data, output_file):
+    writer = HDF5Appender(output_file, spans.max_seq_length, spans.max_predictions_per_seq, **kwargs)
+    for begin in range(0, len(spans), block_rows):
+        writer.append(spans.features(begin, begin + block_rows))
+    writer.close()
+
+
+def write_labeled_data(labeled_data, output_file, vocab=None):
+    """Pickles `labeled_data`, or writes it as columnar labeled data(.labeled) with the ids of `vocab`."""
+    if output_file.endswith(".labeled"):
+        write_labeled(labeled_data, output_file, vocab)
+        return
     with open(output_file, "wb") as f:
         pickle.dump(labeled_data, f)
 
-def create_training_instances(data, all_labels, task_name, generator, max_seq_length, dupe_factor, short_seq_prob, masked_lm_prob, max_predictions_per_seq, rng, with_rand=False):
-    """Create `TrainingInstance`s from raw text."""
+def create_training_instances(data, all_labels, task_name, generator, max_seq_length, dupe_factor, short_seq_prob, masked_lm_prob, max_predictions_per_seq, rng, with_rand=False,
+                              with_labeled=True):
+    """Create the training instances of raw text, as the `InstanceSpans` of `documents_to_spans`.
+
+    The labeled data is None without `with_labeled`, it is only written in rule and saliency mode."""
 
     # Remove empty documents
     if with_rand:
@@ -125,129 +66,348 @@ def create_training_instances(data, all_labels, task_name, generator, max_seq_le
         all_documents = generator(data, all_labels, dupe_factor, rng)        
         print(len(all_documents))
 
-    instances = []
-    all_documents = [x for x in all_documents if x]
-    rng.shuffle(all_documents)
-    for document_index in range(len(all_documents)):
-        instances.extend(create_instances_from_document(all_documents, document_index, max_seq_length, short_seq_prob,
-            masked_lm_prob, max_predictions_per_seq, rng))
+    cls_id, sep_id = generator.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    all_documents, spans = documents_to_spans(all_documents, cls_id, sep_id, max_seq_length, short_seq_prob,
+                                              max_predictions_per_seq, rng)
 
-    rng.shuffle(instances)
-
-    labeled_data = []
-    for document in all_documents:
-        for sentence in document:
-            labeled_data.append((sentence.tokens, [1 if x else 0 for x in sentence.info]))
+    labeled_data = None
+    if with_labeled:
+        id_tokens = np.array(generator.vocab, dtype=object)
+        labeled_data = [labeled_sentence(sentence, id_tokens) for document in all_documents for sentence in document]
 
     if with_rand:
-        rand_instances = []
-        rand_all_documents = [x for x in rand_all_documents if x]
-        rng.shuffle(rand_all_documents)
-        for document_index in range(len(rand_all_documents)):
-            rand_instances.extend(create_instances_from_document(rand_all_documents, document_index, max_seq_length, short_seq_prob,
-                masked_lm_prob, max_predictions_per_seq, rng))
-    
-        rng.shuffle(rand_instances)
-    
-        return instances, rand_instances, labeled_data
+        _, rand_spans = documents_to_spans(rand_all_documents, cls_id, sep_id, max_seq_length, short_seq_prob,
+                                           max_predictions_per_seq, rng)
+        return spans, rand_spans, labeled_data
     else:
-        return instances, labeled_data        
+        return spans, labeled_data        
+
 
+def _ranges(starts, lengths):
+    """The concatenated `np.arange(start, start + length)` of every (start, length)."""
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(offsets[-1] + lengths[-1] if len(lengths) > 0 else 0) - np.repeat(offsets - starts, lengths)
 
-def create_instances_from_document(
-    all_documents, document_index, max_seq_length, short_seq_prob,
-    masked_lm_prob, max_predictions_per_seq, rng):
-    """Creates `TrainingInstance`s for a single document."""
 
-    # document: MaskedTokenInstance: (tokens, info)
-    document = all_documents[document_index]
+def documents_to_spans(all_documents, cls_id, sep_id, max_seq_length, short_seq_prob, max_predictions_per_seq, rng):
+    """`documents_to_instances` of data/bench_instances.py on the id arrays of the `MaskedTokenInstance`s.
+
+    The documents are concatenated into one id array, an instance is a [begin, end) range of it:
+    truncation moves the ends and the masked positions are a range of the flat position array.
+    It draws from `rng` exactly like `documents_to_instances`, so both give the same rows for a seed.
+    Returns the shuffled non-empty documents and the `InstanceSpans`.
+    """
+    all_documents = [x for x in all_documents if x]
+    rng.shuffle(all_documents)
+    segments = [segment for document in all_documents for segment in document]
+    seg_lens = np.array([len(segment.ids) for segment in segments], dtype=np.int64)
+    seg_offsets = np.cumsum(seg_lens) - seg_lens
+    num_masked = np.array([len(segment.positions) for segment in segments], dtype=np.int64)
+    if len(segments) > 0:
+        ids = np.concatenate([segment.ids for segment in segments]).astype(np.int32)
+        positions = np.concatenate([segment.positions for segment in segments]).astype(np.int64) + \
+            np.repeat(seg_offsets, num_masked)
+        mask_ids = np.concatenate([segment.mask_ids for segment in segments]).astype(np.int32)
+    else:
+        ids, positions, mask_ids = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64),
+                                    np.zeros(0, dtype=np.int32))
+    positions_list = positions.tolist()
+    seg_lens = seg_lens.tolist()
 
     # Account for [CLS], [SEP]
     max_num_tokens = max_seq_length - 2
+    # [begin, end) of the tokens and of the masked positions of every instance
+    spans = []
+    # the sorted masked positions of instances with more than `max_predictions_per_seq` of them
+    capped = {}
+    seg_index = 0
+    begin = 0
+    for document in all_documents:
+        target_seq_length = max_num_tokens
+        if rng.random() < short_seq_prob:
+            target_seq_length = rng.randint(2, max_num_tokens)
+        current_length = 0
+        for i in range(len(document)):
+            current_length += seg_lens[seg_index]
+            seg_index += 1
+            if i == len(document) - 1 or current_length >= target_seq_length:
+                end = begin + current_length
+                inst_begin, inst_end = begin, end
+                # truncate from the front or the back, like `truncate_seq_pair` of data/bench_instances.py
+                for _ in range(current_length - max_num_tokens):
+                    if rng.random() < 0.5:
+                        inst_begin += 1
+                    else:
+                        inst_end -= 1
+                assert inst_end - inst_begin >= 1
+                lo = bisect.bisect_left(positions_list, inst_begin)
+                hi = bisect.bisect_left(positions_list, inst_end)
+                if hi - lo > max_predictions_per_seq:
+                    selected = list(range(lo, hi))
+                    rng.shuffle(selected)
+                    capped[len(spans)] = sorted(selected[0:max_predictions_per_seq])
+                spans.append((inst_begin, inst_end, lo, hi))
+                begin = end
+                current_length = 0
+
+    order = list(range(len(spans)))
+    rng.shuffle(order)
+    return all_documents, InstanceSpans(ids, positions, mask_ids, spans, capped, order, cls_id, sep_id, max_seq_length,
+                                        max_predictions_per_seq)
+
+
+def documents_to_features(all_documents, cls_id, sep_id, max_seq_length, short_seq_prob, max_predictions_per_seq, rng):
+    """`documents_to_instances` + `instances_to_features` on id arrays, all rows at once."""
+    all_documents, spans = documents_to_spans(all_documents, cls_id, sep_id, max_seq_length, short_seq_prob,
+                                              max_predictions_per_seq, rng)
+    return all_documents, spans.features()
+
+
+class InstanceSpans(object):
+    """The shuffled training instances of `documents_to_spans` as ranges of the flat id array.
+
+    `features(begin, end)` fills the feature arrays of `instances_to_features` for rows
+    [begin, end) only, so a writer can produce a shard block by block with a few scatters each.
+    """
+    def __init__(self, ids, positions, mask_ids, spans, capped, order, cls_id, sep_id, max_seq_length,
+                 max_predictions_per_seq):
+        self.ids = ids
+        self.positions = positions
+        self.mask_ids = mask_ids
+        # [begin, end) of the tokens and of the masked positions of every instance
+        self.spans = np.array(spans, dtype=np.int64).reshape(-1, 4)
+        self.capped = capped
+        self.is_capped = np.zeros(len(self.spans), dtype=bool)
+        self.is_capped[list(capped)] = True
+        # instance order[r] goes to row r
+        self.order = np.array(order, dtype=np.int64)
+        self.cls_id = cls_id
+        self.sep_id = sep_id
+        self.max_seq_length = max_seq_length
+        self.max_predictions_per_seq = max_predictions_per_seq
+
+    def __len__(self):
+        return len(self.order)
+
+    def features(self, begin=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        num_rows = max(end - begin, 0)
+        features = collections.OrderedDict()
+        features["input_ids"] = np.zeros([num_rows, self.max_seq_length], dtype="int32")
+        features["input_mask"] = np.zeros([num_rows, self.max_seq_length], dtype="int32")
+        features["segment_ids"] = np.zeros([num_rows, self.max_seq_length], dtype="int32")
+        features["masked_lm_positions"] = np.zeros([num_rows, self.max_predictions_per_seq], dtype="int32")
+        features["masked_lm_ids"] = np.zeros([num_rows, self.max_predictions_per_seq], dtype="int32")
+        features["next_sentence_labels"] = np.zeros(num_rows, dtype="int32")
+        if num_rows == 0:
+            return features
+
+        inst = self.order[begin:end]
+        rows = np.arange(num_rows)
+        spans = self.spans[inst]
+        inst_begin, inst_end, lo, hi = spans[:, 0], spans[:, 1], spans[:, 2], spans[:, 3]
+        lengths = inst_end - inst_begin
+        token_rows = np.repeat(rows, lengths)
+        token_cols = _ranges(np.ones_like(lengths), lengths)
+        features["input_ids"][token_rows, token_cols] = self.ids[_ranges(inst_begin, lengths)]
+        features["input_ids"][rows, 0] = self.cls_id
+        features["input_ids"][rows, lengths + 1] = self.sep_id
+        features["input_mask"][:] = np.arange(self.max_seq_length)[None, :] < (lengths + 2)[:, None]
+
+        # masked positions: whole ranges, or the selection of the capped instances
+        num_selected = hi - lo
+        capped_rows = np.nonzero(self.is_capped[inst])[0]
+        num_selected[capped_rows] = 0
+        selected = _ranges(lo, num_selected)
+        selected_rows = np.repeat(rows, num_selected)
+        if len(capped_rows) > 0:
+            selected = np.concatenate([selected] + [np.array(self.capped[k], dtype=np.int64) for k in inst[capped_rows].tolist()])
+            selected_rows = np.concatenate([selected_rows, np.repeat(capped_rows, self.max_predictions_per_seq)])
+            num_selected[capped_rows] = self.max_predictions_per_seq
+            by_row = np.argsort(selected_rows, kind="stable")
+            selected, selected_rows = selected[by_row], selected_rows[by_row]
+        slots = _ranges(np.zeros_like(num_selected), num_selected)
+        mask_cols = self.positions[selected] - inst_begin[selected_rows] + 1
+        features["masked_lm_positions"][selected_rows, slots] = mask_cols
+        features["masked_lm_ids"][selected_rows, slots] = self.ids[self.positions[selected]]
+        features["input_ids"][selected_rows, mask_cols] = self.mask_ids[selected]
+        return features
+
+
+def create_labeled_data(all_documents, rng, vocab):
+    """Only the labeled data(.pkl) of `create_training_instances`, without building instances.
+    `vocab` is the generator's list of tokens by id."""
+    all_documents = [x for x in all_documents if x]
+    rng.shuffle(all_documents)
+    id_tokens = np.array(vocab, dtype=object)
+    return [labeled_sentence(sentence, id_tokens) for document in all_documents for sentence in document]
+
+
+def write_sweep(data, all_labels, generator, thresholds, top_sen_rates, dupe_factor, rng, output_dir, part,
+                labeled_ext=".pkl", vocab=None):
+    """Writes `{output_dir}/th{threshold}_top{top_sen_rate}/{part}.pkl` (or .labeled) for every setting from one
+    scoring run, plus `{output_dir}/sweep_summary_{part}.json` with the masked token rate of every setting."""
+    all_settings = generator.forward_sweep(data, all_labels, dupe_factor, rng, thresholds, top_sen_rates)
+    summary = []
+    for (threshold, top_sen_rate), all_documents in all_settings.items():
+        labeled_data = create_labeled_data(all_documents, rng, generator.vocab)
+        setting_dir = os.path.join(output_dir, "th{}_top{}".format(threshold, top_sen_rate))
+        if not os.path.exists(setting_dir):
+            os.makedirs(setting_dir)
+        write_labeled_data(labeled_data, os.path.join(setting_dir, "{}{}".format(part, labeled_ext)), vocab)
+
+        num_tokens = sum(len(labels) for _, labels in labeled_data)
+        num_masked = sum(sum(labels) for _, labels in labeled_data)
+        masked_rate = num_masked / num_tokens if num_tokens > 0 else 0.0
+        summary.append({"threshold": threshold, "top_sen_rate": top_sen_rate, "sentences": len(labeled_data),
+                        "tokens": num_tokens, "masked_tokens": num_masked, "masked_rate": masked_rate})
+        print("threshold {} top_sen_rate {}: {}/{} tokens masked ({:.4f})".format(
+            threshold, top_sen_rate, num_masked, num_tokens, masked_rate))
+
+    with open(os.path.join(output_dir, "sweep_summary_{}.json".format(part)), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+# guess of the in-memory cost of one token on its way from text to features (token strings, mask infos,
+# instances), only used for the first chunk
+INITIAL_BYTES_PER_TOKEN = 512
+
+
+def rss_bytes():
+    """Resident set size of this process, its peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create_data_streaming(data, generator, tokenizer, max_seq_length, dupe_factor, short_seq_prob, masked_lm_prob,
+                          max_predictions_per_seq, rng, output_file, rand_output_file=None, max_memory_mb=4096,
+                          max_chunk_docs=10000, queue_size=2, hdf5_options=None):
+    """Model mode in document chunks: sentence split -> `ModelGen` scoring -> instances -> hdf5 append.
+
+    The three stages run in their own threads connected by bounded queues, so the next chunk is
+    segmented and the previous one written while the model scores the current one. Chunks are
+    sized from the observed tokens per document so that all chunks in flight fit `max_memory_mb`.
+    The bytes per token are calibrated on the RSS growth of the first chunk and raised whenever the
+    growth passes the budget, so the budget is approximate. Documents and instances are shuffled
+    within their chunk only.
+    """
+    # one chunk in every queue slot and in every stage
+    chunks_in_flight = 2 * queue_size + 3
+    budget = max_memory_mb * (1 << 20)
+    base_rss = rss_bytes()
+    split_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    # tokens of the chunks split and not yet written
+    lock = threading.Lock()
+    in_flight = {"tokens": 0, "bytes_per_token": INITIAL_BYTES_PER_TOKEN}
+
+    def split_stage():
+        try:
+            begin, chunk_docs = 0, min(max_chunk_docs, 256)
+            num_docs, num_tokens = 0, 0
+            # stops at the first error of any stage, the rest of the part would be thrown away
+            while begin < len(data) and len(errors) == 0:
+                docs = data[begin:begin + chunk_docs]
+                ids, offsets, sen_doc_ids = generator.split_sentences(docs)
+                chunk_tokens = int(offsets[-1])
+                with lock:
+                    in_flight["tokens"] += chunk_tokens
+                split_queue.put((len(docs), ids, offsets, sen_doc_ids, chunk_tokens))
+                begin += len(docs)
+                num_docs += len(docs)
+                num_tokens += chunk_tokens
+                tokens_per_doc = max(num_tokens / num_docs, 1.0)
+                chunk_docs = int(max(1, min(max_chunk_docs, budget / (chunks_in_flight * in_flight["bytes_per_token"]
+                                                                      * tokens_per_doc))))
+        except Exception as e:
+            errors.append(e)
+        split_queue.put(None)
+
+    def write_stage():
+        writers = []
+        try:
+            for filename in [output_file, rand_output_file]:
+                if filename is not None:
+                    writers.append(HDF5Appender(filename, max_seq_length, max_predictions_per_seq, **(hdf5_options or {})))
+        except Exception as e:
+            errors.append(e)
+        # keep draining after an error, so the scoring stage never blocks
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            chunk_spans, chunk_tokens = item
+            if len(errors) == 0:
+                try:
+                    for writer, spans in zip(writers, chunk_spans):
+                        for begin in range(0, len(spans), writer.chunk_rows):
+                            writer.append(spans.features(begin, begin + writer.chunk_rows))
+                except Exception as e:
+                    errors.append(e)
+            with lock:
+                in_flight["tokens"] -= chunk_tokens
+        for writer in writers:
+            writer.close()
+        print("Num instances: {}.".format(", ".join(str(writer.num_rows) for writer in writers)))
+
+    splitter = threading.Thread(target=split_stage)
+    writer = threading.Thread(target=write_stage)
+    splitter.start()
+    writer.start()
+    try:
+        num_chunks = 0
+        max_used = 0
+        while len(errors) == 0:
+            item = split_queue.get()
+            if item is None:
+                break
+            doc_num, ids, offsets, sen_doc_ids, chunk_tokens = item
+            all_documents = generator.mask_documents(ids, offsets, sen_doc_ids, doc_num, dupe_factor, rng)
+            if rand_output_file is None:
+                all_documents = [all_documents]
+            chunk_spans = []
+            cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+            for documents in all_documents:
+                _, spans = documents_to_spans(documents, cls_id, sep_id, max_seq_length, short_seq_prob,
+                                              max_predictions_per_seq, rng)
+                chunk_spans.append(spans)
+            # the chunks in flight are all built here, calibrate on the first and shrink the next ones past the budget
+            used = rss_bytes() - base_rss
+            with lock:
+                bytes_per_token = max(used / max(in_flight["tokens"], 1), 1.0)
+                if num_chunks == 0:
+                    in_flight["bytes_per_token"] = bytes_per_token
+                elif used > budget:
+                    in_flight["bytes_per_token"] = max(in_flight["bytes_per_token"], bytes_per_token)
+            if used > max(budget, max_used):
+                logger.warning("Chunk {}: RSS grew by {:.0f} MB, more than --max_memory_mb, shrinking the next "
+                               "chunks".format(num_chunks + 1, used / (1 << 20)))
+            max_used = max(max_used, used)
+            del all_documents, sentences, sen_doc_ids
+            write_queue.put((chunk_spans, chunk_tokens))
+            num_chunks += 1
+            logger.info("Chunk {}: {} documents, {:.0f} bytes per token, peak RSS {:.0f} MB".format(
+                num_chunks, doc_num, in_flight["bytes_per_token"],
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        # let the splitter finish if it is blocked on a full queue
+        while splitter.is_alive():
+            try:
+                split_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        write_queue.put(None)
+        writer.join()
+    if len(errors) > 0:
+        raise errors[0]
 
-    target_seq_length = max_num_tokens
-    if rng.random() < short_seq_prob:
-        target_seq_length = rng.randint(2, max_num_tokens)
-
-    instances = []
-    current_chunk = []
-    current_length = 0
-    i = 0
-    while i < len(document):
-        segment = document[i] # segment: MaskedTokenInstance (tokens, info)
-        current_chunk.append(segment)
-        current_length += len(segment.tokens)
-        if i == len(document) - 1 or current_length >= target_seq_length:
-            if current_chunk:
-                tokens_a = []
-                m_info_a = []
-                for j in range(len(current_chunk)):
-                    tokens_a.extend(current_chunk[j].tokens)
-                    m_info_a.extend(current_chunk[j].info)
-                truncate_seq_pair(tokens_a, m_info_a, [], [], max_num_tokens, rng)
-
-                assert len(tokens_a) >= 1
-
-                tokens = []
-                m_info = []
-                segment_ids = []
-                tokens.append("[CLS]")
-                m_info.append({})
-                segment_ids.append(0)
-                for token, info in zip(tokens_a, m_info_a):
-                    tokens.append(token)
-                    m_info.append(info)
-                    segment_ids.append(0)
-
-                tokens.append("[SEP]")
-                m_info.append({})
-                segment_ids.append(0)
-
-                masked_lm_positions = [index for index in range(len(m_info)) if m_info[index]]
-                if len(masked_lm_positions) > max_predictions_per_seq:
-                    rng.shuffle(masked_lm_positions)
-                    masked_lm_positions = masked_lm_positions[0:max_predictions_per_seq]
-                    masked_lm_positions.sort()
-                masked_lm_labels = [m_info[pos]["label"] for pos in masked_lm_positions]
-                
-                for pos in masked_lm_positions:
-                    tokens[pos] = m_info[pos]["mask"]
-
-                is_random_next = False
-                instance = TrainingInstance(
-                    tokens=tokens,
-                    segment_ids=segment_ids,
-                    is_random_next=is_random_next,
-                    masked_lm_positions=masked_lm_positions,
-                    masked_lm_labels=masked_lm_labels)
-                instances.append(instance)
-            current_chunk = []
-            current_length = 0  
-        i += 1
-    return instances
 
 MaskedLmInstance = collections.namedtuple("MaskedLmInstance", ["index", "label"])
-MaskedTokenInstance = collections.namedtuple("MaskedTokenInstance", ["tokens", "info"])
-
-def truncate_seq_pair(tokens_a, m_info_a, tokens_b, m_info_b, max_num_tokens, rng):
-    """Truncates a pair of sequences to a maximum sequence length."""
-    while True:
-        total_length = len(tokens_a) + len(tokens_b)
-        if total_length <= max_num_tokens:
-            break
-
-        (trunc_tokens, trunc_info) = (tokens_a, m_info_a) if len(tokens_a) > len(tokens_b) else (tokens_b, m_info_b)
-        assert len(trunc_tokens) >= 1
-
-        # We want to sometimes truncate from the front and sometimes from the
-        # back to add more randomness and avoid biases.
-        if rng.random() < 0.5:
-            del trunc_tokens[0]
-            del trunc_info[0]
-        else:
-            trunc_tokens.pop()
-            trunc_info.pop()
-
 
 def main():
     print(torch.cuda.is_available())
@@ -269,6 +429,7 @@ def main():
     # bool
     parser.add_argument("--mode", 
                         type=str,
+                        help="rand, rule, saliency (rule mode labels from one forward + backward pass) or model"
                         )
 
     # str
@@ -309,7 +470,31 @@ def main():
                         type=float)
     parser.add_argument("--threshold",
                         default=0.2,
-                        type=float)
+                        type=float,
+                        help="Rule mode: a token is masked while the classifier's probability of the label drops by "
+                             "less than this.")
+    parser.add_argument("--saliency_threshold",
+                        default=0.0,
+                        type=float,
+                        help="Saliency mode: minimum share of its sentence's total saliency a token needs to be "
+                             "masked. The default 0.0 masks the top --masked_lm_prob tokens of every selected sentence.")
+    parser.add_argument("--mask_search",
+                        default="greedy",
+                        type=str,
+                        choices=["greedy", "speculative", "group"],
+                        help="How rule mode searches mask positions. speculative scores all prefixes in one pass "
+                             "and replays the greedy decisions, which needs far fewer rounds. group tests spans of "
+                             "tokens together and only splits spans that cross the threshold, which needs far fewer "
+                             "scorer calls but may differ from greedy.")
+    parser.add_argument("--thresholds",
+                        default=None,
+                        type=str,
+                        help="Comma separated thresholds for a rule mode sweep. All settings share one scoring "
+                             "run and each one is written to its own th{threshold}_top{top_sen_rate} directory.")
+    parser.add_argument("--top_sen_rates",
+                        default=None,
+                        type=str,
+                        help="Comma separated top_sen_rates for a rule mode sweep, see --thresholds.")
                              
 
     # floats
@@ -343,6 +528,84 @@ def main():
     parser.add_argument('--split_part',
                         type=int
                         )
+    parser.add_argument("--score_cache_dir",
+                        default=None,
+                        type=str,
+                        help="Directory of a persistent cache of the rule/model mode scores, keyed on the model "
+                             "checkpoint and the input ids. Reruns of a part only score what is not cached yet.")
+    parser.add_argument("--score_cache_size_mb",
+                        default=4096,
+                        type=int,
+                        help="Size bound of the score cache, least recently used scores are evicted first.")
+    parser.add_argument("--token_cache_dir",
+                        default=None,
+                        type=str,
+                        help="Directory of tokenized corpora, keyed on the corpus, the vocab and --do_lower_case. "
+                             "The documents are segmented and tokenized once and every mode reads the cached ids.")
+    parser.add_argument("--segment_workers",
+                        default=1,
+                        type=int,
+                        help="Processes that segment and tokenize the documents of the rule, saliency and model modes.")
+    parser.add_argument("--sentence_splitter",
+                        default="spacy",
+                        type=str,
+                        choices=["spacy", "regex"],
+                        help="Sentence splitter of the rule, saliency and model modes. regex needs no spaCy and is "
+                             "faster, see data/bench_sentence_split.py for how often it agrees with spacy.")
+    parser.add_argument("--stream",
+                        action='store_true',
+                        help="Model mode only: split, score, build and append instances in document chunks with "
+                             "overlapping stages, so memory does not grow with the part size. Documents and "
+                             "instances are only shuffled within a chunk. The document texts are read per chunk "
+                             "too, except with --token_cache_dir or for the absa tasks.")
+    parser.add_argument("--max_memory_mb",
+                        default=4096,
+                        type=int,
+                        help="Memory budget of the chunks in flight with --stream. Approximate: chunks are sized from "
+                             "the RSS growth of the first chunk and shrunk when the growth passes the budget, a "
+                             "warning is logged when it does.")
+    parser.add_argument("--hdf5_compression",
+                        default="gzip",
+                        type=str,
+                        choices=HDF5_CODECS,
+                        help="Codec of the hdf5 datasets. lzf writes and reads much faster than gzip at a larger "
+                             "size, see data/bench_hdf5.py.")
+    parser.add_argument("--hdf5_compression_level",
+                        default=None,
+                        type=int,
+                        help="gzip level 0-9 (default 4).")
+    parser.add_argument("--hdf5_chunk_rows",
+                        default=HDF5_CHUNK_ROWS,
+                        type=int,
+                        help="Rows per hdf5 chunk, best a small multiple of the pretraining batch size: reading a "
+                             "batch decompresses every chunk it touches.")
+    parser.add_argument("--labeled_format",
+                        default="pkl",
+                        type=str,
+                        choices=["pkl", "columnar"],
+                        help="Rule and saliency mode: pickled (tokens, labels) pairs ({part}.pkl) or int32 ids and "
+                             "bit packed labels ({part}.labeled) that mask_model_pretrain.py memory maps, see "
+                             "data/labeled_store.py.")
+    parser.add_argument("--stream_chunk_docs",
+                        default=10000,
+                        type=int,
+                        help="Upper bound of documents per chunk with --stream.")
+    parser.add_argument("--work_dir",
+                        default=None,
+                        type=str,
+                        help="Run as a worker of data/shard_coordinator.py on the work units in this directory.")
+    parser.add_argument("--worker_id",
+                        default=0,
+                        type=int)
+    parser.add_argument("--checkpoint_rounds",
+                        default=0,
+                        type=int,
+                        help="Checkpoint the rule mode search every this many rounds (0: off). A rerun with the "
+                             "same arguments resumes from {output_dir}/checkpoint/{part}.")
+    parser.add_argument("--checkpoint_minutes",
+                        default=0,
+                        type=float,
+                        help="Checkpoint the rule mode search every this many minutes (0: off).")
 
     args = parser.parse_args()
     print(args)
@@ -357,66 +620,195 @@ def main():
 
     print("creating instance from {}".format(args.input_dir))
     processor = processors[args.task_name]()
-    eval_examples = processor.get_pretrain_examples(args.input_dir, args.part, args.max_proc)
-    if args.task_name == "absa" or args.task_name == "absa_term":
-        data = eval_examples
-        all_labels = None
-    else:
-        data = [example.text_a for example in eval_examples]
-        all_labels = [example.label for example in eval_examples]
-    
-    del eval_examples
-    
+    if (args.work_dir is None and args.stream and args.mode == "model" and args.token_cache_dir is None
+            and args.task_name not in ["absa", "absa_term"]):
+        # read chunk by chunk by `create_data_streaming`, model mode needs no labels
+        data, all_labels = PartDocuments(processor, args.task_name, args.input_dir, args.part, args.max_proc), None
+    elif args.work_dir is None:
+        data, all_labels = load_documents(processor, args.task_name, args.input_dir, args.part, args.max_proc)
+
     label_list = processor.get_labels()
     logger.info("Bert Model: {}".format(args.bert_model))
 
+    score_cache = None
+    if args.score_cache_dir is not None and args.mode in ["rule", "model"]:
+        score_cache = ScoreCache(args.score_cache_dir, args.bert_model, args.score_cache_size_mb)
+
+    checkpoint = None
+    if args.mode == "rule" and args.work_dir is None and (args.checkpoint_rounds > 0 or args.checkpoint_minutes > 0):
+        config = {k: v for k, v in vars(args).items()
+                  if k not in ["checkpoint_rounds", "checkpoint_minutes", "token_cache_dir", "segment_workers"]}
+        checkpoint = LoopCheckpoint(os.path.join(args.output_dir, "checkpoint", str(max(args.part, 0))), config,
+                                    args.checkpoint_rounds, args.checkpoint_minutes)
+
     if args.mode == "rand":
         print("Mode: rand")
         generator = RandMask(args.masked_lm_prob, args.bert_model, args.do_lower_case, args.max_seq_length)
     elif args.mode == "rule":
         print("Mode: rule")
         if args.task_name == "absa" or args.task_name == "absa_term":
-            generator = ASC(args.masked_lm_prob, args.top_sen_rate, args.threshold, args.bert_model, args.do_lower_case, args.max_seq_length, label_list, args.sentence_batch_size)
+            generator = ASC(args.masked_lm_prob, args.top_sen_rate, args.threshold, args.bert_model, args.do_lower_case, args.max_seq_length, label_list, args.sentence_batch_size, mask_search=args.mask_search, score_cache=score_cache, checkpoint=checkpoint)
         else:
-            generator = SC(args.masked_lm_prob, args.top_sen_rate, args.threshold, args.bert_model, args.do_lower_case, args.max_seq_length, label_list, args.sentence_batch_size)
+            generator = SC(args.masked_lm_prob, args.top_sen_rate, args.threshold, args.bert_model, args.do_lower_case, args.max_seq_length, label_list, args.sentence_batch_size, mask_search=args.mask_search, score_cache=score_cache, checkpoint=checkpoint, segment_workers=args.segment_workers, sentence_splitter=args.sentence_splitter)
+    elif args.mode == "saliency":
+        print("Mode: saliency")
+        if args.task_name == "absa" or args.task_name == "absa_term":
+            raise ValueError("Saliency mode does not support aspect based tasks, use --mode rule")
+        generator = SaliencyGen(args.masked_lm_prob, args.top_sen_rate, args.saliency_threshold, args.bert_model, args.do_lower_case, args.max_seq_length, label_list, args.sentence_batch_size, segment_workers=args.segment_workers, sentence_splitter=args.sentence_splitter)
     else:
         print("Mode: model")
-        generator = ModelGen(args.masked_lm_prob, args.bert_model, args.do_lower_case, args.max_seq_length, args.sentence_batch_size, with_rand=args.with_rand)
+        generator = ModelGen(args.masked_lm_prob, args.bert_model, args.do_lower_case, args.max_seq_length, args.sentence_batch_size, with_rand=args.with_rand, score_cache=score_cache, segment_workers=args.segment_workers, sentence_splitter=args.sentence_splitter)
+
+    try:
+        if args.work_dir is not None:
+            # workers of data/shard_coordinator.py read the documents of every unit they claim
+            run_work_units(args, processor, generator, tokenizer)
+        else:
+            data = tokenize_documents(args, data, all_labels, generator, tokenizer)
+            create_outputs(args, data, all_labels, generator, tokenizer, rng, args.output_dir, args.part, checkpoint)
+    finally:
+        # stops the segmentation workers of --segment_workers
+        if hasattr(generator, "sentence_tokenizer"):
+            generator.sentence_tokenizer.close()
+
+
+def load_documents(processor, task_name, input_dir, part, max_proc, records=None):
+    """Documents of `part` of the pretraining corpus, or of its `records` range, and their labels (None for absa)."""
+    examples = processor.get_pretrain_examples(input_dir, part, max_proc, records=records)
+    if task_name == "absa" or task_name == "absa_term":
+        return examples, None
+    return [example.text_a for example in examples], [example.label for example in examples]
+
+
+class PartDocuments(object):
+    """The documents of `part` of the pretraining corpus, read from disk per slice through the record offsets.
+
+    Only `len` and slicing, for `create_data_streaming`, so the texts of at most the chunks in flight are in memory.
+    """
+    def __init__(self, processor, task_name, input_dir, part, max_proc):
+        self.processor = processor
+        self.task_name = task_name
+        self.input_dir = input_dir
+        self.begin, self.end = processor.get_pretrain_range(input_dir, part, max_proc)
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        data, _ = load_documents(self.processor, self.task_name, self.input_dir, -1, 1,
+                                 records=(self.begin + start, self.begin + max(start, stop)))
+        return data
+
+
+def tokenize_documents(args, data, all_labels, generator, tokenizer):
+    """`data` read from the --token_cache_dir corpus, tokenized on the first run."""
+    if args.token_cache_dir is None or all_labels is None:
+        return data
+    # rand mode masks whole documents, the other modes work on sentences
+    if args.mode == "rand":
+        return load_tokenized_corpus(args.token_cache_dir, data, tokenizer, args.do_lower_case)
+    return load_tokenized_corpus(args.token_cache_dir, data, tokenizer, args.do_lower_case,
+                                 tokenize_fn=generator.sentence_tokenizer.tokenize_documents,
+                                 segment_name=generator.sentence_tokenizer.splitter.name)
+
+
+def hdf5_options(args):
+    return {"chunk_rows": args.hdf5_chunk_rows, "compression": args.hdf5_compression,
+            "compression_level": args.hdf5_compression_level}
+
+
+def create_outputs(args, data, all_labels, generator, tokenizer, rng, output_dir, part, checkpoint=None):
+    # model mode without --with_rand writes its hdf5 data to {part}.pkl
+    labeled_ext = ".labeled" if args.labeled_format == "columnar" and args.mode != "model" else ".pkl"
+    if part >= 0:
+        output_file = os.path.join(output_dir, "model", "{}.hdf5".format(part))        
+        if args.with_rand:
+            rand_output_file = os.path.join(output_dir, "rand", "{}.hdf5".format(part))
+        labeled_output_file = os.path.join(output_dir, "{}{}".format(part, labeled_ext))
+    else:
+        output_file = os.path.join(output_dir, "model", "0.hdf5") 
+        if args.with_rand:
+            rand_output_file = os.path.join(output_dir, "rand", "0.hdf5")
+        labeled_output_file = os.path.join(output_dir, "0{}".format(labeled_ext))
+    
+    if args.stream:
+        if args.mode != "model":
+            raise ValueError("--stream is only supported in model mode")
+        print("Writing masked data(.hdf5) for model mode in chunks")
+        # same files as below
+        create_data_streaming(data, generator, tokenizer, args.max_seq_length, args.dupe_factor, args.short_seq_prob,
+                              args.masked_lm_prob, args.max_predictions_per_seq, rng,
+                              output_file if args.with_rand else labeled_output_file,
+                              rand_output_file if args.with_rand else None,
+                              max_memory_mb=args.max_memory_mb, max_chunk_docs=args.stream_chunk_docs,
+                              hdf5_options=hdf5_options(args))
+        return
+
+    if args.mode == "rule" and (args.thresholds is not None or args.top_sen_rates is not None):
+        thresholds = [float(x) for x in args.thresholds.split(",")] if args.thresholds is not None else [args.threshold]
+        top_sen_rates = [float(x) for x in args.top_sen_rates.split(",")] if args.top_sen_rates is not None else [args.top_sen_rate]
+        print("Writing labeled data(.pkl) for {} settings".format(len(thresholds) * len(top_sen_rates)))
+        write_sweep(data, all_labels, generator, thresholds, top_sen_rates, args.dupe_factor, rng, output_dir, max(part, 0),
+                    labeled_ext, tokenizer.vocab)
+        if checkpoint is not None:
+            checkpoint.clear()
+        return
 
     if args.with_rand:
-        instances, rand_instances, labeled_data = create_training_instances(
+        spans, rand_spans, labeled_data = create_training_instances(
             data, all_labels, args.task_name, generator, args.max_seq_length, args.dupe_factor,
             args.short_seq_prob, args.masked_lm_prob, args.max_predictions_per_seq,
-            rng, with_rand=args.with_rand)
+            rng, with_rand=args.with_rand, with_labeled=args.mode in ["rule", "saliency"])
     else:
-        instances, labeled_data = create_training_instances(
+        spans, labeled_data = create_training_instances(
             data, all_labels, args.task_name, generator, args.max_seq_length, args.dupe_factor,
             args.short_seq_prob, args.masked_lm_prob, args.max_predictions_per_seq,
-            rng, with_rand=args.with_rand)
+            rng, with_rand=args.with_rand, with_labeled=args.mode in ["rule", "saliency"])
 
-    if args.part >= 0:
-        output_file = os.path.join(args.output_dir, "model", "{}.hdf5".format(args.part))        
-        if args.with_rand:
-            rand_output_file = os.path.join(args.output_dir, "rand", "{}.hdf5".format(args.part))
-        labeled_output_file = os.path.join(args.output_dir, "{}.pkl".format(args.part))     
-    else:
-        output_file = os.path.join(args.output_dir, "model", "0.hdf5") 
-        if args.with_rand:
-            rand_output_file = os.path.join(args.output_dir, "rand", "0.hdf5")
-        labeled_output_file = os.path.join(args.output_dir, "0.pkl")
-    
-    if args.mode == "rule":
-        print("Writing labeled data(.pkl) for rule mode")
-        write_labeled_data(labeled_data, labeled_output_file)
+    if args.mode == "rule" or args.mode == "saliency":
+        print("Writing labeled data(.pkl) for {} mode".format(args.mode))
+        write_labeled_data(labeled_data, labeled_output_file, tokenizer.vocab)
+        if checkpoint is not None:
+            checkpoint.clear()
     else:
         print("Writing masked data(.hdf5) for model mode")
         if args.with_rand:
-            print("Num instances: {}. Num rand instance: {}".format(len(instances), len(rand_instances)))
-            write_instance_to_example_file(instances, tokenizer, args.max_seq_length, args.max_predictions_per_seq, output_file)
-            write_instance_to_example_file(rand_instances, tokenizer, args.max_seq_length, args.max_predictions_per_seq, rand_output_file)
+            print("Num instances: {}. Num rand instance: {}".format(len(spans), len(rand_spans)))
+            print(output_file)
+            write_spans(spans, output_file, **hdf5_options(args))
+            print(rand_output_file)
+            write_spans(rand_spans, rand_output_file, **hdf5_options(args))
         else:
-            print("Num instances: {}.".format(len(instances)))
-            write_instance_to_example_file(instances, tokenizer, args.max_seq_length, args.max_predictions_per_seq, labeled_output_file)
+            print("Num instances: {}.".format(len(spans)))
+            print(labeled_output_file)
+            write_spans(spans, labeled_output_file, **hdf5_options(args))
+
+
+def run_work_units(args, processor, generator, tokenizer):
+    """Worker of data/shard_coordinator.py: claims units of the manifest in `args.work_dir` until none are left.
+
+    Unit i covers documents [begin, end) of the manifest, which are the only ones read from the
+    corpus for it. It uses the seed `random_seed + i` and writes its files to {work_dir}/units like
+    a run with `--part i`.
+    """
+    with open(os.path.join(args.work_dir, "manifest.json")) as f:
+        units = json.load(f)["units"]
+    units_dir = os.path.join(args.work_dir, "units")
+    for dirname in [units_dir, os.path.join(units_dir, "model"), os.path.join(units_dir, "rand")]:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    for unit_id, (begin, end, num_tokens) in enumerate(units):
+        if not claim_unit(args.work_dir, unit_id, args.worker_id):
+            continue
+        logger.info("Worker {}: unit {} (documents {}-{}, {} tokens)".format(args.worker_id, unit_id, begin, end, num_tokens))
+        data, all_labels = load_documents(processor, args.task_name, args.input_dir, -1, 1, records=(begin, end))
+        data = tokenize_documents(args, data, all_labels, generator, tokenizer)
+        rng = random.Random(args.random_seed + unit_id)
+        create_outputs(args, data, all_labels, generator, tokenizer, rng, units_dir, unit_id)
+        mark_done(args.work_dir, unit_id)
+
 
 if __name__ == "__main__":
     main()
@@ -18,11 +18,14 @@
 from __future__ import absolute_import, division, print_function
 
 import csv
+import io
+import itertools
 import logging
 import os
 import sys
 import xml.etree.ElementTree as ET
 
+import numpy as np
 from scipy.stats import pearsonr, spearmanr
 from sklearn.metrics import matthews_corrcoef, f1_score
 
@@ -75,6 +78,14 @@ class DataProcessor(object):
         """Gets the list of labels for this data set."""
         raise NotImplementedError()
 
+    def get_pretrain_size(self, data_dir):
+        """Gets the number of records of the pretraining corpus, the `records` of `get_pretrain_examples`."""
+        raise NotImplementedError()
+
+    def get_pretrain_range(self, data_dir, part, max_proc):
+        """Gets the [begin, end) records of `part` out of `max_proc` of the pretraining corpus."""
+        return _part_range(self.get_pretrain_size(data_dir), part, max_proc)
+
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None, delimiter="\t"):
         """Reads a tab separated value file."""
@@ -87,6 +98,75 @@ class DataProcessor(object):
                 lines.append(line)
             return lines
 
+    @classmethod
+    def _record_offsets(cls, input_file, quotechar=None, delimiter="\t", csv_records=True):
+        """Byte offsets of the records of `input_file` plus its size, cached in `{input_file}.idx.npy`.
+
+        With `csv_records` a record ends where `csv.reader` ends it (quoted fields may span lines),
+        otherwise every line is a record.
+        """
+        index_file = input_file + ".idx.npy"
+        if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(input_file):
+            # memory mapped, reading a few records only touches their offsets
+            offsets = np.load(index_file, mmap_mode="r")
+            if offsets[-1] == os.path.getsize(input_file):
+                return offsets
+
+        offsets = [0]
+        pos = [0]
+
+        def lines(f):
+            # universal newlines like the text mode reads, counting the bytes consumed so far
+            for raw in f:
+                for piece in raw.splitlines(True):
+                    pos[0] += len(piece)
+                    yield piece.rstrip(b"\r\n").decode("utf-8") + "\n"
+
+        with open(input_file, "rb") as f:
+            records = csv.reader(lines(f), delimiter=delimiter, quotechar=quotechar) if csv_records else lines(f)
+            for _ in records:
+                offsets.append(pos[0])
+        offsets = np.array(offsets, dtype=np.int64)
+
+        logger.info("Indexed {} records of {}".format(len(offsets) - 1, input_file))
+        tmp = "{}.{}.tmp".format(index_file, os.getpid())
+        try:
+            with open(tmp, "wb") as f:
+                np.save(f, offsets)
+            os.replace(tmp, index_file)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write {}: {}".format(index_file, e))
+        return offsets
+
+    @classmethod
+    def _read_tsv_part(cls, input_file, part, max_proc, quotechar=None, delimiter="\t", records=None):
+        """Reads only the records of `part` out of `max_proc` (or the `records` range), returns (first record index, lines)."""
+        offsets = cls._record_offsets(input_file, quotechar=quotechar, delimiter=delimiter)
+        begin, end = _part_range(len(offsets) - 1, part, max_proc, records)
+        with open(input_file, "rb") as raw:
+            raw.seek(offsets[begin])
+            f = io.TextIOWrapper(raw, encoding="utf-8")
+            reader = csv.reader(f, delimiter=delimiter, quotechar=quotechar)
+            return begin, [line for line in itertools.islice(reader, end - begin)]
+
+
+def _part_range(data_size, part, max_proc, records=None):
+    """[begin, end) of `part` out of `max_proc`, the last part takes the remainder. part < 0 is everything.
+
+    A (begin, end) `records` range, the work units of data/shard_coordinator.py, is used as it is.
+    """
+    if records is not None:
+        return records[0], min(records[1], data_size)
+    part_size = data_size // max_proc
+    begin = 0
+    end = data_size
+    if part >= 0:
+        begin = part*part_size
+        end = (part+1)*part_size
+        if part == max_proc - 1:
+            end = data_size
+    return begin, end
+
 
 class MrpcProcessor(DataProcessor):
     """Processor for the MRPC data set (GLUE version)."""
@@ -243,22 +323,10 @@ class ABSAProcessor(DataProcessor):
     def get_test_examples(self, data_dir):
         return self._create_absa_examples(self._read_xml(os.path.join(data_dir, "test.xml")), "test")
 
-    def get_pretrain_examples(self, data_dir, part, max_proc):
+    def get_pretrain_examples(self, data_dir, part, max_proc, records=None):
         """See base class"""
         lines = self._read_xml(os.path.join(data_dir, "train.xml"))
-        data_size = len(lines)
-        part_size = data_size // max_proc
-        begin = 0
-        end = data_size
-        if part >= 0:
-            begin = part*part_size
-            end = (part+1)*part_size
-            # print(begin, end)
-            # if end - begin < 1000:
-            # begin = 0
-            # end = data_size
-            if part == max_proc - 1:
-                end = data_size
+        begin, end = _part_range(len(lines), part, max_proc, records)
         examples = []
         for i in range(begin, end):
             line = lines[i]
@@ -301,23 +369,11 @@ class ABSATermProcessor(DataProcessor):
     def get_test_examples(self, data_dir):
         return self._create_absa_examples(self._read_xml(os.path.join(data_dir, "test.xml")), "test")
 
-    def get_pretrain_examples(self, data_dir, part, max_proc):
+    def get_pretrain_examples(self, data_dir, part, max_proc, records=None):
         """See base class"""
         lines = self._read_xml(os.path.join(data_dir, "train.xml"))
-        data_size = len(lines)
-        print(data_size)
-        part_size = data_size // max_proc
-        begin = 0
-        end = data_size
-        if part >= 0:
-            begin = part*part_size
-            end = (part+1)*part_size
-            # print(begin, end)
-            # if end - begin < 1000:
-            # begin = 0
-            # end = data_size
-            if part == max_proc - 1:
-                end = data_size
+        print(len(lines))
+        begin, end = _part_range(len(lines), part, max_proc, records)
         print(part, max_proc, begin, end)
         examples = []
         for i in range(begin, end):
@@ -355,25 +411,11 @@ class TwitterProcessor(DataProcessor):
         print("get test examples")
         return self._create_examples(self._read_twitter(os.path.join(data_dir, "test.tsv")), "test")
 
-    def get_pretrain_examples(self, data_dir, part, max_proc):
+    def get_pretrain_examples(self, data_dir, part, max_proc, records=None):
         """See base class"""
-        lines = self._read_twitter(os.path.join(data_dir, "train.tsv"))
-        data_size = len(lines)
-        part_size = data_size // max_proc
-        begin = 0
-        end = data_size
-        if part >= 0:
-            begin = part*part_size
-            end = (part+1)*part_size
-            # print(begin, end)
-            # if end - begin < 1000:
-                # begin = 0
-                # end = data_size
-            if part == max_proc - 1:
-                end = data_size
+        begin, lines = self._read_twitter_part(os.path.join(data_dir, "train.tsv"), part, max_proc, records)
         examples = []
-        for i in range(begin, end):
-            line = lines[i]
+        for i, line in enumerate(lines, begin):
             if line[1] == "positive":
                 label = '2'
             elif line[1] == "negative":
@@ -395,6 +437,18 @@ class TwitterProcessor(DataProcessor):
                 L.append(line.strip().split("\t"))
         return L
 
+    def get_pretrain_size(self, data_dir):
+        """See base class"""
+        return len(self._record_offsets(os.path.join(data_dir, "train.tsv"), csv_records=False)) - 1
+
+    def _read_twitter_part(self, input_file, part, max_proc, records=None):
+        offsets = self._record_offsets(input_file, csv_records=False)
+        begin, end = _part_range(len(offsets) - 1, part, max_proc, records)
+        with open(input_file, "rb") as raw:
+            raw.seek(offsets[begin])
+            f = io.TextIOWrapper(raw, encoding="utf-8")
+            return begin, [line.strip().split("\t") for line in itertools.islice(f, end - begin)]
+
     def _create_examples(self, lines, set_type):
         examples = []
         for (i, line) in enumerate(lines):
@@ -427,30 +481,21 @@ class MRProcessor(DataProcessor):
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "train.csv"), quotechar='*', delimiter=','), "train")
 
-    def get_pretrain_examples(self, data_dir, part, max_proc):
+    def get_pretrain_examples(self, data_dir, part, max_proc, records=None):
         """See base class"""
-        lines = self._read_tsv(os.path.join(data_dir, "train.csv"), quotechar='*', delimiter=',')
-        data_size = len(lines)
-        part_size = data_size // max_proc
-        begin = 0
-        end = data_size
-        if part >= 0:
-            begin = part*part_size
-            end = (part+1)*part_size
-            # print(begin, end)
-            # if end - begin < 1000:
-                # begin = 0
-                # end = data_size
-            if part == max_proc - 1:
-                end = data_size
+        begin, lines = self._read_tsv_part(os.path.join(data_dir, "train.csv"), part, max_proc,
+                                           quotechar='*', delimiter=',', records=records)
         examples = []
-        for i in range(begin, end):
-            line = lines[i]
+        for i, line in enumerate(lines, begin):
             label = line[0]
             text_a = line[1]
             examples.append(InputExample(guid=i, text_a=text_a, text_b=None, label=label))
         return examples
 
+    def get_pretrain_size(self, data_dir):
+        """See base class"""
+        return len(self._record_offsets(os.path.join(data_dir, "train.csv"), quotechar='*', delimiter=',')) - 1
+
 
     def get_dev_examples(self, data_dir):
         """See base class."""
@@ -481,31 +526,23 @@ class YelpProcessor(DataProcessor):
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "train.csv"), quotechar='"', delimiter=','), "train")
 
-    def get_pretrain_examples(self, data_dir, part, max_proc):
+    def get_pretrain_examples(self, data_dir, part, max_proc, records=None):
         """See base class"""
         print(part)
         print(max_proc)
-        lines = self._read_tsv(os.path.join(data_dir, "train.csv"), quotechar='"', delimiter=',')
-        data_size = len(lines)
-        part_size = data_size // max_proc
-        begin = 0
-        end = data_size
-        if part >= 0:
-            begin = part*part_size
-            end = (part+1)*part_size
-            # print(begin, end)
-            # if end - begin < 1000:
-                # begin = 0
-                # end = data_size
-            if part == max_proc - 1:
-                end = data_size
+        _, lines = self._read_tsv_part(os.path.join(data_dir, "train.csv"), part, max_proc,
+                                       quotechar='"', delimiter=',', records=records)
         examples = []
-        for i, line in enumerate(lines[begin:end]):
+        for i, line in enumerate(lines):
             label = line[0]
             text_a = line[1]
             examples.append(InputExample(guid=i, text_a=text_a, text_b=None, label=label))
         return examples
 
+    def get_pretrain_size(self, data_dir):
+        """See base class"""
+        return len(self._record_offsets(os.path.join(data_dir, "train.csv"), quotechar='"', delimiter=',')) - 1
+
 
     def get_dev_examples(self, data_dir):
         """See base class."""
@@ -536,31 +573,23 @@ class AmazonProcessor(DataProcessor):
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "train.csv"), quotechar='"', delimiter=','), "train")
 
-    def get_pretrain_examples(self, data_dir, part, max_proc):
+    def get_pretrain_examples(self, data_dir, part, max_proc, records=None):
         """See base class"""
         print(part)
         print(max_proc)
-        lines = self._read_tsv(os.path.join(data_dir, "train.csv"), quotechar='"', delimiter=',')
-        data_size = len(lines)
-        part_size = data_size // max_proc
-        begin = 0
-        end = data_size
-        if part >= 0:
-            begin = part*part_size
-            end = (part+1)*part_size
-            # print(begin, end)
-            # if end - begin < 1000:
-                # begin = 0
-                # end = data_size
-            if part == max_proc - 1:
-                end = data_size
+        _, lines = self._read_tsv_part(os.path.join(data_dir, "train.csv"), part, max_proc,
+                                       quotechar='"', delimiter=',', records=records)
         examples = []
-        for i, line in enumerate(lines[begin:end]):
+        for i, line in enumerate(lines):
             label = line[0]
             text_a = line[1] + ". " + line[2]
             examples.append(InputExample(guid=i, text_a=text_a, text_b=None, label=label))
         return examples
 
+    def get_pretrain_size(self, data_dir):
+        """See base class"""
+        return len(self._record_offsets(os.path.join(data_dir, "train.csv"), quotechar='"', delimiter=',')) - 1
+
 
     def get_dev_examples(self, data_dir):
         """See base class."""
@@ -0,0 +1,111 @@
+"""The hdf5 files of the pretraining data: codecs and a chunk aligned appender.
+
+Only needs h5py and NumPy, so the merge/shuffle tools can use it without the tokenizer.
+"""
+import collections
+import logging
+import time
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FEATURE_DTYPES = collections.OrderedDict([("input_ids", "i4"), ("input_mask", "i1"), ("segment_ids", "i1"),
+                                          ("masked_lm_positions", "i4"), ("masked_lm_ids", "i4"), ("next_sentence_labels", "i1")])
+
+
+HDF5_CODECS = ["none", "lzf", "gzip"]
+
+# rows per chunk of `HDF5Appender` and the default of every --hdf5_chunk_rows
+HDF5_CHUNK_ROWS = 256
+
+
+def hdf5_codec(compression="gzip", level=None):
+    """The h5py `create_dataset` arguments of a codec: none, lzf or gzip (level 0-9, default 4)."""
+    if compression == "none":
+        return {}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if level is None else level}
+    raise ValueError("Unknown hdf5 compression: {}".format(compression))
+
+
+def write_features(features, output_file, **kwargs):
+    """Writes whole feature arrays, like `InstanceSpans.features` gives, to an hdf5 file, `kwargs` go to `HDF5Appender`."""
+    print("saving data")
+    max_seq_length = features["input_ids"].shape[1]
+    max_predictions_per_seq = features["masked_lm_ids"].shape[1]
+    writer = HDF5Appender(output_file, max_seq_length, max_predictions_per_seq, **kwargs)
+    writer.append(features)
+    writer.close()
+
+
+class HDF5Appender(object):
+    """Writes the datasets of the pretraining hdf5 files block by block, growing them as it goes.
+
+    Chunks hold `chunk_rows` whole rows, so a loader reading a batch of consecutive rows only
+    decompresses the chunks of that batch; `chunk_rows` should be a multiple of its batch size.
+    Rows are buffered until a chunk is full and written in whole chunks, so no compressed chunk
+    is written twice. `close` logs the write throughput.
+    """
+    def __init__(self, output_file, max_seq_length, max_predictions_per_seq, chunk_rows=HDF5_CHUNK_ROWS, compression="gzip",
+                 compression_level=None):
+        self.output_file = output_file
+        self.chunk_rows = chunk_rows
+        self.f = h5py.File(output_file, 'w')
+        self.num_rows = 0
+        self.num_bytes = 0
+        self.write_time = 0.0
+        widths = {"input_ids": max_seq_length, "input_mask": max_seq_length, "segment_ids": max_seq_length,
+                  "masked_lm_positions": max_predictions_per_seq, "masked_lm_ids": max_predictions_per_seq}
+        codec = hdf5_codec(compression, compression_level)
+        self.buffer = collections.OrderedDict()
+        for name, dtype in FEATURE_DTYPES.items():
+            tail = (widths[name],) if name in widths else ()
+            self.f.create_dataset(name, shape=(0,) + tail, maxshape=(None,) + tail, chunks=(chunk_rows,) + tail,
+                                  dtype=dtype, **codec)
+            self.buffer[name] = np.zeros((chunk_rows,) + tail, dtype=dtype)
+        self.buffered = 0
+
+    def write(self, arrays, num):
+        begin = time.time()
+        for name in FEATURE_DTYPES:
+            dataset = self.f[name]
+            dataset.resize(self.num_rows + num, axis=0)
+            dataset[self.num_rows:] = arrays[name][:num]
+            self.num_bytes += num * dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+        self.num_rows += num
+        self.write_time += time.time() - begin
+
+    def append(self, features):
+        num = len(features["input_ids"])
+        begin = 0
+        if self.buffered > 0:
+            # complete the pending chunk first
+            begin = min(num, self.chunk_rows - self.buffered)
+            for name in FEATURE_DTYPES:
+                self.buffer[name][self.buffered:self.buffered + begin] = features[name][:begin]
+            self.buffered += begin
+            if self.buffered == self.chunk_rows:
+                self.write(self.buffer, self.chunk_rows)
+                self.buffered = 0
+        whole = (num - begin) // self.chunk_rows * self.chunk_rows
+        if whole > 0:
+            self.write({name: features[name][begin:begin + whole] for name in FEATURE_DTYPES}, whole)
+        rest = num - begin - whole
+        if rest > 0:
+            for name in FEATURE_DTYPES:
+                self.buffer[name][0:rest] = features[name][begin + whole:]
+            self.buffered = rest
+
+    def close(self):
+        if self.buffered > 0:
+            self.write(self.buffer, self.buffered)
+            self.buffered = 0
+        self.f.flush()
+        self.f.close()
+        logger.info("{}: {} rows, {:.1f} MB in {:.2f}s ({:.1f} MB/s)".format(
+            self.output_file, self.num_rows, self.num_bytes / (1 << 20), self.write_time,
+            self.num_bytes / (1 << 20) / max(self.write_time, 1e-9)))
@@ -0,0 +1,115 @@
+"""Columnar labeled data of rule/saliency mode, the compact alternative to the (tokens, 0/1 labels) pickles.
+
+A `{name}.labeled` directory holds
+    ids.bin      int32 token ids of all sentences, back to back
+    labels.bin   the 0/1 mask label of every token, bit packed (np.packbits order)
+    offsets.bin  int64 start of every sentence in ids.bin, plus the end
+    meta.json    the number of sentences and tokens and the vocab size of the ids
+The files are read with np.memmap, so a reader only touches the sentences it uses. Stores are
+merged by concatenating them, see `concat_labeled`.
+"""
+import json
+import os
+
+import numpy as np
+
+
+class LabeledWriter(object):
+    def __init__(self, path, vocab_size):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.vocab_size = vocab_size
+        self.ids_f = open(os.path.join(path, "ids.bin"), "wb")
+        self.labels_f = open(os.path.join(path, "labels.bin"), "wb")
+        self.offsets_f = open(os.path.join(path, "offsets.bin"), "wb")
+        self.num_sentences = 0
+        self.num_tokens = 0
+        # labels not yet written, fewer than 8
+        self.pending = np.zeros(0, dtype=np.uint8)
+        np.zeros(1, dtype=np.int64).tofile(self.offsets_f)
+
+    def append(self, ids, labels, lengths):
+        """Appends sentences given as their flat `ids` and `labels` and the length of each."""
+        ids = np.asarray(ids, dtype=np.int32)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        ids.tofile(self.ids_f)
+        bits = np.concatenate([self.pending, np.asarray(labels, dtype=np.uint8)])
+        whole = len(bits) // 8 * 8
+        np.packbits(bits[:whole]).tofile(self.labels_f)
+        self.pending = bits[whole:]
+        (self.num_tokens + np.cumsum(lengths)).tofile(self.offsets_f)
+        self.num_sentences += len(lengths)
+        self.num_tokens += len(ids)
+
+    def close(self):
+        np.packbits(self.pending).tofile(self.labels_f)
+        for f in [self.ids_f, self.labels_f, self.offsets_f]:
+            f.close()
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"num_sentences": self.num_sentences, "num_tokens": self.num_tokens,
+                       "vocab_size": self.vocab_size}, f)
+
+
+class LabeledData(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.num_sentences = meta["num_sentences"]
+        self.num_tokens = meta["num_tokens"]
+        self.vocab_size = meta["vocab_size"]
+        self.ids = self.memmap("ids.bin", np.int32, self.num_tokens)
+        self.labels = self.memmap("labels.bin", np.uint8, (self.num_tokens + 7) // 8)
+        self.offsets = self.memmap("offsets.bin", np.int64, self.num_sentences + 1)
+
+    def memmap(self, name, dtype, size):
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=(size,))
+
+    def __len__(self):
+        return self.num_sentences
+
+    def token_labels(self, begin, end):
+        """The 0/1 labels of the tokens [begin, end)."""
+        packed = self.labels[begin // 8:(end + 7) // 8]
+        return np.unpackbits(packed)[begin % 8:begin % 8 + end - begin]
+
+    def sentence(self, i):
+        """(ids, labels) of sentence i."""
+        begin, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.ids[begin:end], self.token_labels(begin, end)
+
+
+def write_labeled(labeled_data, path, vocab):
+    """Writes (tokens, 0/1 labels) pairs, the `labeled_data` of create_data.py, as a store."""
+    writer = LabeledWriter(path, len(vocab))
+    lengths = [len(tokens) for tokens, _ in labeled_data]
+    ids = np.fromiter((vocab[token] for tokens, _ in labeled_data for token in tokens), dtype=np.int32, count=sum(lengths))
+    labels = np.fromiter((label for _, labels in labeled_data for label in labels), dtype=np.uint8, count=sum(lengths))
+    writer.append(ids, labels, lengths)
+    writer.close()
+
+
+def concat_labeled(input_paths, output_path, begin=0, end=None, block_tokens=1 << 24):
+    """Writes the sentences [begin, end) of the concatenated stores `input_paths` to a new store."""
+    stores = [LabeledData(path) for path in input_paths]
+    if len(set(store.vocab_size for store in stores)) > 1:
+        raise ValueError("Labeled data of different vocabs: {}".format(input_paths))
+    total = sum(len(store) for store in stores)
+    end = total if end is None else end
+    writer = LabeledWriter(output_path, stores[0].vocab_size if stores else 0)
+    offset = 0
+    for store in stores:
+        lo, hi = max(begin - offset, 0), min(end - offset, len(store))
+        offset += len(store)
+        while lo < hi:
+            # as many sentences as fit in a block, at least one
+            stop = int(np.searchsorted(store.offsets, store.offsets[lo] + block_tokens, side="right")) - 1
+            stop = min(max(stop, lo + 1), hi)
+            token_begin, token_end = int(store.offsets[lo]), int(store.offsets[stop])
+            writer.append(store.ids[token_begin:token_end], store.token_labels(token_begin, token_end),
+                          np.diff(store.offsets[lo:stop + 1]))
+            lo = stop
+    writer.close()
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+import pickle
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LoopCheckpoint(object):
+    """Named pickled states of a long running generator, written next to its outputs.
+
+    Every state is its own `{prefix}.{name}.pkl` file, replaced atomically. `config` holds
+    the arguments the states depend on: states written under another config are dropped.
+    Loop states are saved by `maybe_save` every `every_rounds` calls or `every_minutes`.
+    """
+    def __init__(self, prefix, config, every_rounds=0, every_minutes=30.0):
+        self.prefix = prefix
+        self.every_rounds = every_rounds
+        self.every_minutes = every_minutes
+        self.rounds = 0
+        self.last_save = time.time()
+
+        dirname = os.path.dirname(prefix)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        config_file = "{}.config.json".format(prefix)
+        config = json.loads(json.dumps(config, sort_keys=True))
+        if os.path.exists(config_file):
+            with open(config_file) as f:
+                if json.load(f) != config:
+                    logger.warning("Arguments changed since {} was written, starting over".format(config_file))
+                    self.clear()
+        with open(config_file, "w") as f:
+            json.dump(config, f, sort_keys=True)
+
+    def path(self, name):
+        return "{}.{}.pkl".format(self.prefix, name)
+
+    def load(self, name):
+        if not os.path.exists(self.path(name)):
+            return None
+        with open(self.path(name), "rb") as f:
+            state = pickle.load(f)
+        logger.info("Loaded checkpoint {}".format(self.path(name)))
+        return state
+
+    def save(self, name, state):
+        tmp = self.path(name) + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path(name))
+        self.rounds = 0
+        self.last_save = time.time()
+
+    def maybe_save(self, name, get_state):
+        """Counts one round and saves `get_state()` when a checkpoint is due."""
+        self.rounds += 1
+        if (self.every_rounds > 0 and self.rounds >= self.every_rounds) or \
+                (self.every_minutes > 0 and time.time() - self.last_save >= self.every_minutes * 60):
+            self.save(name, get_state())
+            logger.info("Saved checkpoint {}".format(self.path(name)))
+
+    def clear(self):
+        dirname = os.path.dirname(self.prefix) or "."
+        basename = os.path.basename(self.prefix) + "."
+        for filename in os.listdir(dirname):
+            if filename.startswith(basename) and (filename.endswith(".pkl") or filename.endswith(".tmp")):
+                os.remove(os.path.join(dirname, filename))
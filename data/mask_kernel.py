@@ -0,0 +1,113 @@
+"""80/10/10 masking of a whole shard on token id arrays, shared by the mask generators.
+
+The sentences (or documents) of a shard are one flat int32 id array plus offsets, the positions
+to mask are one flat array of indexes into it. Stop words are dropped with a bitmap over the
+vocab ids and the replacements are drawn for all positions at once from a NumPy Generator
+seeded from the shard's `random.Random`, so a seed still gives the same masks.
+"""
+import collections
+
+import numpy as np
+
+# positions: sorted positions of the masked tokens, mask_ids: the ids they are replaced with.
+# The labels are the ids at the positions.
+MaskedTokenInstance = collections.namedtuple("MaskedTokenInstance", ["ids", "positions", "mask_ids"])
+
+
+def stop_word_bitmap(vocab):
+    """Bool array over the vocab ids, True where spaCy's `Lexeme.is_stop` is."""
+    # the stop words of spaCy's English defaults, no pipeline is loaded
+    from spacy.lang.en.stop_words import STOP_WORDS
+    is_stop = np.zeros(len(vocab), dtype=bool)
+    for token, token_id in vocab.items():
+        is_stop[token_id] = token.lower() in STOP_WORDS
+    return is_stop
+
+
+def masked_flags(instance):
+    """0/1 per token of a `MaskedTokenInstance`, the labels of the labeled data(.pkl)."""
+    flags = np.zeros(len(instance.ids), dtype=np.int64)
+    flags[instance.positions] = 1
+    return flags.tolist()
+
+
+def labeled_sentence(instance, id_tokens):
+    """(tokens, 0/1 labels) of a `MaskedTokenInstance`, `id_tokens` is the object array of the vocab tokens by id."""
+    return id_tokens[instance.ids].tolist(), masked_flags(instance)
+
+
+def token_ids(sentences, vocab):
+    """Flat int32 ids of the token lists `sentences` and the offset of each (plus the end)."""
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sen) for sen in sentences])
+    ids = np.fromiter((vocab[token] for sen in sentences for token in sen), dtype=np.int32, count=offsets[-1])
+    return ids, offsets
+
+
+class MaskKernel(object):
+    def __init__(self, vocab, skip_stop_words=False, mask_token="[MASK]"):
+        # vocab: token -> id, the tokenizer's vocab
+        self.vocab = vocab
+        self.vocab_size = len(vocab)
+        self.mask_id = vocab[mask_token]
+        self.is_stop = stop_word_bitmap(vocab) if skip_stop_words else None
+
+    def generator(self, rng):
+        """A NumPy Generator seeded from the shard's `random.Random`."""
+        return np.random.default_rng(rng.getrandbits(64))
+
+    def to_ids(self, sentences):
+        return token_ids(sentences, self.vocab)
+
+    def replace(self, label_ids, gen):
+        """80% [MASK], 10% the token itself, 10% a random vocab token."""
+        u = gen.random(len(label_ids))
+        random_ids = gen.integers(0, self.vocab_size, len(label_ids), dtype=np.int32)
+        mask_ids = np.where(u < 0.8, self.mask_id, np.where(u < 0.9, label_ids, random_ids))
+        return mask_ids.astype(np.int32)
+
+    def mask(self, ids, positions, gen):
+        """Drops stop word positions and draws the replacements of the rest. Returns (positions, mask_ids)."""
+        positions = np.sort(np.asarray(positions, dtype=np.int64))
+        if self.is_stop is not None:
+            positions = positions[~self.is_stop[ids[positions]]]
+        return positions, self.replace(ids[positions], gen)
+
+    def flatten(self, offsets, mask_poses_d):
+        """Flat positions of a {segment: positions within the segment} dict."""
+        flat = [offsets[i] + np.asarray(sorted(poses), dtype=np.int64) for i, poses in mask_poses_d.items() if len(poses) > 0]
+        return np.concatenate(flat) if len(flat) > 0 else np.zeros(0, dtype=np.int64)
+
+    def sample(self, offsets, num_to_predict, gen):
+        """`num_to_predict[i]` uniformly drawn positions of segment i, without replacement, as sorted flat positions."""
+        lengths = np.diff(offsets)
+        seg = np.repeat(np.arange(len(lengths)), lengths)
+        # segment id + a random fraction sorts every segment into a random order, in segment order
+        order = np.argsort(seg + gen.random(len(seg)))
+        rank = np.arange(len(seg)) - offsets[:-1][seg]
+        return np.sort(order[rank < np.asarray(num_to_predict)[seg]])
+
+    def split(self, ids, offsets, positions, mask_ids):
+        """One `MaskedTokenInstance` per segment from the flat arrays."""
+        bounds = np.searchsorted(positions, offsets)
+        local = (positions - np.repeat(offsets[:-1], np.diff(bounds))).astype(np.int32)
+        return [MaskedTokenInstance(ids=ids[offsets[i]:offsets[i + 1]], positions=local[bounds[i]:bounds[i + 1]],
+                                    mask_ids=mask_ids[bounds[i]:bounds[i + 1]])
+                for i in range(len(offsets) - 1)]
+
+    def mask_sentences(self, ids, offsets, sen_doc_ids, doc_num, mask_poses_d, dupe_factor, rng):
+        """`all_documents` of the generators: every document's sentences (flat `ids` plus `offsets`), masked
+        at the positions of `mask_poses_d` ({sentence index: positions}) with new replacements per dupe."""
+        positions = self.flatten(offsets, mask_poses_d)
+        gen = self.generator(rng)
+        all_documents = []
+        for _ in range(dupe_factor):
+            instances = self.split(ids, offsets, *self.mask(ids, positions, gen))
+            all_documents.extend(group_documents(instances, sen_doc_ids, doc_num))
+        return all_documents
+
+
+def group_documents(instances, sen_doc_ids, doc_num):
+    """The sentence instances of every document, `sen_doc_ids` is sorted."""
+    bounds = np.searchsorted(np.asarray(sen_doc_ids, dtype=np.int64), np.arange(doc_num + 1)).tolist()
+    return [instances[bounds[i]:bounds[i + 1]] for i in range(doc_num)]
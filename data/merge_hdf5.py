@@ -1,57 +1,105 @@
-import h5py
-import sys
+"""Merges the part files {0..num_files-1}.hdf5 of create_data.py into merged/train.hdf5 and merged/dev/dev.hdf5.
+
+The parts are concatenated in order and the last `--dev_rate` of the rows is the dev split.
+
+--mode copy     copies whole row blocks of the parts, re-chunked and compressed with `--hdf5_compression`
+--mode virtual  writes hdf5 virtual datasets that map the row ranges of the parts, nothing is copied.
+                The sources are stored relative to the merged files, so the parts must stay next to
+                merged/ (moving the whole output dir is fine).
+"""
+import argparse
+import logging
 import os
-import numpy as np
-import collections
-from tqdm import tqdm
-
-origin_dir = sys.argv[1]
-num_files = int(sys.argv[2])
-
-features_trn, features_dev = collections.OrderedDict(), collections.OrderedDict()
-num_instances, max_seq_length, max_predictions_per_seq = 0, 0, 0
-data = []
-
-dev_rate = 0.1
-
-for i in range(num_files):
-    filename = os.path.join(origin_dir, "{}.hdf5".format(i))
-    with h5py.File(filename, "r") as f:
-        num_inst = f["input_ids"].shape[0]
-        max_seq_length = f["input_ids"].shape[1]
-        max_predictions_per_seq = f["masked_lm_positions"].shape[1]
-        num_instances += num_inst
-        for k in tqdm(range(num_inst), desc="loading {}".format(filename)):
-            data.append({
-                "input_ids": f["input_ids"][i, :], 
-                "input_mask": f["input_mask"][i, :], 
-                "segment_ids": f["segment_ids"][i, :], 
-                "masked_lm_positions": f["masked_lm_positions"][i, :], 
-                "masked_lm_ids": f["masked_lm_ids"][i, :], 
-                "next_sentence_labels": f["next_sentence_labels"][i]
-            })
-
-train_data = data[:int((1 - dev_rate) * num_instances)]
-dev_data = data[int((1 - dev_rate) * num_instances):]
-
-for feat, d, name in [(features_trn, train_data, "train.hdf5"), (features_dev, dev_data, "dev/dev.hdf5")]:
-    feat["input_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    feat["input_mask"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    feat["segment_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    feat["masked_lm_positions"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
-    feat["masked_lm_ids"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
-    feat["next_sentence_labels"] = np.zeros(num_instances, dtype="int32")
-
-    for i, inst in enumerate(tqdm(d, desc="train data")):
-        for key in feat:
-            feat[key][i] = inst[key]
-
-    f = h5py.File(os.path.join(origin_dir, "merged", name), 'w')
-    f.create_dataset("input_ids", data=feat["input_ids"], dtype='i4', compression='gzip')
-    f.create_dataset("input_mask", data=feat["input_mask"], dtype='i1', compression='gzip')
-    f.create_dataset("segment_ids", data=feat["segment_ids"], dtype='i1', compression='gzip')
-    f.create_dataset("masked_lm_positions", data=feat["masked_lm_positions"], dtype='i4', compression='gzip')
-    f.create_dataset("masked_lm_ids", data=feat["masked_lm_ids"], dtype='i4', compression='gzip')
-    f.create_dataset("next_sentence_labels", data=feat["next_sentence_labels"], dtype='i1', compression='gzip')
-    f.flush()
-    f.close()
+import sys
+import time
+
+import h5py
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from data.hdf5_writer import FEATURE_DTYPES, HDF5_CHUNK_ROWS, HDF5_CODECS, HDF5Appender
+
+logger = logging.getLogger(__name__)
+
+
+def part_ranges(part_sizes, begin, end):
+    """(part, part_begin, part_end, out_begin) of the rows [begin, end) of the concatenated parts."""
+    ranges = []
+    offset = 0
+    for part, size in enumerate(part_sizes):
+        lo, hi = max(begin, offset), min(end, offset + size)
+        if lo < hi:
+            ranges.append((part, lo - offset, hi - offset, lo - begin))
+        offset += size
+    return ranges
+
+
+def merge_virtual(part_files, part_sizes, begin, end, output_file):
+    shapes, dtypes = {}, {}
+    with h5py.File(part_files[0], "r") as f:
+        for name in FEATURE_DTYPES:
+            shapes[name], dtypes[name] = f[name].shape[1:], f[name].dtype
+    out_dir = os.path.dirname(os.path.abspath(output_file))
+    ranges = part_ranges(part_sizes, begin, end)
+    with h5py.File(output_file, "w") as f:
+        for name in FEATURE_DTYPES:
+            layout = h5py.VirtualLayout(shape=(end - begin,) + shapes[name], dtype=dtypes[name])
+            for part, lo, hi, out in ranges:
+                source = h5py.VirtualSource(os.path.relpath(os.path.abspath(part_files[part]), out_dir), name,
+                                            shape=(part_sizes[part],) + shapes[name], dtype=dtypes[name])
+                layout[out:out + hi - lo] = source[lo:hi]
+            f.create_virtual_dataset(name, layout, fillvalue=0)
+
+
+def merge_copy(part_files, part_sizes, begin, end, output_file, block_rows=65536, **kwargs):
+    with h5py.File(part_files[0], "r") as f:
+        writer = HDF5Appender(output_file, f["input_ids"].shape[1], f["masked_lm_ids"].shape[1], **kwargs)
+    for part, lo, hi, _ in part_ranges(part_sizes, begin, end):
+        with h5py.File(part_files[part], "r") as f:
+            for start in range(lo, hi, block_rows):
+                stop = min(start + block_rows, hi)
+                writer.append({name: f[name][start:stop] for name in FEATURE_DTYPES})
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("origin_dir", type=str, help="The model/ or rand/ output dir of create_data.py.")
+    parser.add_argument("num_files", type=int, help="Number of part files, --max_proc of create_data.py.")
+    parser.add_argument("--mode", default="copy", choices=["copy", "virtual"])
+    parser.add_argument("--dev_rate", default=0.1, type=float)
+    parser.add_argument("--hdf5_compression", default="gzip", choices=HDF5_CODECS, help="Codec of --mode copy.")
+    parser.add_argument("--hdf5_compression_level", default=None, type=int)
+    parser.add_argument("--hdf5_chunk_rows", default=HDF5_CHUNK_ROWS, type=int)
+    parser.add_argument("--block_rows", default=65536, type=int, help="Rows read from a part at a time by --mode copy.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    part_files = [os.path.join(args.origin_dir, "{}.hdf5".format(i)) for i in range(args.num_files)]
+    part_sizes = []
+    for filename in part_files:
+        with h5py.File(filename, "r") as f:
+            part_sizes.append(f["input_ids"].shape[0])
+    num_instances = sum(part_sizes)
+    num_train = int((1 - args.dev_rate) * num_instances)
+
+    merged_dir = os.path.join(args.origin_dir, "merged")
+    if not os.path.exists(os.path.join(merged_dir, "dev")):
+        os.makedirs(os.path.join(merged_dir, "dev"))
+    for name, begin, end in [("train.hdf5", 0, num_train), ("dev/dev.hdf5", num_train, num_instances)]:
+        output_file = os.path.join(merged_dir, name)
+        start = time.time()
+        if args.mode == "virtual":
+            merge_virtual(part_files, part_sizes, begin, end, output_file)
+        else:
+            merge_copy(part_files, part_sizes, begin, end, output_file, block_rows=args.block_rows,
+                       chunk_rows=args.hdf5_chunk_rows, compression=args.hdf5_compression,
+                       compression_level=args.hdf5_compression_level)
+        logger.info("{}: {} rows in {:.2f}s".format(output_file, end - begin, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
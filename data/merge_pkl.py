@@ -3,13 +3,26 @@ import sys
 import os
 import random
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from data.labeled_store import LabeledData, concat_labeled
+
 origin_dir = sys.argv[1]
 num_files = int(sys.argv[2])
 
-L = []
-
 dev_rate = 0.1
 
+# columnar labeled data of --labeled_format columnar: concatenated without loading it
+if os.path.isdir(os.path.join(origin_dir, "0.labeled")):
+    input_paths = [os.path.join(origin_dir, "{}.labeled".format(i)) for i in range(num_files)]
+    all_data_size = sum(len(LabeledData(path)) for path in input_paths)
+    num_train = int((1 - dev_rate) * all_data_size)
+    concat_labeled(input_paths, os.path.join(origin_dir, "merged", "train.labeled"), 0, num_train)
+    concat_labeled(input_paths, os.path.join(origin_dir, "merged", "valid.labeled"), num_train, all_data_size)
+    sys.exit(0)
+
+L = []
+
 for i in range(num_files):
     filename = os.path.join(origin_dir, "{}.pkl".format(i))
     print(filename)
@@ -2,7 +2,6 @@ import logging
 import torch
 import torch.nn as nn
 import numpy as np
-import spacy
 import sys
 import collections
 from tqdm import tqdm
@@ -11,9 +10,10 @@ from torch.nn.functional import softmax
 
 sys.path.append("../")
 from model.tokenization import BertTokenizer
+from data.token_cache import TokenizedCorpus
+from data.mask_kernel import MaskKernel
 
 logger = logging.getLogger(__name__)
-MaskedTokenInstance = collections.namedtuple("MaskedTokenInstance", ["tokens", "info"])
 MaskedItemInfo = collections.namedtuple("MaskedItemInfo", ["current_pos", "sen_doc_pos", "sen_right_id", "doc_ground_truth"])
 
 
@@ -32,33 +32,18 @@ class RandMask(nn.Module):
         self.tokenizer = BertTokenizer.from_pretrained(
             bert_model, do_lower_case=do_lower_case)
         self.vocab = list(self.tokenizer.vocab.keys())
+        self.mask_kernel = MaskKernel(self.tokenizer.vocab)
 
     def forward(self, data, all_labels, dupe_factor, rng):
-        # data: not tokenized
+        # data: document texts or a TokenizedCorpus
         all_documents = []
+        if isinstance(data, TokenizedCorpus):
+            ids, offsets = data.document_ids()
+        else:
+            ids, offsets = self.mask_kernel.to_ids([self.tokenizer.tokenize(line) for line in tqdm(data)])
+        num_to_predict = np.maximum(1, np.round(np.diff(offsets) * self.mask_rate)).astype(np.int64)
+        gen = self.mask_kernel.generator(rng)
         for _ in range(dupe_factor):
-            for line in tqdm(data):
-                all_documents.append([])
-                tokens = self.tokenizer.tokenize(line)
-                cand_indexes = [i for i in range(len(tokens))]
-                rng.shuffle(cand_indexes)
-                masked_info = [{} for token in tokens]
-                masked_token = None
-                masked_lms_len = 0
-                num_to_predict = max(1, int(round(len(tokens) * self.mask_rate)))
-                for index in cand_indexes:
-                    if masked_lms_len >= num_to_predict:
-                        break
-                    if rng.random() < 0.8:
-                        masked_token = "[MASK]"
-                    else:
-                        if rng.random() < 0.5:
-                            masked_token = tokens[index]
-                        else:
-                            masked_token = self.vocab[rng.randint(0, len(self.vocab) - 1)]
-                    
-                    masked_info[index]["mask"] = masked_token
-                    masked_info[index]["label"] = tokens[index]
-                    masked_lms_len += 1
-                all_documents[-1].append(MaskedTokenInstance(tokens=tokens, info=masked_info))
+            positions, mask_ids = self.mask_kernel.mask(ids, self.mask_kernel.sample(offsets, num_to_predict, gen), gen)
+            all_documents.extend([instance] for instance in self.mask_kernel.split(ids, offsets, positions, mask_ids))
         return all_documents
@@ -2,26 +2,94 @@ import logging
 import torch
 import torch.nn as nn
 import numpy as np
-import spacy
 import sys
 import collections
 import multiprocessing
-from spacy.lang.en import English
 from tqdm import tqdm
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.functional import softmax
 
 sys.path.append("../")
 from model.modeling_classification import BertForSequenceClassification, BertForTokenClassification
 from model.tokenization import BertTokenizer
+from data.batch_infer import BucketedInference, RaggedRows, pad_sequences, ranges
+from data.token_cache import TokenizedCorpus
+from data.sentence_split import splitters
+from data.mask_kernel import MaskKernel, group_documents, token_ids
 
 logger = logging.getLogger(__name__)
-MaskedTokenInstance = collections.namedtuple("MaskedTokenInstance", ["tokens", "info"])
 MaskedItemInfo = collections.namedtuple("MaskedItemInfo", ["current_pos", "sen_doc_pos", "sen_right_id", "doc_ground_truth"])
-nlp = English()
-sentencizer = nlp.create_pipe("sentencizer")
-nlp.add_pipe(sentencizer)
+
+
+# tokenizer and splitter of the `SentenceTokenizer` pool processes
+_pool_tokenizer = None
+_pool_splitter = None
+
+
+def _init_pool(tokenizer, splitter):
+    global _pool_tokenizer, _pool_splitter
+    _pool_tokenizer = tokenizer
+    _pool_splitter = splitter
+
+
+def _tokenize_batch(docs, tokenizer=None, splitter=None):
+    """Segments `docs` and tokenizes every sentence, returns the token lists of each document."""
+    tokenizer = tokenizer if tokenizer is not None else _pool_tokenizer
+    splitter = splitter if splitter is not None else _pool_splitter
+    return [[tokenizer.tokenize(text) for text in sen_texts] for sen_texts in splitter.split(docs)]
+
+
+class SentenceTokenizer(object):
+    """Sentence segmentation + wordpiece tokenization of documents.
+
+    Documents go through the `splitter` (see data/sentence_split.py) in batches of `batch_size`,
+    spread over `num_workers` processes when it is above 1. Results keep the document order.
+    The worker processes are spawned, not forked, so they inherit no CUDA state of the generator's
+    model. `close` stops them.
+    """
+    def __init__(self, tokenizer, num_workers=1, batch_size=256, splitter="spacy"):
+        self.tokenizer = tokenizer
+        self.splitter = splitters[splitter]()
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.pool = None
+        if num_workers > 1:
+            self.pool = multiprocessing.get_context("spawn").Pool(num_workers, initializer=_init_pool,
+                                                                  initargs=(tokenizer, self.splitter))
+
+    def tokenize_documents(self, docs):
+        """Token lists of the sentences of every document."""
+        batches = [docs[begin:begin + self.batch_size] for begin in range(0, len(docs), self.batch_size)]
+        if self.pool is None or len(batches) <= 1:
+            results = (_tokenize_batch(batch, self.tokenizer, self.splitter) for batch in batches)
+        else:
+            results = self.pool.imap(_tokenize_batch, batches)
+        all_sentences = []
+        for result in tqdm(results, total=len(batches), desc="Segmenting"):
+            all_sentences.extend(result)
+        return all_sentences
+
+    def __call__(self, data):
+        """Token ids of all sentences back to back, the offset of each (plus the end) and the document id of each.
+
+        `data` is a list of document texts or a `TokenizedCorpus`, which is read instead of segmenting
+        and tokenizing again.
+        """
+        if isinstance(data, TokenizedCorpus):
+            return data.sentence_ids()
+        sentences = []
+        sen_doc_ids = [] # [0, 0, ..., 0, 1, 1, ..., 1, ...]
+        for (doc_id, tL) in enumerate(self.tokenize_documents(data)):
+            sentences.extend(tL)
+            sen_doc_ids.extend([doc_id] * len(tL))
+        ids, offsets = token_ids(sentences, self.tokenizer.vocab)
+        return ids, offsets, sen_doc_ids
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 class InputFeatures(object):
     def __init__(self, input_ids, input_mask, segment_ids=None):
@@ -29,9 +97,318 @@ class InputFeatures(object):
         self.input_mask = input_mask
         self.segment_ids = segment_ids
 
+
+def sentence_inputs(ids, offsets, max_text_len, cls_id, sep_id):
+    """[CLS] + the first `max_text_len` ids + [SEP] of every sentence of the flat `ids`, as the
+    zero padded [N, width] matrix plus length vector of `pad_sequences`."""
+    text_lens = np.minimum(np.diff(offsets), max_text_len)
+    lengths = text_lens + 2
+    rows = np.arange(len(text_lens))
+    matrix = np.zeros([len(text_lens), int(lengths.max()) if len(text_lens) > 0 else 0], dtype=np.int32)
+    matrix[rows, 0] = cls_id
+    matrix[np.repeat(rows, text_lens), ranges(np.ones_like(text_lens), text_lens)] = ids[ranges(offsets[:-1], text_lens)]
+    matrix[rows, text_lens + 1] = sep_id
+    return matrix, lengths
+
+
+def greedy_prefix_mask(score_fn, base_ids, text_ids, labels, origin_scores, threshold, max_text_len, sep_id, text_segment_id=0,
+                       groups=None, checkpoint=None):
+    """Greedy left-to-right mask search shared by SC and ASC.
+
+    Sentence i is fed as `base_ids[i]` + kept text prefix + current token + [SEP]. The current
+    token is chosen as mask, and left out of the prefix, when the score of the gold label is
+    already within `threshold` of `origin_scores[i]`. Only the first `max_text_len` text tokens
+    are fed to the model, like `sentence_inputs` does.
+
+    All sentences live in one preallocated id matrix sorted by text length (longest first), so
+    the sentences still running are always its leading rows and every step is a handful of
+    array writes. `score_fn(input_ids, lengths, segment_ids)` returns [n, num_labels] probs.
+    Returns the list of masked text positions of every sentence.
+
+    `threshold` is a scalar or one value per sentence. Rows with the same `groups` id must be
+    the same sentence; while their kept prefixes are identical they are scored only once.
+    With a `LoopCheckpoint`, the loop state is saved as it goes and a saved state is resumed.
+    """
+    N = len(text_ids)
+    all_mask_poses = [[] for _ in range(N)]
+    if N == 0:
+        return all_mask_poses
+
+    text_lens = np.array([len(t) for t in text_ids], dtype=np.int64)
+    order = np.argsort(-text_lens, kind="stable")
+    text_lens = text_lens[order]
+    base_lens = np.array([len(base_ids[i]) for i in order], dtype=np.int64)
+    texts, _ = pad_sequences([text_ids[i] for i in order], width=max(int(text_lens[0]), 1))
+    labels = np.asarray(labels, dtype=np.int64)[order]
+    origin_scores = np.asarray(origin_scores, dtype=np.float32)[order]
+    thresholds = np.broadcast_to(np.asarray(threshold, dtype=np.float32), (N,))[order]
+    if groups is not None:
+        groups = np.asarray(groups, dtype=np.int64)[order]
+
+    width = int(base_lens.max()) + max_text_len + 1
+    input_ids, _ = pad_sequences([base_ids[i] for i in order], width=width)
+    segment_ids = None
+    if text_segment_id != 0:
+        segment_ids = ((np.arange(width)[None, :] >= base_lens[:, None]) * text_segment_id).astype(np.int32)
+
+    kept = np.zeros(N, dtype=np.int64)
+    is_mask = np.zeros(texts.shape, dtype=np.bool_)
+    mask_pos = 0
+    state = None if checkpoint is None else checkpoint.load("greedy")
+    if state is not None and state["is_mask"].shape == is_mask.shape:
+        mask_pos, kept, is_mask = state["mask_pos"], state["kept"], state["is_mask"]
+        if groups is not None:
+            groups = state["groups"]
+        # rebuild the kept prefixes, ids after them are past the row lengths
+        for r in range(int((text_lens > mask_pos).sum())):
+            prefix = texts[r, :mask_pos][~is_mask[r, :mask_pos]][:max_text_len]
+            input_ids[r, base_lens[r]:base_lens[r] + len(prefix)] = prefix
+        logger.info("Resumed greedy mask search at position {}".format(mask_pos))
+    get_state = lambda: {"mask_pos": mask_pos, "kept": kept, "is_mask": is_mask, "groups": groups}
+
+    n = int((text_lens > mask_pos).sum())
+    while n > 0:
+        rows = np.arange(n)
+        # write the current token after the kept prefix, or only [SEP] once the window is full
+        in_window = kept[:n] < max_text_len
+        pos = base_lens[:n] + np.minimum(kept[:n], max_text_len)
+        input_ids[rows[in_window], pos[in_window]] = texts[rows[in_window], mask_pos]
+        sep_pos = np.where(in_window, pos + 1, pos)
+        input_ids[rows, sep_pos] = sep_id
+
+        if groups is None:
+            probs = score_fn(input_ids[:n], sep_pos + 1, None if segment_ids is None else segment_ids[:n])
+        else:
+            # score one representative row per group of identical inputs
+            _, first, inverse = np.unique(groups[:n], return_index=True, return_inverse=True)
+            probs = score_fn(input_ids[first], sep_pos[first] + 1, None if segment_ids is None else segment_ids[first])[inverse]
+        drop = origin_scores[:n] - probs[rows, labels[:n]] < thresholds[:n]
+        is_mask[rows[drop], mask_pos] = True
+        kept[:n] += ~drop
+        if groups is not None:
+            # rows of a group that took different decisions no longer share their prefix
+            _, groups[:n] = np.unique(groups[:n] * 2 + drop, return_inverse=True)
+
+        mask_pos += 1
+        n = int((text_lens > mask_pos).sum())
+        if checkpoint is not None:
+            checkpoint.maybe_save("greedy", get_state)
+
+    for r, i in enumerate(order):
+        all_mask_poses[i] = np.nonzero(is_mask[r])[0].tolist()
+    return all_mask_poses
+
+
+def prefix_candidates(base, kept, text, pos, num, drop, max_text_len, sep_id, width):
+    """Builds the inputs of text positions [pos, pos + num) assuming every one of them is kept
+    (growing prefixes) or dropped (kept prefix + single token). Returns ids [num, width] and lengths."""
+    block = np.zeros([num, width], dtype=np.int32)
+    nb = len(base)
+    block[:, :nb] = base
+    if not drop:
+        seq = (kept + text[pos:pos + num])[:max_text_len]
+        block[:, nb:nb + len(seq)] = seq
+        text_lens = np.minimum(len(kept) + np.arange(1, num + 1), max_text_len)
+    else:
+        k = min(len(kept), max_text_len)
+        block[:, nb:nb + k] = kept[:k]
+        if k < max_text_len:
+            block[:, nb + k] = text[pos:pos + num]
+            k += 1
+        text_lens = np.full(num, k, dtype=np.int64)
+    sep_pos = nb + text_lens
+    block[np.arange(num), sep_pos] = sep_id
+    return block, sep_pos + 1
+
+
+def speculative_prefix_mask(score_fn, base_ids, text_ids, labels, origin_scores, threshold, max_text_len, sep_id, text_segment_id=0,
+                            window=None, max_rows=1 << 18):
+    """All-prefixes variant of `greedy_prefix_mask`: same decisions, far fewer synchronous rounds.
+
+    Each round expands every undecided position of every sentence up front, assuming the coming
+    decisions repeat the last confirmed one, and scores all candidates as one length sorted stream.
+    The greedy decisions are then replayed on the cached scores up to and including the first one
+    that breaks the assumption. Only the suffix after it is expanded again in the next round, so a
+    sentence needs one round per keep/drop switch instead of one per token.
+
+    `window` caps the positions expanded per sentence and round. Sentences are processed in chunks
+    of at most `max_rows` candidate rows to bound host memory.
+    """
+    N = len(text_ids)
+    all_mask_poses = [[] for _ in range(N)]
+    labels = np.asarray(labels, dtype=np.int64)
+    origin_scores = np.asarray(origin_scores, dtype=np.float32)
+    if N == 0:
+        return all_mask_poses
+    width = max(len(base) for base in base_ids) + max_text_len + 1
+
+    rounds, scored_rows = 0, 0
+    begin = 0
+    while begin < N:
+        end, chunk_rows = begin, 0
+        while end < N and (end == begin or chunk_rows + len(text_ids[end]) <= max_rows):
+            chunk_rows += len(text_ids[end])
+            end += 1
+
+        pos = {i: 0 for i in range(begin, end)}
+        kept = {i: [] for i in range(begin, end)}
+        drop_hyp = {i: False for i in range(begin, end)}
+        active = [i for i in range(begin, end) if len(text_ids[i]) > 0]
+        while len(active) > 0:
+            blocks, block_lens, nums = [], [], []
+            for i in active:
+                num = len(text_ids[i]) - pos[i]
+                if window is not None:
+                    num = min(num, window)
+                block, block_len = prefix_candidates(base_ids[i], kept[i], list(text_ids[i]), pos[i], num, drop_hyp[i],
+                                                     max_text_len, sep_id, width)
+                blocks.append(block)
+                block_lens.append(block_len)
+                nums.append(num)
+            input_ids = np.concatenate(blocks)
+            lengths = np.concatenate(block_lens)
+            segment_ids = None
+            if text_segment_id != 0:
+                segment_ids = np.zeros(input_ids.shape, dtype=np.int32)
+                offset = 0
+                for i, num in zip(active, nums):
+                    segment_ids[offset:offset + num, len(base_ids[i]):] = text_segment_id
+                    offset += num
+            probs = score_fn(input_ids, lengths, segment_ids)
+            rounds += 1
+            scored_rows += len(lengths)
+
+            # replay the greedy decisions while the assumption behind the candidates holds
+            offset = 0
+            for i, num in zip(active, nums):
+                drop = origin_scores[i] - probs[offset:offset + num, labels[i]] < threshold
+                offset += num
+                switches = np.nonzero(drop != drop_hyp[i])[0]
+                confirmed = int(switches[0]) + 1 if len(switches) > 0 else num
+                for j in range(confirmed):
+                    if drop[j]:
+                        all_mask_poses[i].append(pos[i] + j)
+                    else:
+                        kept[i].append(text_ids[i][pos[i] + j])
+                pos[i] += confirmed
+                if len(switches) > 0:
+                    drop_hyp[i] = not drop_hyp[i]
+            active = [i for i in active if pos[i] < len(text_ids[i])]
+        begin = end
+
+    logger.info("speculative mask search: {} rounds, {} scored rows".format(rounds, scored_rows))
+    return all_mask_poses
+
+def group_prefix_mask(score_fn, base_ids, text_ids, labels, origin_scores, threshold, max_text_len, sep_id, text_segment_id=0,
+                      max_span=16):
+    """Adaptive group testing variant of `greedy_prefix_mask` that needs far fewer scorer calls.
+
+    A whole span of tokens is appended to the kept prefix and tested at once. If the gold score
+    stays within `threshold` of `origin_scores` every token of the span is masked and the next span
+    doubles (up to `max_span`). Otherwise the span is split in halves that are tested in order, down
+    to single tokens which get the exact greedy decision. Long runs of masked tokens therefore cost
+    a logarithmic number of evaluations. Decisions may differ from the greedy ones when a span
+    passes as a whole but one of its tokens would not pass on its own.
+    """
+    N = len(text_ids)
+    all_mask_poses = [[] for _ in range(N)]
+    labels = np.asarray(labels, dtype=np.int64)
+    origin_scores = np.asarray(origin_scores, dtype=np.float32)
+    if N == 0:
+        return all_mask_poses
+    width = max(len(base) for base in base_ids) + max_text_len + 1
+
+    pos = [0] * N
+    kept = [[] for _ in range(N)]
+    span_size = [1] * N
+    pending = [[] for _ in range(N)] # stack of spans still to test, left half on top
+    active = [i for i in range(N) if len(text_ids[i]) > 0]
+    evaluations = 0
+    while len(active) > 0:
+        input_ids = np.zeros([len(active), width], dtype=np.int32)
+        lengths = np.zeros(len(active), dtype=np.int64)
+        segment_ids = np.zeros([len(active), width], dtype=np.int32) if text_segment_id != 0 else None
+        for r, i in enumerate(active):
+            if len(pending[i]) == 0:
+                pending[i].append((pos[i], min(pos[i] + span_size[i], len(text_ids[i]))))
+            a, b = pending[i][-1]
+            seq = (kept[i] + list(text_ids[i][a:b]))[:max_text_len]
+            nb = len(base_ids[i])
+            input_ids[r, :nb] = base_ids[i]
+            input_ids[r, nb:nb + len(seq)] = seq
+            input_ids[r, nb + len(seq)] = sep_id
+            lengths[r] = nb + len(seq) + 1
+            if segment_ids is not None:
+                segment_ids[r, nb:] = text_segment_id
+
+        probs = score_fn(input_ids, lengths, segment_ids)
+        evaluations += len(active)
+        drop = origin_scores[active] - probs[np.arange(len(active)), labels[active]] < threshold
+
+        for r, i in enumerate(active):
+            a, b = pending[i].pop()
+            if drop[r]:
+                all_mask_poses[i].extend(range(a, b))
+                pos[i] = b
+                span_size[i] = min(span_size[i] * 2, max_span)
+            elif b - a == 1:
+                kept[i].append(text_ids[i][a])
+                pos[i] = b
+            else:
+                mid = (a + b) // 2
+                pending[i].append((mid, b))
+                pending[i].append((a, mid))
+                span_size[i] = max(span_size[i] // 2, 1)
+        active = [i for i in active if pos[i] < len(text_ids[i])]
+
+    greedy_evaluations = sum(len(text) for text in text_ids)
+    logger.info("group mask search: {} evaluations instead of {} ({} saved)".format(
+        evaluations, greedy_evaluations, greedy_evaluations - evaluations))
+    return all_mask_poses
+
+mask_searches = {
+    "greedy": greedy_prefix_mask,
+    "speculative": speculative_prefix_mask,
+    "group": group_prefix_mask
+}
+
+
+def sweep_prefix_mask(mask_search, score_fn, base_ids, text_ids, labels, origin_scores, thresholds, max_text_len, sep_id,
+                      text_segment_id=0, checkpoint=None):
+    """Runs a mask search for several thresholds at once. Returns one list of mask positions per threshold.
+
+    With the greedy search every sentence gets one row per threshold, and the rows of a sentence
+    share their model calls until their decisions diverge. Other searches run once per threshold.
+    With a `LoopCheckpoint` the greedy loop state is checkpointed, other searches resume per threshold.
+    """
+    T = len(thresholds)
+    if mask_search != "greedy":
+        all_mask_poses = [] if checkpoint is None else (checkpoint.load("search") or [])
+        for threshold in thresholds[len(all_mask_poses):]:
+            all_mask_poses.append(mask_searches[mask_search](score_fn, base_ids, text_ids, labels, origin_scores, threshold,
+                                                             max_text_len, sep_id, text_segment_id=text_segment_id))
+            if checkpoint is not None:
+                checkpoint.save("search", all_mask_poses)
+        return all_mask_poses
+    if T == 1:
+        return [greedy_prefix_mask(score_fn, base_ids, text_ids, labels, origin_scores, thresholds[0], max_text_len, sep_id,
+                                   text_segment_id=text_segment_id, checkpoint=checkpoint)]
+
+    N = len(text_ids)
+    rep = lambda L: [x for x in L for _ in range(T)]
+    all_mask_poses = greedy_prefix_mask(score_fn, rep(base_ids), rep(text_ids), rep(labels), rep(origin_scores),
+                                        list(thresholds) * N, max_text_len, sep_id, text_segment_id=text_segment_id,
+                                        groups=np.repeat(np.arange(N), T), checkpoint=checkpoint)
+    return [all_mask_poses[t::T] for t in range(T)]
+
+
 class SC(nn.Module):
-    def __init__(self, mask_rate, top_sen_rate, threshold, bert_model, do_lower_case, max_seq_length, label_list, sen_batch_size, use_gpu=True):
+    def __init__(self, mask_rate, top_sen_rate, threshold, bert_model, do_lower_case, max_seq_length, label_list, sen_batch_size, use_gpu=True, mask_search="greedy",
+                 score_cache=None, checkpoint=None, segment_workers=1,
+                 sentence_splitter="spacy"):
         super(SC, self).__init__()
+        self.checkpoint = checkpoint
+        self.mask_search = mask_search
         self.mask_rate = mask_rate 
         self.top_sen_rate = top_sen_rate
         self.threshold = threshold 
@@ -45,119 +422,99 @@ class SC(nn.Module):
         self.n_gpu = torch.cuda.device_count()
         self.sen_batch_size = sen_batch_size
         self.vocab = list(self.tokenizer.vocab.keys())
+        self.mask_kernel = MaskKernel(self.tokenizer.vocab, skip_stop_words=True)
         if self.n_gpu > 1:
             self.model = torch.nn.DataParallel(self.model)
+        self.engine = BucketedInference(self.model, self.device, self.sen_batch_size * self.max_seq_length, cache=score_cache)
+        self.sentence_tokenizer = SentenceTokenizer(self.tokenizer, segment_workers, splitter=sentence_splitter)
+
+    def evaluate(self, ids, offsets, batch_size):
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        all_input_ids, all_lengths = sentence_inputs(ids, offsets, self.max_seq_length - 2, cls_id, sep_id)
+        all_segment_ids = np.zeros_like(all_input_ids)
+
+        # same memory as `batch_size` rows of `max_seq_length`, but batches are only padded to their longest row
+        preds = self.engine.run(all_input_ids, all_lengths, self.predict_probs, segment_ids=all_segment_ids,
+                                max_tokens=batch_size * self.max_seq_length)
+        preds = np.asarray(preds, dtype=np.float32).reshape(-1, self.num_labels)
+        preds_arg = np.argmax(preds, axis=1)
+        return preds_arg, preds
+
+    def predict_probs(self, input_ids, input_mask, segment_ids):
+        logits = self.model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
+        return softmax(logits, dim=1).detach().cpu().numpy()
+
+    def score_ids(self, input_ids, lengths, segment_ids=None):
+        preds = self.engine.run(input_ids, lengths, self.predict_probs, segment_ids=segment_ids)
+        return np.asarray(preds, dtype=np.float32).reshape(-1, self.num_labels)
+
+    def create_reverse_mask(self, mask_poses, ids, gen):
+        """Masks `mask_rate` of the tokens outside `mask_poses` instead. Returns (positions, mask_ids)."""
+        cand_indexes = np.setdiff1d(np.arange(len(ids)), np.asarray(list(mask_poses), dtype=np.int64))
+        positions = np.sort(gen.permutation(cand_indexes)[0:max(1, int(self.mask_rate * len(ids)))])
+        return positions, self.mask_kernel.replace(ids[positions], gen)
 
-    def convert_examples_to_features(self, data):
-        features = []
-        for (ex_index, tokens_a) in enumerate(data):
-            if ex_index % 10000 == 0:
-                logger.info("Writing example %d of %d" % (ex_index, len(data)))
-            if len(tokens_a) > self.max_seq_length - 2:
-                tokens_a = tokens_a[:(self.max_seq_length - 2)]
-            tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-            
-            segment_ids = [0] * len(tokens)
-            input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-            input_mask = [1] * len(input_ids)
-            
-            padding = [0] * (self.max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
-
-            assert len(input_ids) == self.max_seq_length
-            assert len(input_mask) == self.max_seq_length
-            assert len(segment_ids) == self.max_seq_length
-
-            features.append(InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids))
-
-        return features
-
-    def evaluate(self, data, batch_size):
-        eval_features = self.convert_examples_to_features(data)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=batch_size)
-
-        self.model.eval()
-        preds = []
-        for input_ids, input_mask, segment_ids, in tqdm(eval_dataloader, desc="Evaluating"):
-            input_ids = input_ids.to(self.device)
-            input_mask = input_mask.to(self.device)
-            segment_ids = segment_ids.to(self.device)
-            with torch.no_grad():
-                logits = self.model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
-                logits = softmax(logits, dim=1)
-            if len(preds) == 0:
-                preds.append(logits.detach().cpu().numpy())
-            else:
-                preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
+    def forward(self, data, all_labels, dupe_factor, rng):
+        all_settings = self.forward_sweep(data, all_labels, dupe_factor, rng, [self.threshold], [self.top_sen_rate])
+        return all_settings[(self.threshold, self.top_sen_rate)]
 
-        preds_arg = np.argmax(preds[0], axis=1)
-        return preds_arg, preds[0]
+    def forward_sweep(self, data, all_labels, dupe_factor, rng, thresholds, top_sen_rates):
+        """Masks `data` for every (threshold, top_sen_rate) setting from one scoring run.
 
-    def create_mask(self, mask_poses, sen, rng):
-        masked_info = [{} for token in sen]
-        for pos in mask_poses:
-            lexeme = nlp.vocab[sen[pos]]
-            if lexeme.is_stop:
-                continue
-            if rng.random() < 0.8:
-                mask_token = "[MASK]"
-            else:
-                if rng.random() < 0.5:
-                    mask_token = sen[pos]
-                else:
-                    mask_token = self.vocab[rng.randint(0, len(self.vocab) - 1)]
-            masked_info[pos]["mask"] = mask_token
-            masked_info[pos]["label"] = sen[pos]
-        return masked_info
-
-    def create_reverse_mask(self, mask_poses, sen, rng):
-        reverse_mask_poses = [i for i in range(len(sen)) if i not in mask_poses]
-        rng.shuffle(reverse_mask_poses)
-        cand_indexes = reverse_mask_poses[0:max(1, int(self.mask_rate * len(sen)))]
-        masked_info = [{} for token in sen]
-        for cand_index in cand_indexes:
-            if rng.random() < 0.8:
-                mask_token = "[MASK]"
-            else:
-                if rng.random() < 0.5:
-                    mask_token = sen[cand_index]
-                else:
-                    mask_token = self.vocab[rng.randint(0, len(self.vocab) - 1)]
-            masked_info[cand_index]["mask"] = mask_token
-            masked_info[cand_index]["label"] = sen[cand_index]
-        return masked_info
-
-    def forward(self, data, all_labels, dupe_factor, rng):
+        Sentences are selected with the largest rate, the smaller rates keep a leading part of
+        each document's ranking. Returns an OrderedDict from setting to `all_documents`.
+        With a checkpoint, the selected sentences, the search loop and its result are saved
+        and a restarted run continues from the last of them.
+        """
+        doc_num = len(data)
+        selected = None if self.checkpoint is None else self.checkpoint.load("selected")
+        if selected is None:
+            selected = self.select_sentences(data, all_labels, max(top_sen_rates))
+            if self.checkpoint is not None:
+                self.checkpoint.save("selected", selected)
+        ids, offsets, sen_doc_ids = selected["ids"], selected["offsets"], selected["sen_doc_ids"]
+        right_sen_doc_poses, right_ranks = selected["right_sen_doc_poses"], selected["right_ranks"]
+
+        all_right_mask_poses = None if self.checkpoint is None else self.checkpoint.load("mask_poses")
+        if all_right_mask_poses is None:
+            right_sens_num = len(right_sen_doc_poses)
+            # tokenize once: the greedy loop works on preallocated id buffers
+            cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+            right_sen_ids = [ids[offsets[sen_doc_pos]:offsets[sen_doc_pos + 1]].tolist() for sen_doc_pos in right_sen_doc_poses]
+            all_right_mask_poses = sweep_prefix_mask(self.mask_search, self.score_ids, [[cls_id]] * right_sens_num, right_sen_ids,
+                                                     selected["right_labels"], selected["right_scores"], thresholds,
+                                                     self.max_seq_length - 2, sep_id, checkpoint=self.checkpoint)
+            self.engine.log_stats("SC")
+            if self.checkpoint is not None:
+                self.checkpoint.save("mask_poses", all_right_mask_poses)
+
+        all_settings = collections.OrderedDict()
+        for threshold, right_mask_poses in zip(thresholds, all_right_mask_poses):
+            for top_sen_rate in top_sen_rates:
+                mask_poses_d = {}
+                for sen_doc_pos, (rank, ds_len), mask_poses in zip(right_sen_doc_poses, right_ranks, right_mask_poses):
+                    if rank < max(int(top_sen_rate * ds_len), 1) and len(mask_poses) > 0:
+                        mask_poses_d[sen_doc_pos] = mask_poses
+                all_settings[(threshold, top_sen_rate)] = self.create_documents(ids, offsets, sen_doc_ids, doc_num, mask_poses_d,
+                                                                                dupe_factor, rng)
+        return all_settings
+
+    def select_sentences(self, data, all_labels, top_sen_rate):
+        """Segments and scores all sentences, then keeps the top `top_sen_rate` right sentences of every document."""
         # convert label to ids
         doc_num = len(data)
         label_map = {label : i for i, label in enumerate(self.label_list)}
         all_label_ids = [label_map[label] for label in all_labels]
         
         # convert data, segment data to sentences
-        sentences = []
-        sen_doc_ids = [] # [0, 0, ..., 0, 1, 1, ..., 1, ...]
-        for (doc_id, doc) in enumerate(data):
-            doc = nlp(doc)
-            tL = [self.tokenizer.tokenize(sen.text) for sen in doc.sents]
-            sentences.extend(tL)
-            sen_doc_ids.extend([doc_id] * len(tL))
+        ids, offsets, sen_doc_ids = self.sentence_tokenizer(data)
 
         logger.info("Begin eval for all sentence")
-        sens_preds, sens_pred_scores = self.evaluate(sentences, self.sen_batch_size)
+        sens_preds, sens_pred_scores = self.evaluate(ids, offsets, self.sen_batch_size)
 
-        right_sens = [] 
-        right_preds = [] 
         right_scores = [] 
-        right_sen_doc_ids = [] 
         right_sen_doc_poses = [] 
+        right_ranks = [] # (rank in its document, number of right sentences of the document)
         i = 0
         for doc_id in range(doc_num):
             ds = []
@@ -166,78 +523,29 @@ class SC(nn.Module):
                 doc_ground_truth = all_label_ids[doc_id]
                 # compare with ground truth
                 if doc_ground_truth == sen_pred:
-                    ds.append((sentences[i], doc_id, i, sen_pred, sens_pred_scores[i][doc_ground_truth]))
+                    ds.append((i, sens_pred_scores[i][doc_ground_truth]))
                 i += 1
             if len(ds) == 0:
                 continue
             ds = sorted(ds, key=lambda x : x[-1], reverse=True)
-            t_sen, t_sen_doc_id, t_sen_doc_pos, t_pred, t_score = zip(*ds[0:max(int(self.top_sen_rate * len(ds)), 1)])  # select top sentences
-            right_sens.extend(t_sen)
-            right_preds.extend(t_pred)
+            t_sen_doc_pos, t_score = zip(*ds[0:max(int(top_sen_rate * len(ds)), 1)])  # select top sentences
             right_scores.extend(t_score)
-            right_sen_doc_ids.extend(t_sen_doc_id)
             right_sen_doc_poses.extend(t_sen_doc_pos)
-        
-        right_sens_num = len(right_sens)
-        # convert right sentence to reverse
+            right_ranks.extend((rank, len(ds)) for rank in range(len(t_sen_doc_pos)))
 
-        masked_sens = []
-        masked_item_infos = []
-        
-        # init
-        for sen_right_id, (sen_doc_pos, sen) in enumerate(zip(right_sen_doc_poses, right_sens)):
-            masked_sens.append(sen[0:1])
-            masked_item_infos.append({"sen_doc_pos": sen_doc_pos, "sen_right_id": sen_right_id, "doc_ground_truth": all_label_ids[sen_doc_ids[sen_doc_pos]]})
+        right_labels = [all_label_ids[sen_doc_ids[sen_doc_pos]] for sen_doc_pos in right_sen_doc_poses]
+        return {"ids": ids, "offsets": offsets, "sen_doc_ids": sen_doc_ids, "right_sen_doc_poses": right_sen_doc_poses,
+                "right_ranks": right_ranks, "right_scores": right_scores, "right_labels": right_labels}
 
-        mask_poses_d = {}
-        mask_pos = 0
-
-        while len(masked_sens) != 0:
-            _, mask_sens_scores = self.evaluate(masked_sens, self.sen_batch_size)
-            masked_sens_num = len(masked_sens)
-            temp_masked_sens = []
-            temp_masked_item_infos = []
-            for masked_sen, masked_item_info, mask_sens_score in zip(masked_sens, masked_item_infos, mask_sens_scores):
-                sen_doc_pos = masked_item_info["sen_doc_pos"]
-                doc_ground_truth = masked_item_info["doc_ground_truth"]
-                sen_right_id = masked_item_info["sen_right_id"]
-                origin_score = right_scores[sen_right_id]
-                if origin_score - mask_sens_score[doc_ground_truth] < self.threshold:
-                    # choose as mask
-                    if sen_doc_pos in mask_poses_d:
-                        mask_poses_d[sen_doc_pos].append(mask_pos)
-                    else:
-                        mask_poses_d[sen_doc_pos] = [mask_pos]
-                    masked_sen.pop()
-                
-                # add next token
-                if mask_pos + 1 < len(right_sens[sen_right_id]):
-                    masked_sen.append(right_sens[sen_right_id][mask_pos + 1])
-                    temp_masked_sens.append(masked_sen)
-                    temp_masked_item_infos.append(masked_item_info)
-                
-                masked_sens = temp_masked_sens
-                masked_item_infos = temp_masked_item_infos
-            mask_pos += 1       
-
-        all_documents = []
-
-        for _ in range(dupe_factor):
-            i = 0
-            for doc_id in tqdm(range(doc_num), desc="Generating All Documents"):
-                all_documents.append([])
-                while i < len(sen_doc_ids) and doc_id == sen_doc_ids[i]:
-                    mask_poses = []
-                    if i in mask_poses_d:
-                        mask_poses = mask_poses_d[i]
-                    m_info = self.create_mask(mask_poses, sentences[i], rng)
-                    all_documents[-1].append(MaskedTokenInstance(tokens=sentences[i], info=m_info))
-                    i += 1
-        return all_documents
+    def create_documents(self, ids, offsets, sen_doc_ids, doc_num, mask_poses_d, dupe_factor, rng):
+        return self.mask_kernel.mask_sentences(ids, offsets, sen_doc_ids, doc_num, mask_poses_d, dupe_factor, rng)
 
 class ASC(nn.Module):
-    def __init__(self, mask_rate, top_sen_rate, threshold, bert_model, do_lower_case, max_seq_length, label_list, sen_batch_size, use_gpu=True):
+    def __init__(self, mask_rate, top_sen_rate, threshold, bert_model, do_lower_case, max_seq_length, label_list, sen_batch_size, use_gpu=True, mask_search="greedy",
+                 score_cache=None, checkpoint=None):
         super(ASC, self).__init__()
+        self.checkpoint = checkpoint
+        self.mask_search = mask_search
         self.mask_rate = mask_rate 
         self.top_sen_rate = top_sen_rate 
         self.threshold = threshold
@@ -252,54 +560,31 @@ class ASC(nn.Module):
         self.n_gpu = torch.cuda.device_count()
         self.sen_batch_size = sen_batch_size
         self.vocab = list(self.tokenizer.vocab.keys())
+        self.mask_kernel = MaskKernel(self.tokenizer.vocab, skip_stop_words=True)
         if self.n_gpu > 1:
             self.model = torch.nn.DataParallel(self.model)
+        self.engine = BucketedInference(self.model, self.device, self.sen_batch_size * self.max_seq_length, cache=score_cache)
     
     def evaluate(self, data, batch_size):
         eval_features = self.convert_examples_to_features(data)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=batch_size)
-
-        self.model.eval()
-        preds = []
-        for input_ids, input_mask, segment_ids, in tqdm(eval_dataloader, desc="Evaluating"):
-            input_ids = input_ids.to(self.device)
-            input_mask = input_mask.to(self.device)
-            segment_ids = segment_ids.to(self.device)
-            with torch.no_grad():
-                logits = self.model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
-                logits = softmax(logits, dim=1)
-            if len(preds) == 0:
-                preds.append(logits.detach().cpu().numpy())
-            else:
-                preds[0] = np.append(preds[0], logits.detach().cpu().numpy(), axis=0)
+        all_input_ids, all_lengths = pad_sequences([f.input_ids for f in eval_features])
+        all_segment_ids, _ = pad_sequences([f.segment_ids for f in eval_features])
+        del eval_features
 
-        preds_arg = np.argmax(preds[0], axis=1)
-        return preds_arg, preds[0]
+        # same memory as `batch_size` rows of `max_seq_length`, but batches are only padded to their longest row
+        preds = self.engine.run(all_input_ids, all_lengths, self.predict_probs, segment_ids=all_segment_ids,
+                                max_tokens=batch_size * self.max_seq_length)
+        preds = np.asarray(preds, dtype=np.float32).reshape(-1, self.num_labels)
+        preds_arg = np.argmax(preds, axis=1)
+        return preds_arg, preds
 
-    def create_mask(self, mask_poses, sen, rng):
-        masked_info = [{} for token in sen]
-        for pos in mask_poses:
-            lexeme = nlp.vocab[sen[pos]]
-            if lexeme.is_stop:
-                # print("stop words: ", sen[pos])
-                continue
-            if rng.random() < 0.8:
-                mask_token = "[MASK]"
-            else:
-                if rng.random() < 0.5:
-                    mask_token = sen[pos]
-                else:
-                    mask_token = self.vocab[rng.randint(
-                        0, len(self.vocab) - 1)]
-            masked_info[pos]["mask"] = mask_token
-            masked_info[pos]["label"] = sen[pos]
-        return masked_info
+    def predict_probs(self, input_ids, input_mask, segment_ids):
+        logits = self.model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
+        return softmax(logits, dim=1).detach().cpu().numpy()
+
+    def score_ids(self, input_ids, lengths, segment_ids=None):
+        preds = self.engine.run(input_ids, lengths, self.predict_probs, segment_ids=segment_ids)
+        return np.asarray(preds, dtype=np.float32).reshape(-1, self.num_labels)
 
     def convert_examples_to_features(self, data):
         features = []
@@ -313,21 +598,63 @@ class ASC(nn.Module):
             segment_ids = [0] * (len(tokens_a) + 2) + [1] * (len(tokens_b) + 1)
             input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
             input_mask = [1] * len(input_ids)
-        
-            padding = [0] * (self.max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
-            assert len(input_ids) == self.max_seq_length
-            assert len(input_mask) == self.max_seq_length
-            assert len(segment_ids) == self.max_seq_length
+
+            # padding is done per batch in `evaluate`
             features.append(InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids))
 
         return features
 
     def forward(self, data, all_labels, dupe_factor, rng):
-        # data[i]: {"text": ... , "facts": ["aspect1": label1, "aspect2": label2, ...]}
+        all_settings = self.forward_sweep(data, all_labels, dupe_factor, rng, [self.threshold], [self.top_sen_rate])
+        return all_settings[(self.threshold, self.top_sen_rate)]
+
+    def forward_sweep(self, data, all_labels, dupe_factor, rng, thresholds, top_sen_rates):
+        """Masks `data` for every (threshold, top_sen_rate) setting from one scoring run.
+
+        ASC uses every right sentence, so settings that only differ in `top_sen_rate` share their masks.
+        With a checkpoint, the scored sentences, the search loop and its result are saved and a
+        restarted run continues from the last of them.
+        """
         doc_num = len(data)
+        selected = None if self.checkpoint is None else self.checkpoint.load("selected")
+        if selected is None:
+            selected = self.select_sentences(data)
+            if self.checkpoint is not None:
+                self.checkpoint.save("selected", selected)
+        texts, right_sens, right_sen_doc_ids = selected["texts"], selected["right_sens"], selected["right_sen_doc_ids"]
+
+        all_right_mask_poses = None if self.checkpoint is None else self.checkpoint.load("mask_poses")
+        if all_right_mask_poses is None:
+            # tokenize once: the greedy loop works on preallocated id buffers
+            cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+            text_ids = [self.tokenizer.convert_tokens_to_ids(text) for text in texts]
+            right_base_ids = [[cls_id] + self.tokenizer.convert_tokens_to_ids(sen["aspect"]) + [sep_id] for sen in right_sens]
+            right_text_ids = [text_ids[doc_id] for doc_id in right_sen_doc_ids]
+            right_labels = [sen["label"] for sen in right_sens]
+            all_right_mask_poses = sweep_prefix_mask(self.mask_search, self.score_ids, right_base_ids, right_text_ids, right_labels,
+                                                     selected["right_scores"], thresholds, self.max_seq_length - 2, sep_id,
+                                                     text_segment_id=1, checkpoint=self.checkpoint)
+            self.engine.log_stats("ASC")
+            if self.checkpoint is not None:
+                self.checkpoint.save("mask_poses", all_right_mask_poses)
+
+        ids, offsets = self.mask_kernel.to_ids(texts)
+        all_settings = collections.OrderedDict()
+        for threshold, right_mask_poses in zip(thresholds, all_right_mask_poses):
+            mask_poses_L = [set() for i in range(doc_num)]
+            for right_sen_doc_id, mask_poses in zip(right_sen_doc_ids, right_mask_poses):
+                mask_poses_L[right_sen_doc_id].update(mask_poses)
+
+            for top_sen_rate in top_sen_rates:
+                # one document per text
+                all_settings[(threshold, top_sen_rate)] = self.mask_kernel.mask_sentences(
+                    ids, offsets, range(doc_num), doc_num, dict(enumerate(mask_poses_L)), dupe_factor, rng)
+
+        return all_settings
+
+    def select_sentences(self, data):
+        """Tokenizes all (aspect, text) pairs and keeps the right ones with their gold label scores."""
+        # data[i]: {"text": ... , "facts": ["aspect1": label1, "aspect2": label2, ...]}
         label_map = {label : i for i, label in enumerate(self.label_list)}
         
         sen_doc_ids = []
@@ -348,59 +675,105 @@ class ASC(nn.Module):
         right_sens = []
         right_scores = []
         right_sen_doc_ids = []
-        i = 0
         for sen_id in range(len(sentences)):
             if sens_preds[sen_id] == sentences[sen_id]["label"]:
                 right_sens.append(sentences[sen_id])
                 right_sen_doc_ids.append(sen_doc_ids[sen_id])
                 right_scores.append(sens_pred_scores[sen_id][sentences[sen_id]["label"]])
+        return {"texts": texts, "right_sens": right_sens, "right_scores": right_scores, "right_sen_doc_ids": right_sen_doc_ids}
+
+class SaliencyGen(nn.Module):
+    """Rule mode masks from one forward + backward pass of the finetuned classifier.
+
+    Token importance is gradient x input on the word embeddings. Sentences are selected like
+    `SC` (correctly predicted, top `top_sen_rate` per document), then the top `mask_rate`
+    tokens whose share of the sentence saliency reaches `threshold` are masked. `threshold` is
+    create_data.py's --saliency_threshold, not the probability drop of `SC`.
+    """
+    def __init__(self, mask_rate, top_sen_rate, threshold, bert_model, do_lower_case, max_seq_length, label_list, sen_batch_size, use_gpu=True,
+                 segment_workers=1, sentence_splitter="spacy"):
+        super(SaliencyGen, self).__init__()
+        self.mask_rate = mask_rate
+        self.top_sen_rate = top_sen_rate
+        self.threshold = threshold
+        self.label_list = label_list
+        self.num_labels = len(self.label_list)
+        self.max_seq_length = max_seq_length
+        self.tokenizer = BertTokenizer.from_pretrained(bert_model, do_lower_case=do_lower_case)
+        self.model = BertForSequenceClassification.from_pretrained(bert_model, num_labels=self.num_labels)
+        self.device = torch.device("cuda" if torch.cuda.is_available() and use_gpu else "cpu")
+        self.model.to(self.device)
+        self.sen_batch_size = sen_batch_size
+        self.vocab = list(self.tokenizer.vocab.keys())
+        self.mask_kernel = MaskKernel(self.tokenizer.vocab, skip_stop_words=True)
+        # not wrapped in DataParallel: the embedding hook below must see the embeddings of the whole batch
+        self.embedding_output = None
+        self.model.bert.embeddings.word_embeddings.register_forward_hook(self.keep_embedding_output)
+        self.engine = BucketedInference(self.model, self.device, self.sen_batch_size * self.max_seq_length)
+        self.sentence_tokenizer = SentenceTokenizer(self.tokenizer, segment_workers, splitter=sentence_splitter)
+
+    def keep_embedding_output(self, module, inputs, output):
+        self.embedding_output = output
+
+    def predict_saliency(self, input_ids, input_mask, segment_ids):
+        logits = self.model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
+        probs = softmax(logits, dim=1)
+        # only correctly predicted sentences are used, so the predicted label is the gold one
+        target = probs.max(dim=1)[0].sum()
+        grads, = torch.autograd.grad(target, self.embedding_output)
+        saliency = (grads * self.embedding_output).sum(dim=2).abs() * input_mask.float()
+        probs = probs.detach().cpu().numpy()
+        saliency = saliency.detach().cpu().numpy()
+        lengths = input_mask.sum(dim=1).detach().cpu().numpy()
+        # saliency without [CLS] and [SEP]
+        return [(p, sal[1:l - 1]) for p, sal, l in zip(probs, saliency, lengths)]
+
+    def select_mask_poses(self, saliency, sen_len):
+        total = saliency.sum()
+        if total <= 0:
+            return []
+        share = saliency / total
+        max_mask_num = int(max(1, self.mask_rate * sen_len))
+        top = np.argsort(-share, kind="stable")[0:max_mask_num]
+        return sorted(int(pos) for pos in top if share[pos] >= self.threshold)
 
-        masked_sens = []
-        masked_item_infos = []
-        
-        # init
-        for sen_right_id, sen in enumerate(right_sens):
-            masked_sens.append({"text": sen["text"][0:1], "aspect": sen["aspect"], "label": sen["label"], "sen_right_id": sen_right_id})
-
-        mask_poses_L = [set() for i in range(doc_num)]
-        mask_pos = 0
-        while len(masked_sens) != 0:
-            _, mask_sens_scores = self.evaluate(masked_sens, self.sen_batch_size)
-            masked_sens_num = len(masked_sens)
-            temp_masked_sens = []
-            temp_masked_item_infos = []
-            for masked_sen, mask_sens_score in zip(masked_sens, mask_sens_scores):
-                doc_ground_truth = masked_sen["label"]
-                sen_right_id = masked_sen["sen_right_id"]
-                origin_score = right_scores[sen_right_id]
-                right_sen_doc_id = right_sen_doc_ids[sen_right_id]
-
-                if origin_score - mask_sens_score[doc_ground_truth] < self.threshold:
-                    mask_poses_L[right_sen_doc_id].add(mask_pos)
-                    masked_sen["text"].pop()
-                
-                if mask_pos + 1 < len(right_sens[sen_right_id]["text"]):
-                    masked_sen["text"].append(right_sens[sen_right_id]["text"][mask_pos + 1])
-                    temp_masked_sens.append(masked_sen)
-                
-                masked_sens = temp_masked_sens
-            mask_pos += 1       
+    def forward(self, data, all_labels, dupe_factor, rng):
+        doc_num = len(data)
+        label_map = {label : i for i, label in enumerate(self.label_list)}
+        all_label_ids = [label_map[label] for label in all_labels]
 
-        
-        all_documents = []
-        for doc_id in range(doc_num):
-            mask_poses = mask_poses_L[doc_id]
+        ids, offsets, sen_doc_ids = self.sentence_tokenizer(data)
 
-        for _ in range(dupe_factor):
-            for doc_id in tqdm(range(doc_num), desc="Generating All Documents"):
-                mask_poses = mask_poses_L[doc_id]
-                m_info = self.create_mask(mask_poses, texts[doc_id], rng)
-                all_documents.append([MaskedTokenInstance(tokens=texts[doc_id], info=m_info)])
+        logger.info("Begin saliency for all sentence")
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        all_input_ids, all_lengths = sentence_inputs(ids, offsets, self.max_seq_length - 2, cls_id, sep_id)
+        outputs = self.engine.run(all_input_ids, all_lengths, self.predict_saliency, grad=True, desc="Saliency")
 
-        return all_documents
+        # select right sentences as `SC` does, then mask by saliency
+        mask_poses_d = {}
+        i = 0
+        for doc_id in range(doc_num):
+            ds = []
+            doc_ground_truth = all_label_ids[doc_id]
+            while i < len(sen_doc_ids) and sen_doc_ids[i] == doc_id:
+                probs = outputs[i][0]
+                if np.argmax(probs) == doc_ground_truth:
+                    ds.append((i, probs[doc_ground_truth]))
+                i += 1
+            if len(ds) == 0:
+                continue
+            ds = sorted(ds, key=lambda x : x[-1], reverse=True)
+            for sen_doc_pos, _ in ds[0:max(int(self.top_sen_rate * len(ds)), 1)]:
+                mask_poses = self.select_mask_poses(outputs[sen_doc_pos][1], offsets[sen_doc_pos + 1] - offsets[sen_doc_pos])
+                if len(mask_poses) > 0:
+                    mask_poses_d[sen_doc_pos] = mask_poses
+
+        return self.mask_kernel.mask_sentences(ids, offsets, sen_doc_ids, doc_num, mask_poses_d, dupe_factor, rng)
 
 class ModelGen(nn.Module):
-    def __init__(self, mask_rate, bert_model, do_lower_case, max_seq_length, sen_batch_size, with_rand=False, use_gpu=True):
+    def __init__(self, mask_rate, bert_model, do_lower_case, max_seq_length, sen_batch_size, with_rand=False, use_gpu=True,
+                 score_cache=None, segment_workers=1,
+                 sentence_splitter="spacy"):
         super(ModelGen, self).__init__()
         self.mask_rate = mask_rate
         self.max_seq_length = max_seq_length
@@ -411,119 +784,78 @@ class ModelGen(nn.Module):
         self.n_gpu = torch.cuda.device_count()
         self.sen_batch_size = sen_batch_size
         self.vocab = list(self.tokenizer.vocab.keys())
+        self.mask_kernel = MaskKernel(self.tokenizer.vocab)
         self.with_rand = with_rand
         if self.n_gpu > 1:
             self.model = torch.nn.DataParallel(self.model)
+        self.engine = BucketedInference(self.model, self.device, self.sen_batch_size * self.max_seq_length, cache=score_cache)
+        self.sentence_tokenizer = SentenceTokenizer(self.tokenizer, segment_workers, splitter=sentence_splitter)
     
-    def create_mask(self, mask_poses, sen, rng):
-        masked_info = [{} for token in sen]
-        for pos in mask_poses:
-            if rng.random() < 0.8:
-                mask_token = "[MASK]"
-            else:
-                if rng.random() < 0.5:
-                    mask_token = sen[pos]
-                else:
-                    mask_token = self.vocab[rng.randint(0, len(self.vocab) - 1)]
-            masked_info[pos]["mask"] = mask_token
-            masked_info[pos]["label"] = sen[pos]
-        return masked_info
-
-    def convert_examples_to_features(self, data):
-        features = []
-        for tokens in tqdm(data, desc="converting to features"):
-            if len(tokens) >= self.max_seq_length - 1:
-                tokens = tokens[0:(self.max_seq_length - 2)]
-            ntokens = []
-            ntokens.append("[CLS]")
-            for token in tokens:
-                ntokens.append(token)
-            ntokens.append("[SEP]")
-            input_ids = self.tokenizer.convert_tokens_to_ids(ntokens)
-            input_mask = [1] * len(input_ids)
-            while len(input_ids) < self.max_seq_length:
-                input_ids.append(0)
-                input_mask.append(0)
-        
-            features.append(InputFeatures(input_ids=input_ids, input_mask=input_mask))
-
-        return features
-
-    def evaluate(self, data, batch_size):
-        eval_features = self.convert_examples_to_features(data)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        del eval_features
-        eval_data = TensorDataset(all_input_ids, all_input_mask)
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=batch_size)
-
-        self.model.eval()
-        preds = []
-        all_res = []
-        all_logits = []
-        for input_ids, input_mask in tqdm(eval_dataloader, desc="Evaluating"):
-            input_ids = input_ids.to(self.device)
-            input_mask = input_mask.to(self.device)
-            with torch.no_grad():
-                logits = self.model(input_ids, attention_mask=input_mask)
-
-            res = torch.argmax(logits, dim=2).detach().cpu().numpy()
-            logits = logits.detach().cpu().numpy()
-            all_res.extend(res)
-            all_logits.extend(logits)
-        
-        N = len(all_res)
-        for i in tqdm(range(0, N), desc="Begin CPU"):
-            r, m, l = all_res[i], all_input_mask[i], all_logits[i]
-            K = len(m)
-            t = []
-            for j in range(1, K):
-                mm, rr, ll = m[j], r[j], l[j]
-                if mm == 1:
-                    t.append((rr, ll[rr]))
-            t.pop() # pop out [SEP]
-            preds.append(t)
-        return preds
-
+    def evaluate(self, ids, offsets, batch_size):
+        """Returns the selected mask positions of all sentences as one flat array plus offsets."""
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        all_input_ids, all_lengths = sentence_inputs(ids, offsets, self.max_seq_length - 2, cls_id, sep_id)
+        # the positions depend on mask_rate and max_seq_length, so does the cache entry
+        preds = self.engine.run(all_input_ids, all_lengths, self.predict_mask_poses,
+                                max_tokens=batch_size * self.max_seq_length,
+                                cache_name="predict_mask_poses_{}_{}".format(self.mask_rate, self.max_seq_length))
+        if len(preds) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+        return preds.values, preds.offsets
+
+    def predict_mask_poses(self, input_ids, input_mask, segment_ids):
+        """Token positions predicted as mask (label 1), best first, at most `mask_rate` of the sentence.
+
+        Positions do not count [CLS]. Rows filling `max_seq_length` may be truncated sentences, so
+        all their candidates are kept and `mask_documents` cuts them with the full sentence length.
+        """
+        logits = self.model(input_ids, attention_mask=input_mask)
+        lengths = input_mask.sum(dim=1)
+        positions = torch.arange(input_ids.size(1), device=input_ids.device).unsqueeze(0)
+        cand = (torch.argmax(logits, dim=2) == 1) & (positions >= 1) & (positions < lengths.unsqueeze(1) - 1)
+        scores = logits[:, :, 1].masked_fill(~cand, float("-inf"))
+        sen_len = torch.clamp(lengths - 2, min=0)
+        max_mask_num = torch.where(sen_len + 2 >= self.max_seq_length, sen_len,
+                                   torch.clamp((sen_len.double() * self.mask_rate).floor().long(), min=1))
+        num = torch.min(cand.sum(dim=1), max_mask_num)
+        # stable, so equal scores keep their token order
+        order = torch.sort(scores, dim=1, descending=True, stable=True)[1]
+        poses = (order - 1)[positions < num.unsqueeze(1)]
+        offsets = np.zeros(len(num) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(num.cpu().numpy())
+        return RaggedRows(poses.to(torch.int32).cpu().numpy(), offsets)
 
     def forward(self, data, all_labels, dupe_factor, rng):
-        # data: not tokenized
-        doc_num = len(data)
+        # data: document texts or a TokenizedCorpus
+        ids, offsets, sen_doc_ids = self.split_sentences(data)
+        return self.mask_documents(ids, offsets, sen_doc_ids, len(data), dupe_factor, rng)
+
+    def split_sentences(self, data):
         # convert data, segment data to sentences
-        sentences = []
-        sen_doc_ids = []  # [0, 0, ..., 0, 1, 1, ..., 1, ...] 
-        for (doc_id, doc) in enumerate(tqdm(data)):
-            doc = nlp(doc)
-            tL = [self.tokenizer.tokenize(sen.text) for sen in doc.sents]
-            sentences.extend(tL)
-            sen_doc_ids.extend([doc_id] * len(tL))
-            del tL
+        return self.sentence_tokenizer(data)
+
+    def mask_documents(self, ids, offsets, sen_doc_ids, doc_num, dupe_factor, rng):
+        all_mask_poses, pred_offsets = self.evaluate(ids, offsets, self.sen_batch_size)
+        self.engine.log_stats("ModelGen")
 
-        preds = self.evaluate(sentences, self.sen_batch_size)
+        # the first `mask_rate` of every sentence's predicted positions, best first
+        max_mask_num = np.maximum(1, self.mask_rate * np.diff(offsets)).astype(np.int64)
+        seg = np.repeat(np.arange(len(offsets) - 1), np.diff(pred_offsets))
+        keep = np.arange(len(all_mask_poses)) - pred_offsets[:-1][seg] < max_mask_num[seg]
+        positions = offsets[:-1][seg[keep]] + all_mask_poses[keep]
+        num_masked = np.bincount(seg[keep], minlength=len(offsets) - 1)
 
+        gen = self.mask_kernel.generator(rng)
         all_documents = []
         rand_all_documents = []
         for _ in range(dupe_factor):
-            i = 0
-            for doc_id in tqdm(range(doc_num), desc="Generating All Documents"):
-                all_documents.append([])
-                if self.with_rand:
-                    rand_all_documents.append([])
-                while i < len(sen_doc_ids) and doc_id == sen_doc_ids[i]:
-                    mask_poses = [(pos, pred[1]) for (pos, pred) in enumerate(preds[i]) if pred[0] == 1]
-                    mask_poses = sorted(mask_poses, key=lambda x: x[1], reverse=True)
-                    max_mask_num = int(max(1, self.mask_rate * len(sentences[i])))
-                    mask_poses = [pos for pos, _ in mask_poses[0:max_mask_num]]
-                    m_info = self.create_mask(mask_poses, sentences[i], rng)
-                    all_documents[-1].append(MaskedTokenInstance(tokens=sentences[i], info=m_info))
-                    if self.with_rand:
-                        cand_indexes = [i for i in range(len(sentences[i]))]
-                        rng.shuffle(cand_indexes)
-                        rand_mask_poses = cand_indexes[0:len(mask_poses)]
-                        rand_m_info = self.create_mask(rand_mask_poses, sentences[i], rng)
-                        rand_all_documents[-1].append(MaskedTokenInstance(tokens=sentences[i], info=rand_m_info))
-                    i += 1
+            instances = self.mask_kernel.split(ids, offsets, *self.mask_kernel.mask(ids, positions, gen))
+            all_documents.extend(group_documents(instances, sen_doc_ids, doc_num))
+            if self.with_rand:
+                # as many random positions as the model masked
+                rand_positions = self.mask_kernel.sample(offsets, num_masked, gen)
+                instances = self.mask_kernel.split(ids, offsets, *self.mask_kernel.mask(ids, rand_positions, gen))
+                rand_all_documents.extend(group_documents(instances, sen_doc_ids, doc_num))
         if self.with_rand:
             print("with rand")
             return all_documents, rand_all_documents
@@ -0,0 +1,125 @@
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+sys.path.append("../")
+from model.modeling_classification import CONFIG_NAME, WEIGHTS_NAME
+
+logger = logging.getLogger(__name__)
+
+
+def model_fingerprint(bert_model, chunk_size=1 << 20):
+    """sha1 of the config and weights of a model directory, or of the name for shortcut models."""
+    h = hashlib.sha1()
+    if not os.path.isdir(bert_model):
+        h.update(bert_model.encode("utf-8"))
+        return h.hexdigest()
+    for name in [CONFIG_NAME, WEIGHTS_NAME]:
+        path = os.path.join(bert_model, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class ScoreCache(object):
+    """Persistent model outputs keyed on model checkpoint + forward function + input ids.
+
+    Entries live in one SQLite file that several processes (e.g. one per data part) can
+    share. The file is bounded to `max_size_mb` of stored outputs, least recently used
+    entries are evicted first.
+    """
+    def __init__(self, cache_dir, bert_model, max_size_mb=1024):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, "scores.sqlite")
+        self.fingerprint = model_fingerprint(bert_model)
+        self.max_size = int(max_size_mb * (1 << 20))
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self.conn = sqlite3.connect(self.path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('size', 0)")
+        logger.info("Score cache {} for model {}".format(self.path, self.fingerprint))
+
+    def key(self, namespace, input_ids, segment_ids=None):
+        h = hashlib.sha1()
+        h.update(self.fingerprint.encode("utf-8"))
+        h.update(namespace.encode("utf-8"))
+        h.update(input_ids.astype("<i4").tobytes())
+        if segment_ids is not None:
+            h.update(b"|")
+            h.update(segment_ids.astype("<i4").tobytes())
+        return h.digest()
+
+    def get_many(self, keys, chunk_size=500):
+        """Returns {key: value} for the cached keys and marks them as recently used."""
+        found = {}
+        for begin in range(0, len(keys), chunk_size):
+            chunk = keys[begin:begin + chunk_size]
+            rows = self.conn.execute("SELECT key, value FROM scores WHERE key IN ({})".format(",".join("?" * len(chunk))),
+                                     chunk).fetchall()
+            for key, value in rows:
+                found[bytes(key)] = pickle.loads(value)
+        if len(found) > 0:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany("UPDATE scores SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Stores (key, value) pairs, then evicts the least recently used entries above the size bound."""
+        if len(items) == 0:
+            return
+        now = time.time()
+        rows = []
+        for key, value in items:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, value, len(value), now))
+        with self.conn:
+            # replaced entries give back their size first
+            replaced = 0
+            for key, _, _, _ in rows:
+                size = self.conn.execute("SELECT size FROM scores WHERE key = ?", (key,)).fetchone()
+                if size is not None:
+                    replaced += size[0]
+            self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)", rows)
+            self.conn.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (sum(r[2] for r in rows) - replaced,))
+            self.evict()
+
+    def evict(self, chunk_size=1000):
+        total = self.conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+        while total > self.max_size:
+            rows = self.conn.execute("SELECT key, size FROM scores ORDER BY last_used LIMIT ?", (chunk_size,)).fetchall()
+            if len(rows) == 0:
+                break
+            freed, victims = 0, []
+            for key, size in rows:
+                if total - freed <= self.max_size:
+                    break
+                freed += size
+                victims.append((key,))
+            self.conn.executemany("DELETE FROM scores WHERE key = ?", victims)
+            self.conn.execute("UPDATE meta SET value = value - ? WHERE name = 'size'", (freed,))
+            self.evicted += len(victims)
+            total -= freed
+
+    def log_stats(self, name):
+        logger.info("{}: score cache {} hits, {} misses, {} evicted".format(name, self.hits, self.misses, self.evicted))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,151 @@
+"""Sentence splitters of the mask generators.
+
+`SpacySplitter` is the spaCy English() + sentencizer pipeline the generators always used, spaCy is
+only imported when it first splits. `RegexSplitter` needs no dependency: it cuts the text into
+approximate spaCy tokens with a few compiled regexes and abbreviation rules, then applies the
+sentencizer rule to them. data/bench_sentence_split.py measures how often the two agree.
+"""
+import re
+import unicodedata
+
+_nlp = None
+
+
+def get_nlp():
+    """The spaCy English() + sentencizer pipeline, built on first use."""
+    global _nlp
+    if _nlp is None:
+        from spacy.lang.en import English
+        _nlp = English()
+        _nlp.add_pipe(_nlp.create_pipe("sentencizer"))
+    return _nlp
+
+
+class SpacySplitter(object):
+    name = "spacy_sentencizer"
+
+    def __init__(self, batch_size=256):
+        self.batch_size = batch_size
+
+    def split(self, docs):
+        """Sentence texts of every document."""
+        return [[sen.text for sen in doc.sents] for doc in get_nlp().pipe(docs, batch_size=self.batch_size)]
+
+
+# spaCy's English tokenizer exceptions that end with a period, they keep it
+ABBREVIATIONS = set("""
+Adm. Ak. Ala. Apr. Ariz. Ark. Aug. Bros. Calif. Co. Colo. Conn. Corp. D.C. Dec. Del. Dr. E.G. E.g. Feb. Fla.
+Ga. Gen. Gov. I.E. I.e. Ia. Id. Ill. Inc. Ind. Jan. Jr. Jul. Jun. Kan. Kans. Ky. La. Ltd. Mar. Mass. May. Md.
+Messrs. Mich. Minn. Miss. Mo. Mont. Mr. Mrs. Ms. Mt. N.C. N.D. N.H. N.J. N.M. N.Y. Neb. Nebr. Nev. Nov. Oct.
+Okla. Ore. Pa. Ph.D. Prof. Rep. Rev. S.C. Sen. Sep. Sept. St. Tenn. Va. Wash. Wis. a.m. co. e.g. i.e. p.m.
+v.s. vs. ._.
+""".split()) | set("{}.".format(c) for c in "abcdefghijklmnopqrstuvwxyzäöü")
+
+EMOTICONS = set(""":) :( :-) :-( ;) ;-) :D :-D :P :-P :p :/ :'( :'-( =) =( (: ): <3 </3 xD XD :o :O ^_^ -_- :]
+:[ :| 8)""".split())
+
+# the sentencizer's default punctuation of the scripts in our corpora
+SENT_END_CHARS = set("!.?:;։؟۔।॥‼‽⁇⁈⁉⸮﹒﹖﹗"
+                     "！．？｡。")
+# characters the tokenizer always splits off the end of a token
+SUFFIX_CHARS = set("!?:;,)]}>\"'`’”»…*&#_。？！，、；：）」』】")
+# characters the tokenizer always splits off the start of a token
+PREFIX_CHARS = set("([{<\"'`‘“«*&#_$£€¥§%=+—–…!?,:;¿¡")
+
+
+def is_punct(text):
+    return all(unicodedata.category(c).startswith("P") for c in text)
+
+
+class RegexSplitter(object):
+    name = "regex"
+
+    def __init__(self):
+        self.chunk_re = re.compile(r"\S+")
+        self.ellipsis_re = re.compile(r"\.\.+$")
+        # a period is split off after lowercase letters, digits, some punctuation or two capitals
+        self.period_re = re.compile(r"(?:[^\W_A-Z]|[%²\-+,:;!?()\[\]{}<>_#*&'\"“”‘’`]|[A-Z][A-Z])\.$",
+                                    re.UNICODE)
+        # infixes that split a chunk: lower.Upper, letter/digit:letter, ellipses
+        self.infix_re = re.compile(r"(?<=[a-z'\"’”])\.(?=[A-Z'\"‘“])|(?<=[A-Za-z0-9]):(?=[A-Za-z])|\.\.+(?=\w)")
+        # host names like a.B.cd are kept whole, like spaCy's URL match does
+        self.host_re = re.compile(r"^(?:[^\W_][\w-]*\.)+[a-z]{2,63}$")
+        self.url_re = re.compile(r"^(?:https?://|www\.)\S*[\w/]$")
+
+    def split_chunk(self, text, begin):
+        """Approximate spaCy tokens of one whitespace separated chunk, as (begin, end) offsets."""
+        # strip prefixes and suffixes like the tokenizer loop, exceptions stop it
+        prefixes, suffixes = [], []
+        start = 0
+        stop = len(text)
+        while stop > start:
+            token = text[start:stop]
+            if token in ABBREVIATIONS or token in EMOTICONS or self.url_re.match(token):
+                break
+            if token[0] in PREFIX_CHARS and stop - start > 1:
+                prefixes.append((start, start + 1))
+                start += 1
+                continue
+            m = self.ellipsis_re.search(token)
+            if m is not None and m.start() > 0:
+                suffixes.append((start + m.start(), stop))
+                stop = start + m.start()
+                continue
+            if token[-1] in SUFFIX_CHARS and stop - start > 1:
+                suffixes.append((stop - 1, stop))
+                stop -= 1
+                continue
+            if token[-1] == "." and stop - start > 1 and self.period_re.search(token):
+                suffixes.append((stop - 1, stop))
+                stop -= 1
+                continue
+            break
+        tokens = list(prefixes)
+        if stop > start:
+            token = text[start:stop]
+            pos = start
+            if token not in ABBREVIATIONS and token not in EMOTICONS and not self.url_re.match(token) and \
+                    not self.host_re.match(token):
+                for m in self.infix_re.finditer(token):
+                    if m.start() > pos - start:
+                        tokens.append((pos, start + m.start()))
+                    tokens.append((start + m.start(), start + m.end()))
+                    pos = start + m.end()
+            tokens.append((pos, stop))
+        tokens.extend(reversed(suffixes))
+        return [(begin + a, begin + b) for a, b in tokens if b > a]
+
+    def split_text(self, text):
+        tokens = []
+        for m in self.chunk_re.finditer(text):
+            tokens.extend(self.split_chunk(m.group(), m.start()))
+        # the sentencizer: a token after sentence end punctuation starts a sentence unless it is punctuation
+        sentences = []
+        sen_begin = None
+        seen_end = False
+        last_end = 0
+        for begin, end in tokens:
+            token = text[begin:end]
+            in_end_chars = token in SENT_END_CHARS
+            if sen_begin is None:
+                sen_begin = begin
+            elif seen_end and not in_end_chars and not is_punct(token):
+                sentences.append(text[sen_begin:last_end])
+                sen_begin = begin
+                seen_end = False
+            if in_end_chars:
+                seen_end = True
+            last_end = end
+        if sen_begin is not None:
+            sentences.append(text[sen_begin:last_end])
+        return sentences
+
+    def split(self, docs):
+        """Sentence texts of every document."""
+        return [self.split_text(doc) for doc in docs]
+
+
+splitters = {
+    "spacy": SpacySplitter,
+    "regex": RegexSplitter,
+}
@@ -0,0 +1,269 @@
+"""Runs create_data.py over token balanced work units on a local pool of workers.
+
+The corpus is cut into small contiguous units of about `--unit_tokens` whitespace tokens. One
+create_data.py worker per entry of `--devices` loads its model once and claims units until none
+are left, so long documents no longer hold back a whole part. A worker only reads the documents of
+the units it claims, through the record offset index of data_utils.py. Finished units are recorded in
+{output_dir}/work, and a restart only redoes the unfinished ones. At the end the unit outputs
+are concatenated into `--num_parts` parts with the file names a `--part`/`--max_proc` run writes,
+for merge_hdf5.py and merge_pkl.py.
+
+    python3 data/shard_coordinator.py --input_dir=... --task_name=... --output_dir=... --devices=0,1,2,3 \
+        -- --bert_model=... --mode=rule --max_seq_length=128 ...
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+import h5py
+
+sys.path.append("../")
+
+from data.data_utils import processors
+from data.hdf5_writer import HDF5_CHUNK_ROWS, HDF5_CODECS
+from data.labeled_store import concat_labeled
+from data.merge_hdf5 import merge_copy
+
+logger = logging.getLogger(__name__)
+
+
+def claim_path(work_dir, unit_id):
+    return os.path.join(work_dir, "claims", "{}".format(unit_id))
+
+
+def done_path(work_dir, unit_id):
+    return os.path.join(work_dir, "done", "{}".format(unit_id))
+
+
+def claim_unit(work_dir, unit_id, worker_id):
+    """Atomically claims an unfinished unit for `worker_id`. Returns False if it is done or taken."""
+    if os.path.exists(done_path(work_dir, unit_id)):
+        return False
+    try:
+        fd = os.open(claim_path(work_dir, unit_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(str(worker_id))
+    return True
+
+
+def mark_done(work_dir, unit_id):
+    open(done_path(work_dir, unit_id), "w").close()
+
+
+def release_claims(work_dir, worker_id=None):
+    """Drops the claims of unfinished units, of one worker or of all of them."""
+    claims_dir = os.path.join(work_dir, "claims")
+    for name in os.listdir(claims_dir):
+        if os.path.exists(done_path(work_dir, name)):
+            continue
+        path = os.path.join(claims_dir, name)
+        if worker_id is not None:
+            with open(path) as f:
+                if f.read().strip() != str(worker_id):
+                    continue
+        os.remove(path)
+
+
+def document_tokens(task_name, examples):
+    if task_name == "absa" or task_name == "absa_term":
+        return [len(example["text"].split()) + 1 for example in examples]
+    return [len(example.text_a.split()) + 1 for example in examples]
+
+
+def make_units(num_tokens, unit_tokens):
+    """Cuts documents into contiguous [begin, end) units of about `unit_tokens` tokens."""
+    units = []
+    begin, tokens = 0, 0
+    for i, n in enumerate(num_tokens):
+        tokens += n
+        if tokens >= unit_tokens or i == len(num_tokens) - 1:
+            units.append([begin, i + 1, tokens])
+            begin, tokens = i + 1, 0
+    return units
+
+
+def split_parts(units, num_parts):
+    """Splits the unit ids into `num_parts` contiguous groups of about the same number of tokens.
+
+    No group is empty, except the last ones when there are more parts than units.
+    """
+    total = sum(unit[2] for unit in units)
+    parts = [[] for _ in range(num_parts)]
+    tokens = 0
+    part = -1
+    for unit_id, unit in enumerate(units):
+        # at most one part after the previous unit's, and enough units left for the parts after it
+        part = min(int(tokens * num_parts / max(total, 1)), num_parts - 1, part + 1)
+        part = max(part, min(num_parts, len(units)) - (len(units) - unit_id))
+        parts[part].append(unit_id)
+        tokens += unit[2]
+    return parts
+
+
+def concat_hdf5(input_files, output_file, empty=False, **kwargs):
+    """Concatenates hdf5 instance files block by block, `kwargs` are the `HDF5Appender` options of the workers.
+    With `empty`, writes a file without rows of the same layout instead."""
+    part_sizes = []
+    for filename in input_files:
+        with h5py.File(filename, "r") as f:
+            part_sizes.append(f["input_ids"].shape[0])
+    merge_copy(input_files, part_sizes, 0, 0 if empty else sum(part_sizes), output_file, **kwargs)
+
+
+def hdf5_options(create_data_args):
+    """The hdf5 options of the create_data.py arguments, with its defaults."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--hdf5_compression", default="gzip", choices=HDF5_CODECS)
+    parser.add_argument("--hdf5_compression_level", default=None, type=int)
+    parser.add_argument("--hdf5_chunk_rows", default=HDF5_CHUNK_ROWS, type=int)
+    args, _ = parser.parse_known_args(create_data_args)
+    return {"chunk_rows": args.hdf5_chunk_rows, "compression": args.hdf5_compression,
+            "compression_level": args.hdf5_compression_level}
+
+
+def concat_pkl(input_files, output_file):
+    L = []
+    for filename in input_files:
+        with open(filename, "rb") as f:
+            L.extend(pickle.load(f))
+    with open(output_file, "wb") as f:
+        pickle.dump(L, f)
+
+
+def assemble_parts(work_dir, output_dir, units, num_parts, hdf5_options=None):
+    """Concatenates the unit outputs into the per part files of a `--part`/`--max_proc` run.
+
+    With more parts than units, the parts without units are written empty, so all `num_parts` files exist.
+    """
+    units_dir = os.path.join(work_dir, "units")
+    parts = split_parts(units, num_parts)
+    for dirpath, dirnames, filenames in os.walk(units_dir):
+        reldir = os.path.relpath(dirpath, units_dir)
+        # columnar labeled data are {unit}.labeled directories
+        labeled_dirs = [dirname for dirname in dirnames if dirname.endswith(".labeled")]
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.endswith(".labeled")]
+        for ext in [".pkl", ".hdf5", ".labeled"]:
+            if not any(filename.endswith(ext) for filename in filenames + labeled_dirs):
+                continue
+            target_dir = os.path.normpath(os.path.join(output_dir, reldir))
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            # the shapes of the empty parts
+            template = [os.path.join(dirpath, filename) for filename in filenames + labeled_dirs if filename.endswith(ext)][0]
+            for part, unit_ids in enumerate(parts):
+                input_files = [os.path.join(dirpath, "{}{}".format(unit_id, ext)) for unit_id in unit_ids]
+                input_files = [filename for filename in input_files if os.path.exists(filename)]
+                output_file = os.path.join(target_dir, "{}{}".format(part, ext))
+                if len(input_files) == 0 and len(unit_ids) > 0:
+                    continue
+                if ext == ".labeled":
+                    if len(unit_ids) == 0:
+                        concat_labeled([template], output_file, 0, 0)
+                    else:
+                        concat_labeled(input_files, output_file)
+                elif h5py.is_hdf5(template):
+                    # model mode without --with_rand writes hdf5 content to {part}.pkl
+                    if len(unit_ids) == 0:
+                        concat_hdf5([template], output_file, empty=True, **(hdf5_options or {}))
+                    else:
+                        concat_hdf5(input_files, output_file, **(hdf5_options or {}))
+                else:
+                    concat_pkl(input_files, output_file)
+                print("{}: {} units".format(output_file, len(input_files)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", default=None, type=str, required=True)
+    parser.add_argument("--task_name", default=None, type=str, required=True)
+    parser.add_argument("--output_dir", default=None, type=str, required=True)
+    parser.add_argument("--devices", default="0", type=str,
+                        help="Comma separated CUDA devices, one worker each. Use -1 for a CPU worker.")
+    parser.add_argument("--num_parts", default=None, type=int,
+                        help="Number of part files to assemble (default: number of devices).")
+    parser.add_argument("--unit_tokens", default=200000, type=int,
+                        help="Approximate number of whitespace tokens per work unit.")
+    parser.add_argument("--max_retries", default=3, type=int,
+                        help="How many times a crashed worker is restarted.")
+    args, create_data_args = parser.parse_known_args()
+    if len(create_data_args) > 0 and create_data_args[0] == "--":
+        create_data_args = create_data_args[1:]
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    devices = args.devices.split(",")
+    num_parts = args.num_parts if args.num_parts is not None else len(devices)
+    work_dir = os.path.join(args.output_dir, "work")
+    for dirname in [work_dir, os.path.join(work_dir, "claims"), os.path.join(work_dir, "done")]:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    manifest_file = os.path.join(work_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest["unit_tokens"] != args.unit_tokens:
+            raise ValueError("{} was made with --unit_tokens={}".format(manifest_file, manifest["unit_tokens"]))
+    else:
+        examples = processors[args.task_name]().get_pretrain_examples(args.input_dir, -1, 1)
+        manifest = {"unit_tokens": args.unit_tokens, "num_docs": len(examples),
+                    "units": make_units(document_tokens(args.task_name, examples), args.unit_tokens)}
+        del examples
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f)
+    units = manifest["units"]
+    if num_parts > len(units):
+        logger.warning("{} parts of {} units, {} parts will be empty".format(num_parts, len(units), num_parts - len(units)))
+
+    # no worker runs yet, claims left over from a previous run are stale
+    release_claims(work_dir)
+    num_done = sum(1 for unit_id in range(len(units)) if os.path.exists(done_path(work_dir, unit_id)))
+    logger.info("{} units of {} documents, {} already done".format(len(units), manifest["num_docs"], num_done))
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_data.py")
+
+    def start(worker_id):
+        cmd = [sys.executable, script, "--input_dir={}".format(args.input_dir), "--task_name={}".format(args.task_name),
+               "--output_dir={}".format(args.output_dir), "--work_dir={}".format(work_dir),
+               "--worker_id={}".format(worker_id), "--part=-1"] + create_data_args
+        env = dict(os.environ)
+        env["CUDA_VISIBLE_DEVICES"] = "" if devices[worker_id] == "-1" else devices[worker_id]
+        return subprocess.Popen(cmd, env=env)
+
+    workers = {worker_id: start(worker_id) for worker_id in range(len(devices))}
+    retries = 0
+    while len(workers) > 0:
+        time.sleep(5)
+        for worker_id, proc in list(workers.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del workers[worker_id]
+            if code != 0:
+                release_claims(work_dir, worker_id)
+                if retries < args.max_retries:
+                    retries += 1
+                    logger.warning("Worker {} exited with {}, restarting it".format(worker_id, code))
+                    workers[worker_id] = start(worker_id)
+                else:
+                    logger.warning("Worker {} exited with {}".format(worker_id, code))
+
+    unfinished = [unit_id for unit_id in range(len(units)) if not os.path.exists(done_path(work_dir, unit_id))]
+    if len(unfinished) > 0:
+        raise RuntimeError("{} units are unfinished, rerun to retry them".format(len(unfinished)))
+    assemble_parts(work_dir, args.output_dir, units, num_parts, hdf5_options(create_data_args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""Shuffles the part files of create_data.py and splits them into train/dev, out of core.
+
+A seeded alternative to merge_hdf5.py/merge_pkl.py, which take the last rows of the last parts
+as dev. Works on the hdf5 instances ({i}.hdf5) and on the labeled data, columnar ({i}.labeled) or
+pickled ({i}.pkl), and writes the same merged/ files as the merge scripts.
+
+Scatter: every row goes to one of `--num_buckets` temporary bucket files, drawn uniformly.
+Gather: the buckets are read one at a time in order, each is permuted in memory and appended to
+the output, the first `1 - --dev_rate` of the rows to train and the rest to dev. The result is
+a uniform permutation of all rows and at most one block or one bucket is in memory, about
+rows / num_buckets rows. The same seed, --num_buckets and --block_rows give the same split.
+
+Pickled parts are unpickled item by item (see `StreamingListUnpickler`), so they are never loaded
+whole either, but the pure Python unpickler is slower than reading columnar ({i}.labeled) parts.
+
+    python3 data/shuffle_split.py ${OUTPUT_DIR}/model/ ${MAX_PROC} --format hdf5 --seed 42
+"""
+import argparse
+import logging
+import os
+import pickle
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import h5py
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from data.hdf5_writer import FEATURE_DTYPES, HDF5_CHUNK_ROWS, HDF5_CODECS, HDF5Appender
+from data.labeled_store import LabeledData, LabeledWriter
+
+logger = logging.getLogger(__name__)
+
+
+class PickledListWriter(object):
+    """Writes a pickled list item by item, `pickle.load` of the file gives the whole list.
+
+    Protocol 2 has no frames, so the pickle of every item without its PROTO and STOP opcodes
+    can go between the MARK and APPENDS opcodes of one list. Its memo entries are only
+    read back inside the same item, so reusing the memo indexes of earlier items is fine.
+    """
+    def __init__(self, output_file):
+        self.f = open(output_file, "wb")
+        self.f.write(pickle.PROTO + b"\x02" + pickle.EMPTY_LIST)
+
+    def append(self, items):
+        if len(items) == 0:
+            return
+        self.f.write(pickle.MARK)
+        for item in items:
+            self.f.write(pickle.dumps(item, protocol=2)[2:-1])
+        self.f.write(pickle.APPENDS)
+
+    def close(self):
+        self.f.write(pickle.STOP)
+        self.f.close()
+
+
+class StreamingListUnpickler(pickle._Unpickler):
+    """Unpickles a pickled list without building it, its items go to `on_items` in the batches they
+    were appended in.
+
+    The pure Python unpickler with the APPEND(S) of the outermost list replaced. After every batch
+    only the memo entries of strings and numbers are kept, the tokens later items refer to, so the
+    memo does not grow with the items. MEMOIZE counts its indexes itself, they are not the memo size.
+    """
+    dispatch = dict(pickle._Unpickler.dispatch)
+
+    def __init__(self, f, on_items):
+        super(StreamingListUnpickler, self).__init__(f)
+        self.on_items = on_items
+        self.memo_size = 0
+
+    def load_memoize(self):
+        self.memo[self.memo_size] = self.stack[-1]
+        self.memo_size += 1
+    dispatch[pickle.MEMOIZE[0]] = load_memoize
+
+    def load_appends(self):
+        # the stack before MARK holds only the outermost list
+        if len(self.metastack) != 1 or len(self.metastack[0]) != 1:
+            return pickle._Unpickler.load_appends(self)
+        self.handle(self.pop_mark())
+    dispatch[pickle.APPENDS[0]] = load_appends
+
+    def load_append(self):
+        if len(self.metastack) != 0 or len(self.stack) != 2:
+            return pickle._Unpickler.load_append(self)
+        self.handle([self.stack.pop()])
+    dispatch[pickle.APPEND[0]] = load_append
+
+    def handle(self, items):
+        self.on_items(items)
+        self.memo = {i: obj for i, obj in self.memo.items() if isinstance(obj, (str, bytes, int, float))}
+
+
+def read_pickled_list(filename, block_rows):
+    """Yields the items of the pickled list in `filename` in lists of `block_rows`, unpickled on a
+    background thread that is at most one list ahead."""
+    blocks = queue.Queue(maxsize=1)
+    errors = []
+
+    def read():
+        pending = []
+
+        def on_items(items):
+            pending.extend(items)
+            while len(pending) >= block_rows:
+                blocks.put(pending[:block_rows])
+                del pending[:block_rows]
+        try:
+            with open(filename, "rb") as f:
+                StreamingListUnpickler(f, on_items).load()
+            if len(pending) > 0:
+                blocks.put(pending)
+        except Exception as e:
+            errors.append(e)
+        blocks.put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    while True:
+        block = blocks.get()
+        if block is None:
+            break
+        yield block
+    reader.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+class HDF5Rows(object):
+    """Rows of the hdf5 instance files, one structured record per row in the bucket files."""
+    ext = ".hdf5"
+    outputs = ["train.hdf5", "dev/dev.hdf5"]
+
+    def __init__(self, block_rows=65536, **hdf5_options):
+        self.block_rows = block_rows
+        self.hdf5_options = hdf5_options
+        self.dtype = None
+
+    def parts(self, part_files):
+        """Yields the rows of every part as blocks of structured records."""
+        for filename in part_files:
+            with h5py.File(filename, "r") as f:
+                if self.dtype is None:
+                    self.dtype = np.dtype([(name, f[name].dtype, f[name].shape[1:]) for name in FEATURE_DTYPES])
+                num_rows = f["input_ids"].shape[0]
+                for begin in range(0, num_rows, self.block_rows):
+                    end = min(begin + self.block_rows, num_rows)
+                    block = np.empty(end - begin, dtype=self.dtype)
+                    for name in FEATURE_DTYPES:
+                        block[name] = f[name][begin:end]
+                    yield block
+
+    def take(self, rows, index):
+        return rows[index]
+
+    def dump(self, rows, f):
+        rows.tofile(f)
+
+    def load(self, filename):
+        return np.fromfile(filename, dtype=self.dtype)
+
+    def open(self, output_file):
+        return HDF5Appender(output_file, self.dtype["input_ids"].shape[0], self.dtype["masked_lm_ids"].shape[0],
+                            **self.hdf5_options)
+
+    def append(self, writer, rows):
+        writer.append({name: np.ascontiguousarray(rows[name]) for name in FEATURE_DTYPES})
+
+
+class LabeledBlock(object):
+    """Sentences of columnar labeled data, their flat `ids` and `labels` and the length of each."""
+    def __init__(self, ids, labels, lengths):
+        self.ids = ids
+        self.labels = labels
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+class LabeledRows(object):
+    """Rows of the columnar labeled data, `LabeledBlock`s pickled in the bucket files."""
+    ext = ".labeled"
+    outputs = ["train.labeled", "valid.labeled"]
+
+    def __init__(self, block_rows=65536):
+        self.block_rows = block_rows
+        self.vocab_size = None
+
+    def parts(self, part_files):
+        """Yields the sentences of every part as blocks read from its memory maps."""
+        for filename in part_files:
+            store = LabeledData(filename)
+            if self.vocab_size is None:
+                self.vocab_size = store.vocab_size
+            elif store.vocab_size != self.vocab_size:
+                raise ValueError("Labeled data of different vocabs: {}".format(filename))
+            for begin in range(0, len(store), self.block_rows):
+                end = min(begin + self.block_rows, len(store))
+                token_begin, token_end = int(store.offsets[begin]), int(store.offsets[end])
+                yield LabeledBlock(np.array(store.ids[token_begin:token_end]),
+                                   store.token_labels(token_begin, token_end), np.diff(store.offsets[begin:end + 1]))
+
+    def take(self, rows, index):
+        index = np.asarray(index, dtype=np.int64)
+        starts = (np.cumsum(rows.lengths) - rows.lengths)[index]
+        taken = rows.lengths[index]
+        # the token positions of the taken sentences, back to back
+        tokens = np.repeat(starts - (np.cumsum(taken) - taken), taken) + np.arange(taken.sum())
+        return LabeledBlock(rows.ids[tokens], rows.labels[tokens], taken)
+
+    def dump(self, rows, f):
+        pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, filename):
+        blocks = []
+        with open(filename, "rb") as f:
+            while True:
+                try:
+                    blocks.append(pickle.load(f))
+                except EOFError:
+                    break
+        return LabeledBlock(*[np.concatenate([getattr(block, name) for block in blocks])
+                              for name in ["ids", "labels", "lengths"]])
+
+    def open(self, output_file):
+        return LabeledWriter(output_file, self.vocab_size)
+
+    def append(self, writer, rows):
+        writer.append(rows.ids, rows.labels, rows.lengths)
+
+
+class PklRows(object):
+    """Rows of the labeled data files, lists of (tokens, labels) pickled in batches in the bucket files."""
+    ext = ".pkl"
+    outputs = ["train.pkl", "valid.pkl"]
+
+    def __init__(self, block_rows=65536):
+        self.block_rows = block_rows
+
+    def parts(self, part_files):
+        """Yields the rows of every part as blocks, unpickled item by item."""
+        for filename in part_files:
+            for rows in read_pickled_list(filename, self.block_rows):
+                yield rows
+
+    def take(self, rows, index):
+        return [rows[i] for i in index]
+
+    def dump(self, rows, f):
+        pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, filename):
+        rows = []
+        with open(filename, "rb") as f:
+            while True:
+                try:
+                    rows.extend(pickle.load(f))
+                except EOFError:
+                    return rows
+
+    def open(self, output_file):
+        return PickledListWriter(output_file)
+
+    def append(self, writer, rows):
+        writer.append(rows)
+
+
+def scatter(rows_format, part_files, bucket_files, seed):
+    """Appends every row to a random bucket file, returns the number of rows."""
+    num_buckets = len(bucket_files)
+    num_rows = 0
+    for block_index, rows in enumerate(rows_format.parts(part_files)):
+        gen = np.random.default_rng([seed, 0, block_index])
+        buckets = gen.integers(0, num_buckets, len(rows))
+        order = np.argsort(buckets, kind="stable")
+        bounds = np.searchsorted(buckets[order], np.arange(num_buckets + 1)).tolist()
+        for bucket in range(num_buckets):
+            if bounds[bucket] < bounds[bucket + 1]:
+                with open(bucket_files[bucket], "ab") as f:
+                    rows_format.dump(rows_format.take(rows, order[bounds[bucket]:bounds[bucket + 1]]), f)
+        num_rows += len(rows)
+    return num_rows
+
+
+def gather(rows_format, bucket_files, output_files, num_train, seed):
+    """Writes the permuted buckets in order, the first `num_train` rows to the first output, the rest to the second."""
+    writers = [rows_format.open(output_file) for output_file in output_files]
+    written = 0
+    for bucket, filename in enumerate(bucket_files):
+        if not os.path.exists(filename):
+            continue
+        rows = rows_format.load(filename)
+        rows = rows_format.take(rows, np.random.default_rng([seed, 1, bucket]).permutation(len(rows)))
+        split = min(max(num_train - written, 0), len(rows))
+        if split > 0:
+            rows_format.append(writers[0], rows_format.take(rows, np.arange(split)))
+        if split < len(rows):
+            rows_format.append(writers[1], rows_format.take(rows, np.arange(split, len(rows))))
+        written += len(rows)
+        os.remove(filename)
+    for writer in writers:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("origin_dir", type=str, help="The dir of the part files, as for merge_hdf5.py/merge_pkl.py.")
+    parser.add_argument("num_files", type=int)
+    parser.add_argument("--format", default="hdf5", choices=["hdf5", "labeled", "pkl"],
+                        help="hdf5 instances, columnar labeled data or pickled labeled data.")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--dev_rate", default=0.1, type=float)
+    parser.add_argument("--num_buckets", default=64, type=int,
+                        help="The gather holds about rows / num_buckets rows in memory.")
+    parser.add_argument("--block_rows", default=65536, type=int, help="Rows scattered at a time.")
+    parser.add_argument("--temp_dir", default=None, type=str, help="Where the bucket files go, default the merged dir.")
+    parser.add_argument("--hdf5_compression", default="gzip", choices=HDF5_CODECS)
+    parser.add_argument("--hdf5_compression_level", default=None, type=int)
+    parser.add_argument("--hdf5_chunk_rows", default=HDF5_CHUNK_ROWS, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    if args.format == "hdf5":
+        rows_format = HDF5Rows(args.block_rows, chunk_rows=args.hdf5_chunk_rows, compression=args.hdf5_compression,
+                               compression_level=args.hdf5_compression_level)
+    elif args.format == "labeled":
+        rows_format = LabeledRows(args.block_rows)
+    else:
+        rows_format = PklRows(args.block_rows)
+    part_files = [os.path.join(args.origin_dir, "{}{}".format(i, rows_format.ext)) for i in range(args.num_files)]
+    merged_dir = os.path.join(args.origin_dir, "merged")
+    output_files = [os.path.join(merged_dir, name) for name in rows_format.outputs]
+    for output_file in output_files:
+        if not os.path.exists(os.path.dirname(output_file)):
+            os.makedirs(os.path.dirname(output_file))
+
+    temp_dir = tempfile.mkdtemp(prefix="shuffle_split.", dir=args.temp_dir or merged_dir)
+    try:
+        bucket_files = [os.path.join(temp_dir, "{}.bucket".format(i)) for i in range(args.num_buckets)]
+        begin = time.time()
+        num_rows = scatter(rows_format, part_files, bucket_files, args.seed)
+        logger.info("scattered {} rows to {} buckets in {:.2f}s".format(num_rows, args.num_buckets, time.time() - begin))
+        num_train = int((1 - args.dev_rate) * num_rows)
+        begin = time.time()
+        gather(rows_format, bucket_files, output_files, num_train, args.seed)
+        logger.info("wrote {} train and {} dev rows in {:.2f}s".format(num_train, num_rows - num_train, time.time() - begin))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def corpus_key(data, vocab, do_lower_case, segment_name):
+    """sha1 of the document texts, the vocab, `do_lower_case` and the sentence segmentation."""
+    corpus = hashlib.sha1()
+    for doc in data:
+        doc = doc.encode("utf-8")
+        corpus.update("{}:".format(len(doc)).encode("utf-8"))
+        corpus.update(doc)
+    h = hashlib.sha1()
+    h.update(corpus.hexdigest().encode("utf-8"))
+    h.update(hashlib.sha1("\n".join(vocab).encode("utf-8")).hexdigest().encode("utf-8"))
+    h.update("lower={} segment={}".format(bool(do_lower_case), segment_name).encode("utf-8"))
+    return h.hexdigest()
+
+
+class TokenizedCorpus(object):
+    """Token ids of a corpus in flat memory-mapped arrays written by `load_tokenized_corpus`.
+
+    ids.bin holds the int32 ids of all sentences back to back, sen_offsets.npy the token offset of
+    every sentence (plus the end) and doc_offsets.npy the sentence offset of every document (plus
+    the end). Slicing gives a view over a range of documents, so it can stand in for the list of
+    document texts the generators get.
+    """
+    def __init__(self, path, doc_begin=0, doc_end=None):
+        self.path = path
+        if os.path.getsize(os.path.join(path, "ids.bin")) > 0:
+            self.ids = np.memmap(os.path.join(path, "ids.bin"), dtype=np.int32, mode="r")
+        else:
+            self.ids = np.zeros(0, dtype=np.int32)
+        self.sen_offsets = np.load(os.path.join(path, "sen_offsets.npy"), mmap_mode="r")
+        self.doc_offsets = np.load(os.path.join(path, "doc_offsets.npy"), mmap_mode="r")
+        self.doc_begin = doc_begin
+        self.doc_end = len(self.doc_offsets) - 1 if doc_end is None else doc_end
+
+    def __len__(self):
+        return self.doc_end - self.doc_begin
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in [None, 1]:
+            raise TypeError("TokenizedCorpus only supports contiguous slices")
+        begin, end, _ = index.indices(len(self))
+        end = max(begin, end)
+        return TokenizedCorpus(self.path, self.doc_begin + begin, self.doc_begin + end)
+
+    def sentence_ids(self):
+        """Ids of the sentences of the view back to back, the offset of each (plus the end) and the
+        document id (within the view) of each."""
+        sen_begin, sen_end = self.doc_offsets[self.doc_begin], self.doc_offsets[self.doc_end]
+        offsets = np.asarray(self.sen_offsets[sen_begin:sen_end + 1])
+        doc_sizes = np.diff(np.asarray(self.doc_offsets[self.doc_begin:self.doc_end + 1]))
+        sen_doc_ids = np.repeat(np.arange(len(doc_sizes)), doc_sizes).tolist()
+        return np.asarray(self.ids[offsets[0]:offsets[-1]]), offsets - offsets[0], sen_doc_ids
+
+    def document_ids(self):
+        """Ids of the documents of the view back to back and the offset of each (plus the end)."""
+        doc_offsets = np.asarray(self.doc_offsets[self.doc_begin:self.doc_end + 1])
+        offsets = np.asarray(self.sen_offsets)[doc_offsets]
+        return np.asarray(self.ids[offsets[0]:offsets[-1]]), offsets - offsets[0]
+
+
+def load_tokenized_corpus(cache_dir, data, tokenizer, do_lower_case, tokenize_fn=None, segment_name="document",
+                          chunk_docs=10000):
+    """Returns the `TokenizedCorpus` of the document texts `data`, building it in `cache_dir` on a miss.
+
+    `tokenize_fn` maps a list of documents to the token lists of the sentences of each, without it
+    every document is tokenized as one sentence. `segment_name` names the segmentation in the cache key.
+    """
+    vocab = list(tokenizer.vocab.keys())
+    key = corpus_key(data, vocab, do_lower_case, segment_name if tokenize_fn is not None else "document")
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        logger.info("Tokenized corpus {}".format(path))
+        return TokenizedCorpus(path)
+
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    if not os.path.exists(tmp):
+        os.makedirs(tmp)
+    sen_offsets = [0]
+    doc_offsets = [0]
+    with open(os.path.join(tmp, "ids.bin"), "wb") as f:
+        for begin in tqdm(range(0, len(data), chunk_docs), desc="Tokenizing corpus"):
+            docs = data[begin:begin + chunk_docs]
+            if tokenize_fn is not None:
+                all_sentences = tokenize_fn(docs)
+            else:
+                all_sentences = [[tokenizer.tokenize(doc)] for doc in docs]
+            ids = []
+            chunk_begin = sen_offsets[-1]
+            for sentences in all_sentences:
+                for tokens in sentences:
+                    ids.extend(tokenizer.vocab[token] for token in tokens)
+                    sen_offsets.append(chunk_begin + len(ids))
+                doc_offsets.append(len(sen_offsets) - 1)
+            np.asarray(ids, dtype=np.int32).tofile(f)
+    np.save(os.path.join(tmp, "sen_offsets.npy"), np.asarray(sen_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp, "doc_offsets.npy"), np.asarray(doc_offsets, dtype=np.int64))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"num_docs": len(doc_offsets) - 1, "num_sentences": len(sen_offsets) - 1,
+                   "num_tokens": sen_offsets[-1], "do_lower_case": bool(do_lower_case),
+                   "segment": segment_name if tokenize_fn is not None else "document"}, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another process built it first
+        shutil.rmtree(tmp)
+    logger.info("Tokenized corpus {}: {} documents, {} sentences, {} tokens".format(
+        path, len(doc_offsets) - 1, len(sen_offsets) - 1, sen_offsets[-1]))
+    return TokenizedCorpus(path)
@@ -13,12 +13,13 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.nn import CrossEntropyLoss
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, TensorDataset)
+from torch.utils.data import (DataLoader, Dataset, RandomSampler, SequentialSampler, TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 
 from model.modeling_classification import (CONFIG_NAME, WEIGHTS_NAME, VOCAB_NAME, BertConfig, BertForTokenClassification)
 from model.optimization import BertAdam
 from model.tokenization import BertTokenizer
+from data.labeled_store import LabeledData
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -164,6 +165,36 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
                                       label_id=label_ids))
     return features
 
+
+class LabeledDataset(Dataset):
+    """The features of `convert_examples_to_features`, built per sentence from columnar labeled data(.labeled)."""
+
+    def __init__(self, path, max_seq_length, tokenizer):
+        self.data = LabeledData(path)
+        if self.data.vocab_size != len(tokenizer.vocab):
+            raise ValueError("{} has the ids of a vocab of size {}, the tokenizer's has {}".format(
+                path, self.data.vocab_size, len(tokenizer.vocab)))
+        self.max_seq_length = max_seq_length
+        self.cls_id, self.sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        ids, labels = self.data.sentence(index)
+        num = min(len(ids), self.max_seq_length - 2)
+        input_ids = np.zeros(self.max_seq_length, dtype=np.int64)
+        input_ids[0] = self.cls_id
+        input_ids[1:num + 1] = ids[:num]
+        input_ids[num + 1] = self.sep_id
+        input_mask = np.zeros(self.max_seq_length, dtype=np.int64)
+        input_mask[:num + 2] = 1
+        label_ids = np.zeros(self.max_seq_length, dtype=np.int64)
+        label_ids[1:num + 1] = labels[:num]
+        return (torch.from_numpy(input_ids), torch.from_numpy(input_mask),
+                torch.zeros(self.max_seq_length, dtype=torch.long), torch.from_numpy(label_ids))
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -355,30 +386,35 @@ def main():
     train_examples = None
     num_train_optimization_steps = None
     if args.do_train:
-        train_examples = processor.get_train_examples(args.data_dir)
+        train_labeled = os.path.join(args.data_dir, "train.labeled")
         
         if args.fp16:
             sample_weight = torch.HalfTensor([1.0, args.sample_weight]).cuda()
         else:
             sample_weight = torch.FloatTensor([1.0, args.sample_weight]).cuda()
 
-        cached_train_features_file = os.path.join(args.data_dir, 'train_{}_{}_{}'.format(list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(task_name)))
-        try:
-            with open(cached_train_features_file, "rb") as reader:
-                logger.info("Load from cache dir: {}".format(cached_train_features_file))
-                train_features = pickle.load(reader)
-        except:
-            train_features = convert_examples_to_features(train_examples, label_list, args.max_seq_length, tokenizer)
-            if args.local_rank == -1 or torch.distributed.get_rank() == 0:
-                logger.info("Saving train features into cached file {}".format(cached_train_features_file))
-                with open(cached_train_features_file, "wb") as writer:
-                    pickle.dump(train_features, writer)
-
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        if os.path.isdir(train_labeled):
+            # columnar labeled data: memory mapped, no tokenization or feature cache
+            train_data = LabeledDataset(train_labeled, args.max_seq_length, tokenizer)
+        else:
+            train_examples = processor.get_train_examples(args.data_dir)
+            cached_train_features_file = os.path.join(args.data_dir, 'train_{}_{}_{}'.format(list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(task_name)))
+            try:
+                with open(cached_train_features_file, "rb") as reader:
+                    logger.info("Load from cache dir: {}".format(cached_train_features_file))
+                    train_features = pickle.load(reader)
+            except:
+                train_features = convert_examples_to_features(train_examples, label_list, args.max_seq_length, tokenizer)
+                if args.local_rank == -1 or torch.distributed.get_rank() == 0:
+                    logger.info("Saving train features into cached file {}".format(cached_train_features_file))
+                    with open(cached_train_features_file, "wb") as writer:
+                        pickle.dump(train_features, writer)
+
+            all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
+            all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
+            all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
+            all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
+            train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
         
         if args.local_rank == -1:
             train_sampler = RandomSampler(train_data)
@@ -409,7 +445,7 @@ def main():
         label_map = {i: label for i, label in enumerate(label_list, 1)}
         
         logger.info("***** Running training *****")
-        logger.info("  Num examples = %d", len(train_examples))
+        logger.info("  Num examples = %d", len(train_data))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
 
@@ -461,31 +497,36 @@ def main():
             weight_path = os.path.join(args.output_dir, "all_models", "e{}_{}".format(e, WEIGHTS_NAME))
             model.load_state_dict(torch.load(weight_path))
             model.to(device)
-            eval_examples = processor.get_dev_examples(args.data_dir)
-            
-            cached_eval_features_file = os.path.join(args.data_dir, 'dev_{0}_{1}_{2}'.format(
-                list(filter(None, args.bert_model.split('/'))).pop(),
-                str(args.max_seq_length),
-                str(task_name)))
-            try:
-                with open(cached_eval_features_file, "rb") as reader:
-                    eval_features = pickle.load(reader)
-            except:
-                eval_features = convert_examples_to_features(eval_examples, label_list, args.max_seq_length, tokenizer)
-                if args.local_rank == -1 or torch.distributed.get_rank() == 0:
-                    logger.info("  Saving eval features into cached file %s", cached_eval_features_file)
-                    with open(cached_eval_features_file, "wb") as writer:
-                        pickle.dump(eval_features, writer)
+            valid_labeled = os.path.join(args.data_dir, "valid.labeled")
+            if os.path.isdir(valid_labeled):
+                eval_data = LabeledDataset(valid_labeled, args.max_seq_length, tokenizer)
+            else:
+                eval_examples = processor.get_dev_examples(args.data_dir)
+
+                cached_eval_features_file = os.path.join(args.data_dir, 'dev_{0}_{1}_{2}'.format(
+                    list(filter(None, args.bert_model.split('/'))).pop(),
+                    str(args.max_seq_length),
+                    str(task_name)))
+                try:
+                    with open(cached_eval_features_file, "rb") as reader:
+                        eval_features = pickle.load(reader)
+                except:
+                    eval_features = convert_examples_to_features(eval_examples, label_list, args.max_seq_length, tokenizer)
+                    if args.local_rank == -1 or torch.distributed.get_rank() == 0:
+                        logger.info("  Saving eval features into cached file %s", cached_eval_features_file)
+                        with open(cached_eval_features_file, "wb") as writer:
+                            pickle.dump(eval_features, writer)
+
+                all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
+                all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
+                all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
+                all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
+
+                eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
 
             logger.info("***** Running evaluation *****")
-            logger.info("  Num examples = %d", len(eval_examples))
+            logger.info("  Num examples = %d", len(eval_data))
             logger.info("  Batch size = %d", args.eval_batch_size)
-            all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-            all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-
-            eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
             # Run prediction for full data
             if args.local_rank == -1:
                 eval_sampler = SequentialSampler(eval_data)
@@ -8,14 +8,19 @@ import os
 import logging
 import argparse
 import random
+import shutil
 import h5py
 from tqdm import tqdm, trange
 import os
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Dataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Dataset, Sampler
 from torch.utils.data.distributed import DistributedSampler
 import math
+import time
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from apex import amp
 import json
 
@@ -33,41 +38,175 @@ logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(messa
                     level = logging.INFO)
 logger = logging.getLogger(__name__)
 
+PRETRAINING_FIELDS = ["input_ids", "input_mask", "segment_ids", "masked_lm_positions", "masked_lm_ids", "next_sentence_labels"]
+
+
+def mmap_sidecar(input_file, mmap_dir=None, block_rows=65536):
+    """Uncompressed .npy copies of the datasets of `input_file`, written once and then reused.
+
+    They go to `{mmap_dir}/{file name}.mmap`, or next to the file. The copy is made in a temporary
+    directory and renamed, so processes racing to create it all end up with a complete one.
+    """
+    directory = os.path.dirname(os.path.abspath(input_file)) if mmap_dir is None else mmap_dir
+    sidecar = os.path.join(directory, os.path.basename(input_file) + ".mmap")
+    if os.path.isdir(sidecar):
+        return sidecar
+    os.makedirs(directory, exist_ok=True)
+    tmp_dir = "{}.tmp{}".format(sidecar, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    with h5py.File(input_file, "r") as f:
+        for name in PRETRAINING_FIELDS:
+            dataset = f[name]
+            array = np.lib.format.open_memmap(os.path.join(tmp_dir, name + ".npy"), mode="w+",
+                                              dtype=dataset.dtype, shape=dataset.shape)
+            for begin in range(0, dataset.shape[0], block_rows):
+                array[begin:begin + block_rows] = dataset[begin:begin + block_rows]
+            array.flush()
+            del array
+    try:
+        os.rename(tmp_dir, sidecar)
+    except OSError:
+        # another process was first
+        shutil.rmtree(tmp_dir)
+    return sidecar
+
+
 class pretraining_dataset(Dataset):
+    """The rows of one hdf5 file of data/create_data.py, kept in their on-disk dtypes.
+
+    backend "memory" reads the whole file, "hdf5" reads the rows of every item from the file
+    (one handle per worker process) and "mmap" memory maps an uncompressed sidecar copy of the
+    file, see `mmap_sidecar`, which the workers share through the page cache. Items are widened
+    to int64 only when they are returned.
+    """
 
-    def __init__(self, input_file, max_pred_length):
+    def __init__(self, input_file, max_pred_length, backend="memory", mmap_dir=None):
         self.input_file = input_file
         self.max_pred_length = max_pred_length
-        f = h5py.File(input_file, "r")
-        self.input_ids = np.asarray(f["input_ids"][:]).astype(np.int64)#[num_instances x max_seq_length])
-        self.input_masks = np.asarray(f["input_mask"][:]).astype(np.int64) #[num_instances x max_seq_length]
-        self.segment_ids = np.asarray(f["segment_ids"][:]).astype(np.int64) #[num_instances x max_seq_length]
-        self.masked_lm_positions = np.asarray(f["masked_lm_positions"][:]).astype(np.int64) #[num_instances x max_pred_length]
-        self.masked_lm_ids= np.asarray(f["masked_lm_ids"][:]).astype(np.int64) #[num_instances x max_pred_length]
-        self.next_sentence_labels = np.asarray(f["next_sentence_labels"][:]).astype(np.int64) # [num_instances]
-        f.close()
+        self.backend = backend
+        self.f = None
+        self.pid = None
+        if backend == "memory":
+            with h5py.File(input_file, "r") as f:
+                self.arrays = {name: f[name][:] for name in PRETRAINING_FIELDS}
+            self.num_rows = len(self.arrays["input_ids"])
+        elif backend == "mmap":
+            sidecar = mmap_sidecar(input_file, mmap_dir)
+            self.arrays = {name: np.load(os.path.join(sidecar, name + ".npy"), mmap_mode="r") for name in PRETRAINING_FIELDS}
+            self.num_rows = len(self.arrays["input_ids"])
+        elif backend == "hdf5":
+            self.arrays = None
+            with h5py.File(input_file, "r") as f:
+                self.num_rows = f["input_ids"].shape[0]
+        else:
+            raise ValueError("Unknown data backend: {}".format(backend))
+
+    def rows(self, index):
+        """The on-disk dtype arrays of row `index`, a row index, a slice or an array of row indexes."""
+        if self.backend != "hdf5":
+            return [self.arrays[name][index] for name in PRETRAINING_FIELDS]
+        # h5py handles do not survive a fork, every worker opens its own
+        if self.f is None or self.pid != os.getpid():
+            self.f = h5py.File(self.input_file, "r")
+            self.pid = os.getpid()
+        if isinstance(index, slice) or np.ndim(index) == 0:
+            return [self.f[name][index] for name in PRETRAINING_FIELDS]
+        # h5py only reads increasing, unique indexes
+        unique, inverse = np.unique(index, return_inverse=True)
+        return [self.f[name][unique][inverse] for name in PRETRAINING_FIELDS]
 
     def __len__(self):
         'Denotes the total number of samples'
-        return len(self.input_ids)
+        return self.num_rows
 
     def __getitem__(self, index):
-        
-        input_ids= torch.from_numpy(self.input_ids[index]) # [max_seq_length]
-        input_mask = torch.from_numpy(self.input_masks[index]) #[max_seq_length]
-        segment_ids = torch.from_numpy(self.segment_ids[index])# [max_seq_length]
-        masked_lm_positions = torch.from_numpy(self.masked_lm_positions[index]) #[max_pred_length]
-        masked_lm_ids = torch.from_numpy(self.masked_lm_ids[index]) #[max_pred_length]
-        next_sentence_labels = torch.from_numpy(np.asarray(self.next_sentence_labels[index])) #[1]
-         
-        masked_lm_labels = torch.ones(input_ids.shape, dtype=torch.long) * -1
-        index = self.max_pred_length
-        # store number of  masked tokens in index
-        if len((masked_lm_positions == 0).nonzero()) != 0:
-          index = (masked_lm_positions == 0).nonzero()[0].item()
-        masked_lm_labels[masked_lm_positions[:index]] = masked_lm_ids[:index]
-
-        return [input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels]
+        """One item, or a whole batch when `index` is a slice or an array of rows, see `PretrainingBatchSampler`."""
+        single = not isinstance(index, slice) and np.ndim(index) == 0
+        input_ids, input_mask, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels = [
+            torch.from_numpy(np.asarray(x, dtype=np.int64)) for x in self.rows([index] if single else index)]
+        masked_lm_labels = masked_lm_labels_batch(input_ids.shape, masked_lm_positions, masked_lm_ids)
+        batch = [input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels]
+        return [t[0] for t in batch] if single else batch
+
+
+def masked_lm_labels_batch(shape, masked_lm_positions, masked_lm_ids):
+    """-1 everywhere but at the masked positions, which get their ids, in one scatter.
+
+    The masked positions of a row end at its first 0 position (0 is [CLS], never masked).
+    """
+    valid = torch.cumprod((masked_lm_positions != 0).long(), dim=1).bool()
+    masked_lm_labels = torch.full(shape, -1, dtype=torch.long)
+    # the padding writes -1 to column 0, which stays -1
+    masked_lm_labels.scatter_(1, masked_lm_positions.masked_fill(~valid, 0), masked_lm_ids.masked_fill(~valid, -1))
+    return masked_lm_labels
+
+
+class PretrainingBatchSampler(Sampler):
+    """Batches of rows of a `pretraining_dataset`, shuffled with `seed`, that it reads and collates at once.
+
+    Rows are drawn at random and every batch is sorted, or with `contiguous` every batch is a
+    block of consecutive rows and the blocks are shuffled, so a batch decompresses as few hdf5
+    chunks as possible. The batches are split between `num_replicas` ranks, padded with the
+    first batches like DistributedSampler so that all ranks run the same number of steps.
+    """
+
+    def __init__(self, num_rows, batch_size, contiguous=False, num_replicas=1, rank=0, seed=0):
+        self.num_rows = num_rows
+        self.batch_size = batch_size
+        self.contiguous = contiguous
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+
+    def __len__(self):
+        num_batches = (self.num_rows + self.batch_size - 1) // self.batch_size
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        if self.contiguous:
+            starts = (torch.randperm((self.num_rows + self.batch_size - 1) // self.batch_size, generator=generator) * self.batch_size).tolist()
+            batches = [slice(start, min(start + self.batch_size, self.num_rows)) for start in starts]
+        else:
+            rows = torch.randperm(self.num_rows, generator=generator).numpy()
+            batches = [np.sort(rows[begin:begin + self.batch_size]) for begin in range(0, self.num_rows, self.batch_size)]
+        batches += batches[:len(self) * self.num_replicas - len(batches)]
+        return iter(batches[self.rank::self.num_replicas])
+
+
+def prefetch_datasets(files, make_dataset, num_prefetch=1):
+    """Yields (dataset, seconds waited for it) of every file in order, the next `num_prefetch`
+    datasets are built on a background thread while the current one is used. With 0 they are
+    built when they are needed, as before.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    futures = collections.deque(executor.submit(make_dataset, data_file) for data_file in files[:num_prefetch])
+    try:
+        for i, data_file in enumerate(files):
+            begin = time.time()
+            dataset = futures.popleft().result() if futures else make_dataset(data_file)
+            stall = time.time() - begin
+            # at most the current file and num_prefetch others are in memory
+            if num_prefetch > 0 and i + num_prefetch < len(files):
+                futures.append(executor.submit(make_dataset, files[i + num_prefetch]))
+            yield dataset, stall
+            del dataset
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def pretraining_dataloader(dataset, batch_size, args, seed):
+    if args.local_rank == -1:
+        num_replicas, rank = 1, 0
+    else:
+        num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+    sampler = PretrainingBatchSampler(len(dataset), batch_size, args.contiguous_batches, num_replicas, rank, seed)
+    kwargs = {"prefetch_factor": args.prefetch_factor} if args.num_workers > 0 else {}
+    # the dataset returns whole batches
+    return DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=args.num_workers, pin_memory=True, **kwargs)
 
 def main():    
 
@@ -174,8 +313,40 @@ def main():
                         type=int,
                         default=16)
     parser.add_argument("--save_total_limit", type=int, default=10)
+    parser.add_argument("--data_backend",
+                        type=str,
+                        default="memory",
+                        choices=["memory", "hdf5", "mmap"],
+                        help="memory: read every file whole, hdf5: read rows from the file when they are used, "
+                             "mmap: memory map an uncompressed copy of every file, made on first use.")
+    parser.add_argument("--num_workers",
+                        type=int,
+                        default=4,
+                        help="DataLoader worker processes.")
+    parser.add_argument("--prefetch_factor",
+                        type=int,
+                        default=2,
+                        help="Batches every worker loads ahead.")
+    parser.add_argument("--contiguous_batches",
+                        default=False,
+                        action='store_true',
+                        help="Batches of consecutive rows in a random order instead of random rows, much faster "
+                             "to read from compressed hdf5. Best on shuffled data, see data/shuffle_split.py.")
+    parser.add_argument("--prefetch_files",
+                        type=int,
+                        default=None,
+                        help="Number of next data files loaded in the background while a file trains, 0 loads "
+                             "every file when it is reached. With --data_backend memory every prefetched file is "
+                             "read whole, so the peak memory is (1 + prefetch_files) decoded files, the default "
+                             "there is 0. The other backends only open their files and default to 1.")
+    parser.add_argument("--mmap_dir",
+                        type=str,
+                        default=None,
+                        help="Where the copies of --data_backend mmap go, next to the data files by default.")
 
     args = parser.parse_args()
+    if args.prefetch_files is None:
+        args.prefetch_files = 0 if args.data_backend == "memory" else 1
 
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -293,13 +464,10 @@ def main():
     num_files = len(files)
 
     logger.info("***** Loading Dev Data *****")
-    dev_data = pretraining_dataset(input_file=os.path.join(args.input_dir, args.dev_data_file), max_pred_length=args.max_predictions_per_seq)
-    if args.local_rank == -1:
-        dev_sampler = RandomSampler(dev_data)
-        dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=args.dev_batch_size * n_gpu, num_workers=4, pin_memory=True)
-    else:
-        dev_sampler = DistributedSampler(dev_data)
-        dev_dataloader = DataLoader(dev_data, sampler=dev_sampler, batch_size=args.dev_batch_size, num_workers=4, pin_memory=True)
+    dev_data = pretraining_dataset(input_file=os.path.join(args.input_dir, args.dev_data_file), max_pred_length=args.max_predictions_per_seq,
+                                   backend=args.data_backend, mmap_dir=args.mmap_dir)
+    dev_dataloader = pretraining_dataloader(dev_data, args.dev_batch_size * n_gpu if args.local_rank == -1 else args.dev_batch_size,
+                                            args, args.seed)
 
     logger.info("***** Running training *****")
     logger.info("  Batch size = {}".format(args.train_batch_size))
@@ -314,6 +482,7 @@ def main():
     average_loss = 0.0 # averaged loss every args.log_freq steps
     epoch = 0
     training_steps = 0
+    total_stall = 0.0 # seconds training waited for data files
     while True:
         if not args.resume_from_checkpoint:
             random.shuffle(files)
@@ -322,17 +491,17 @@ def main():
             f_start_id = checkpoint['files'][0]
             files = checkpoint['files'][1:]
             args.resume_from_checkpoint = False
-        for f_id in range(f_start_id, len(files)):
+        make_dataset = functools.partial(pretraining_dataset, max_pred_length=args.max_predictions_per_seq,
+                                         backend=args.data_backend, mmap_dir=args.mmap_dir)
+        datasets = prefetch_datasets(files[f_start_id:], make_dataset, args.prefetch_files)
+        for f_id, (train_data, stall) in enumerate(datasets, f_start_id):
             data_file = files[f_id]
-            logger.info("file no {} file {}".format(f_id, data_file))
-            train_data = pretraining_dataset(input_file=data_file, max_pred_length=args.max_predictions_per_seq)
+            total_stall += stall
+            logger.info("file no {} file {} waited {:.2f}s for data, {:.2f}s in total".format(f_id, data_file, stall, total_stall))
 
-            if args.local_rank == -1:
-                train_sampler = RandomSampler(train_data)
-                train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size * n_gpu, num_workers=4, pin_memory=True)
-            else:
-                train_sampler = DistributedSampler(train_data)
-                train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size, num_workers=4, pin_memory=True)
+            train_dataloader = pretraining_dataloader(
+                train_data, args.train_batch_size * n_gpu if args.local_rank == -1 else args.train_batch_size,
+                args, args.seed + epoch * len(files) + f_id)
 
             for step, batch in enumerate(tqdm(train_dataloader, desc="File Iteration")):
                 model.train()
@@ -426,7 +595,6 @@ def main():
 
                         return
             del train_dataloader
-            del train_sampler
             del train_data       
 
             torch.cuda.empty_cache()